@@ -8,7 +8,16 @@ import plotly.express as px
 from modules.diversity import diversity_tab
 from modules.stats import stats_tab
 from modules.taxonomy import taxonomy_tab
-from modules.utils import load_table, safe_float, clean_state
+from modules.utils import load_table, safe_float, clean_state, session_load_options, file_bytes, file_hash
+from modules.cache import memoize
+from modules.biom_hdf5 import biom_info, is_biom
+from modules.alignment import load_dataset
+from modules.pipeline import phylo_tree
+from modules.prefilter import TOP_BY, prefilter_summary
+from modules.rarefaction import AUTO_DEPTH_KEEP, rarefy_summary
+from modules.store import WORKSPACE_QUOTA_BYTES, delete_study, list_studies, open_study, save_study, workspace_usage
+from modules.instrumentation import span
+from modules.diagnostics import diagnostics_panel
 
 # ======================== BLOQUE 2: ESTILO Y LOGO ========================
 st.set_page_config(page_title="Microbiota 16S - UYWA", layout="wide")
@@ -89,7 +98,7 @@ with st.sidebar:
         st.experimental_rerun()
 
 # ======================== BLOQUE 3: LOGIN ========================
-from auth import USERS_DB  # <-- IMPORTA TU ARCHIVO AUTH.PY AQUÍ
+from auth import USERS_DB, is_admin_user  # <-- IMPORTA TU ARCHIVO AUTH.PY AQUÍ
 
 def login():
     st.title("Iniciar sesión")
@@ -120,49 +129,196 @@ st.markdown(f"<div style='text-align:right; font-size:13px;'>👤 Usuario: <b>{s
 
 # ======================== BLOQUE 5: TITULO, UPLOADERS Y TABS PRINCIPALES ========================
 st.title("Gestión y Análisis de Microbiota 16S")
-tabs = st.tabs(["Carga de Archivos", "Diversidad", "Visualización Taxonómica", "Análisis Estadístico"])
+TAB_LABELS = ["Carga de Archivos", "Diversidad", "Visualización Taxonómica", "Análisis Estadístico"]
+# Pestañas con estado (Streamlit >= 1.55): cambiar de pestaña relanza el script y solo se ejecuta la abierta
+tabs = st.tabs(TAB_LABELS, key="main_tabs", on_change="rerun")
 
 # ======================== BLOQUE 6: CARGA DE ARCHIVOS EN PESTAÑA 0 ========================
 with tabs[0]:
     st.header("Carga de Archivos de Microbiota")
-    otus_file = st.file_uploader("Tabla OTUs/ASVs (csv/tsv/xlsx)", type=["csv", "tsv", "xlsx"], key="otus_upload_tab")
+    otus_file = st.file_uploader(
+        "Tabla OTUs/ASVs (csv/tsv/xlsx o BIOM v2.1 con taxonomía y metadata)",
+        type=["csv", "tsv", "xlsx", "biom"], key="otus_upload_tab"
+    )
     taxonomy_file = st.file_uploader("Taxonomía (csv/tsv/xlsx)", type=["csv", "tsv", "xlsx"], key="tax_upload_tab")
     metadata_file = st.file_uploader("Metadata (csv/tsv/xlsx)", type=["csv", "tsv", "xlsx"], key="meta_upload_tab")
+    tree_file = st.file_uploader(
+        "Árbol filogenético (Newick, opcional: habilita UniFrac)",
+        type=["nwk", "newick", "tre", "tree"], key="tree_upload_tab"
+    )
+    st.checkbox(
+        "Usar matriz dispersa para la tabla OTU (recomendado para tablas grandes)",
+        key="use_sparse",
+        help="Guarda los conteos como matriz dispersa entera (CSR); reduce mucho la memoria con tablas de >95% ceros."
+    )
+    st.checkbox(
+        "Lectura por bloques de la tabla OTU (tablas muy grandes)",
+        key="use_streaming",
+        help="Lee la tabla en bloques, comprime los conteos al entero mínimo y descarta los OTUs con todo ceros."
+    )
+
+    # Un archivo BIOM puede traer también la taxonomía y la metadata de muestras:
+    # se usa como esas tablas si no se suben por separado
+    if otus_file and is_biom(otus_file.name):
+        try:
+            biom = memoize("biominfo", file_hash(otus_file), lambda: biom_info(file_bytes(otus_file)), persist=False)
+        except ValueError as e:
+            st.error(str(e))
+            st.stop()
+        st.caption(
+            f"BIOM: {biom['n_features']} OTUs/ASVs x {biom['n_samples']} muestras · "
+            f"{biom['nnz'] / max(1, biom['n_features'] * biom['n_samples']):.1%} de valores no nulos"
+        )
+        if taxonomy_file is None and biom["taxonomy"]:
+            taxonomy_file = otus_file
+        if metadata_file is None and biom["metadata"]:
+            metadata_file = otus_file
 
     # Muestra información básica si los archivos están cargados
+    # (mismos parámetros que usan las pestañas: la tabla parseada se reutiliza desde la caché)
+    load_options = session_load_options()
     if otus_file:
-        df = load_table(otus_file)
+        progress_bar = st.progress(0.0, text="Leyendo tabla OTU/ASV...") if load_options["streaming"] else None
+        df = load_table(
+            otus_file, index_col=0, sparse=load_options["sparse"], streaming=load_options["streaming"],
+            progress=(lambda f: progress_bar.progress(f, text=f"Leyendo tabla OTU/ASV... {f:.0%}")) if progress_bar else None
+        )
+        if progress_bar:
+            progress_bar.empty()
         st.success(f"OTUs/ASVs: {df.shape[0]} filas x {df.shape[1]} columnas")
+        if df.attrs.get("dropped_features"):
+            st.info(f"Se descartaron {df.attrs['dropped_features']} OTUs/ASVs sin lecturas en ninguna muestra.")
     if taxonomy_file:
-        df = load_table(taxonomy_file)
+        df = load_table(taxonomy_file, index_col=0, section="taxonomy")
         st.success(f"Taxonomía: {df.shape[0]} filas x {df.shape[1]} columnas")
     if metadata_file:
-        df = load_table(metadata_file)
+        df = load_table(metadata_file, section="metadata")
         st.success(f"Metadata: {df.shape[0]} muestras x {df.shape[1]} variables")
+    if tree_file:
+        try:
+            tree = phylo_tree(tree_file)
+            st.success(f"Árbol filogenético: {tree.count(tips=True)} hojas")
+        except ValueError as e:
+            st.error(str(e))
+            tree_file = None
+    if otus_file and (taxonomy_file or metadata_file):
+        ds = load_dataset(otus_file, taxonomy_file, metadata_file, **dict(load_options, prefilter=None, rarefy=None))
+        n_samples, n_features = len(ds.alignment.samples), len(ds.alignment.features)
+        if metadata_file:
+            st.info(f"Muestras con metadata: {len(ds.common_samples)} de {n_samples}")
+        if taxonomy_file:
+            st.info(f"OTUs/ASVs con taxonomía: {ds.alignment.n_tax_matched} de {n_features}")
+
+    # Prefiltrado de OTUs/ASVs: se calcula una vez por conjunto de datos y parámetros
+    # y todas las pestañas de análisis trabajan sobre la tabla filtrada
+    with st.expander("Prefiltrado de OTUs/ASVs (común a todas las pestañas)"):
+        col_count, col_prev = st.columns(2)
+        col_count.number_input("Lecturas totales mínimas por OTU", min_value=0, step=1, key="pf_min_count")
+        col_prev.slider("Prevalencia mínima (% de muestras)", 0, 100, step=1, key="pf_min_prevalence")
+        col_top, col_by = st.columns(2)
+        col_top.number_input("Conservar los N OTUs principales (0: todos)", min_value=0, step=50, key="pf_top_n")
+        col_by.selectbox("Criterio del top N", list(TOP_BY), format_func=TOP_BY.get, key="pf_top_by")
+        if otus_file and taxonomy_file:
+            col_level, col_text = st.columns([1, 2])
+            tax_columns = list(load_table(taxonomy_file, index_col=0, section="taxonomy").columns)
+            col_level.selectbox("Nivel para excluir", tax_columns, index=None, key="pf_exclude_level")
+            col_text.text_input(
+                "Taxones a excluir (separados por comas)", key="pf_exclude",
+                placeholder="Mitochondria, Chloroplast",
+                help="Se excluyen los OTUs cuyo taxón en el nivel elegido contiene alguno de los textos."
+            )
+        if otus_file and (taxonomy_file or metadata_file):
+            # Sin rarefacción: su profundidad puede no ser válida y tiene su propio bloque
+            filtered = load_dataset(otus_file, taxonomy_file, metadata_file, **dict(session_load_options(), rarefy=None))
+            if filtered.prefilter is not None:
+                st.caption(prefilter_summary(filtered.prefilter))
+
+    # Rarefacción de toda la tabla a una profundidad uniforme (tras el prefiltrado):
+    # alfa, Bray-Curtis y agregados taxonómicos usan la misma tabla normalizada
+    with st.expander("Rarefacción a profundidad uniforme (común a todas las pestañas)"):
+        st.checkbox("Rarefactar la tabla antes de los análisis", key="rf_enabled")
+        col_depth, col_iter = st.columns(2)
+        col_depth.number_input(
+            "Profundidad (lecturas por muestra; 0: automática)", min_value=0, step=100, key="rf_depth",
+            help=f"La automática es la mayor profundidad que alcanza el {AUTO_DEPTH_KEEP:.0%} de las muestras."
+        )
+        col_iter.number_input("Submuestreos promediados", min_value=1, max_value=100, step=1, key="rf_iterations")
+        if st.session_state.get("rf_enabled") and otus_file and (taxonomy_file or metadata_file):
+            try:
+                rarefied = load_dataset(otus_file, taxonomy_file, metadata_file, **session_load_options())
+                st.caption(rarefy_summary(rarefied.rarefaction))
+            except ValueError as e:
+                st.error(str(e))
 
     # Guarda en sesión para otras pestañas
     if otus_file: st.session_state["otus_file"] = otus_file
     if taxonomy_file: st.session_state["taxonomy_file"] = taxonomy_file
     if metadata_file: st.session_state["metadata_file"] = metadata_file
+    if tree_file: st.session_state["tree_file"] = tree_file
 
-# ======================== BLOQUE 7: LLAMADA A CADA MÓDULO ========================
-with tabs[1]:
-    diversity_tab(
-        st.session_state.get("otus_file"),
-        st.session_state.get("taxonomy_file"),
-        st.session_state.get("metadata_file"),
-    )
+    # Estudios guardados en el almacén binario: se reabren sin volver a subir ni parsear.
+    # Cada usuario tiene su espacio de trabajo (USER_KEY); las tablas y los resultados
+    # se guardan por contenido y se comparten: el mismo archivo no se recalcula.
+    st.subheader("Estudios guardados")
+    col_name, col_save = st.columns([3, 1])
+    study_name = col_name.text_input("Nombre del estudio", key="study_name")
+    if col_save.button("Guardar estudio", key="save_study") and study_name.strip():
+        if st.session_state.get("otus_file") is None:
+            st.warning("Carga al menos la tabla OTU/ASV para guardar el estudio.")
+        else:
+            try:
+                save_study(
+                    study_name.strip(),
+                    st.session_state.get("otus_file"),
+                    st.session_state.get("taxonomy_file"),
+                    st.session_state.get("metadata_file"),
+                    workspace=USER_KEY,
+                    tree_file=st.session_state.get("tree_file"),
+                )
+                st.success(f"Estudio '{study_name.strip()}' guardado.")
+            except ValueError as e:
+                st.error(str(e))
+    studies = list_studies(USER_KEY)
+    if studies:
+        st.caption(
+            f"Espacio de trabajo: {workspace_usage(USER_KEY, studies) / 2 ** 20:.1f} MB "
+            f"de {WORKSPACE_QUOTA_BYTES / 2 ** 20:.0f} MB"
+        )
+        col_pick, col_open, col_delete = st.columns([3, 1, 1])
+        picked = col_pick.selectbox(
+            "Abrir estudio", range(len(studies)), format_func=lambda i: studies[i]["name"], key="study_pick"
+        )
+        if col_open.button("Abrir", key="open_study"):
+            otus_stored, taxonomy_stored, metadata_stored, tree_stored = open_study(studies[picked])
+            st.session_state["otus_file"] = otus_stored
+            st.session_state["taxonomy_file"] = taxonomy_stored
+            st.session_state["metadata_file"] = metadata_stored
+            st.session_state["tree_file"] = tree_stored
+            st.success(f"Estudio '{studies[picked]['name']}' abierto.")
+        if col_delete.button("Eliminar", key="delete_study"):
+            delete_study(studies[picked]["name"], USER_KEY)
+            st.rerun()
 
-with tabs[2]:
-    taxonomy_tab(
-        st.session_state.get("otus_file"),
-        st.session_state.get("taxonomy_file"),
-        st.session_state.get("metadata_file"),
-    )
+# ======================== BLOQUE 7: LLAMADA A CADA MÓDULO ========================
+# Solo la pestaña abierta calcula algo. Cada pestaña es además un fragmento
+# (st.fragment): sus widgets relanzan solo esa pestaña, no el script completo.
+analysis_tabs = [
+    (tabs[1], "pestaña.diversidad", diversity_tab),
+    (tabs[2], "pestaña.taxonomia", taxonomy_tab),
+    (tabs[3], "pestaña.estadistica", stats_tab),
+]
+for tab, span_name, tab_fn in analysis_tabs:
+    if not tab.open:
+        continue
+    with tab, span(span_name):
+        tab_fn(
+            st.session_state.get("otus_file"),
+            st.session_state.get("taxonomy_file"),
+            st.session_state.get("metadata_file"),
+        )
 
-with tabs[3]:
-    stats_tab(
-        st.session_state.get("otus_file"),
-        st.session_state.get("taxonomy_file"),
-        st.session_state.get("metadata_file"),
-    )
+# ======================== BLOQUE 8: DIAGNÓSTICO (SOLO ADMIN) ========================
+# Al final del script: incluye los tiempos de esta misma ejecución
+if is_admin_user(st.session_state.get("user")):
+    with st.sidebar:
+        diagnostics_panel()
@@ -2,7 +2,7 @@ import streamlit as st
 
 USERS_DB = {
     "demo": {"name": "Demo", "password": "1234", "premium": False},
-    "admin": {"name": "Admin", "password": "adminpass", "premium": True},
+    "admin": {"name": "Admin", "password": "adminpass", "premium": True, "admin": True},
     # ... Puedes usar una base de datos o archivo real
 }
 
@@ -21,3 +21,6 @@ def login():
 
 def is_premium_user(user):
     return user and user.get("premium", False)
+
+def is_admin_user(user):
+    return user and user.get("admin", False)
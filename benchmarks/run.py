@@ -0,0 +1,170 @@
+"""
+Benchmarks de escalabilidad con datos sintéticos.
+
+    python -m benchmarks.run                                  # tamaños por defecto
+    python -m benchmarks.run --sizes 50 500 5000 --out bench.json
+    python -m benchmarks.run --compare bench_anterior.json    # compara con otra versión
+
+Para cada tamaño (número de muestras) genera un conjunto de datos con semilla
+fija y mide el tiempo y la memoria pico (tracemalloc: Python + numpy) de cada
+etapa. El resultado es un JSON con la versión del código, el entorno y una
+fila por (etapa, tamaño). Las etapas demasiado caras para un tamaño (matriz
+de distancias densa) se marcan como omitidas.
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Cachés y almacén siempre en un directorio temporal propio: cada medición
+# parte en frío y nunca se tocan los datos reales de la app
+_WORKDIR = tempfile.mkdtemp(prefix="uywa-bench-")
+atexit.register(shutil.rmtree, _WORKDIR, ignore_errors=True)
+os.environ["UYWA_CACHE_DIR"] = os.path.join(_WORKDIR, "cache")
+os.environ["UYWA_STORE_DIR"] = os.path.join(_WORKDIR, "store")
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import write_dataset
+from modules.ordination import nmds
+from modules.permanova import permanova
+from modules.pipeline import compute_alpha, compute_braycurtis
+from modules.rarefaction import rarefaction_curves
+from modules.rollup import TaxonomyIndex
+from modules.store import STORE_DIR
+from modules.utils import PARSE_CACHE, load_table
+
+DEFAULT_SIZES = [50, 200, 1000, 5000, 20000]
+# Límites de muestras para etapas cuadráticas (distancias densas n x n)
+MAX_SAMPLES = {"braycurtis": 20000, "nmds": 2000, "permanova": 10000}
+
+def _version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def measure(fn, repeat=1):
+    """
+    Ejecuta fn() repeat veces; devuelve (último resultado, mejor tiempo en s, memoria pico en MB).
+    """
+    best, peak, result = float("inf"), 0, None
+    for _ in range(repeat):
+        result = None
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = min(best, elapsed)
+    return result, best, peak / 2 ** 20
+
+def bench_size(n_samples, n_features, seed, repeat, data_dir):
+    paths = write_dataset(os.path.join(data_dir, f"n{n_samples}_f{n_features}_s{seed}"), n_samples, n_features, seed)
+    rows = []
+
+    def record(stage, fn, limit=None):
+        if limit is not None and n_samples > limit:
+            rows.append({"stage": stage, "samples": n_samples, "features": n_features, "skipped": True})
+            return None
+        result, seconds, peak_mb = measure(fn, repeat)
+        rows.append({
+            "stage": stage, "samples": n_samples, "features": n_features,
+            "seconds": round(seconds, 5), "peak_mb": round(peak_mb, 2),
+        })
+        print(f"  {stage:<22} {seconds:9.3f} s {peak_mb:10.1f} MB", flush=True)
+        return result
+
+    def parse(sparse, cold=True):
+        # En frío se parsea el CSV; si no, se reabre la versión binaria del almacén
+        PARSE_CACHE.clear()
+        if cold:
+            shutil.rmtree(STORE_DIR, ignore_errors=True)
+        return load_table(paths["otus"], index_col=0, sparse=sparse)
+
+    dense = record("load_table", lambda: parse(False))
+    counts = record("load_table_sparse", lambda: parse(True))
+    record("load_table_store", lambda: parse(True, cold=False))
+    taxonomy = load_table(paths["taxonomy"], index_col=0)
+    metadata = load_table(paths["metadata"]).set_index("SampleID")
+
+    record("alpha", lambda: compute_alpha(dense))
+    record("alpha_sparse", lambda: compute_alpha(counts))
+    dist = record("braycurtis", lambda: compute_braycurtis(counts), MAX_SAMPLES["braycurtis"])
+    if dist is not None:
+        record("nmds", lambda: nmds(dist, n_jobs=1), MAX_SAMPLES["nmds"])
+        grouping = metadata.loc[list(dist.ids), "Treatment"].to_numpy()
+        record("permanova", lambda: permanova(dist, grouping, permutations=999, n_jobs=1), MAX_SAMPLES["permanova"])
+    record("rarefaction_curves", lambda: rarefaction_curves(counts, steps=10, iterations=10))
+    index = record("taxonomy_index", lambda: TaxonomyIndex(counts.features, taxonomy))
+    record("taxonomy_rollup", lambda: [index.rollup_frame(counts, level) for level in index.levels])
+    return rows
+
+def compare(current, previous):
+    """
+    Tabla de cocientes actual / anterior por (etapa, tamaño); >1 es más lento.
+    """
+    key = lambda r: (r["stage"], r["samples"], r["features"])
+    old = {key(r): r for r in previous["results"] if not r.get("skipped")}
+    rows = []
+    for r in current["results"]:
+        prev = old.get(key(r))
+        if r.get("skipped") or prev is None:
+            continue
+        rows.append({
+            "stage": r["stage"], "samples": r["samples"],
+            "seconds": r["seconds"], "seconds_prev": prev["seconds"],
+            "time_ratio": round(r["seconds"] / max(prev["seconds"], 1e-9), 3),
+            "peak_ratio": round(r["peak_mb"] / max(prev["peak_mb"], 1e-9), 3),
+        })
+    return pd.DataFrame(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de UYWA-MICROBIOTA con datos sintéticos.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Números de muestras")
+    parser.add_argument("--features", type=int, default=2000, help="Número de OTUs")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=1, help="Repeticiones por etapa (se guarda el mejor tiempo)")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "uywa-bench-data"),
+                        help="Carpeta de los conjuntos sintéticos (se reutilizan entre ejecuciones)")
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior para comparar")
+    args = parser.parse_args(argv)
+
+    report = {
+        "version": _version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "cpus": os.cpu_count(),
+        "params": {"features": args.features, "seed": args.seed, "repeat": args.repeat},
+        "results": [],
+    }
+    for n in sorted(args.sizes):
+        print(f"{n} muestras x {args.features} OTUs", flush=True)
+        report["results"] += bench_size(n, args.features, args.seed, args.repeat, args.data_dir)
+    with open(args.out, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Resultados en {os.path.abspath(args.out)}")
+
+    if args.compare:
+        with open(args.compare) as fh:
+            table = compare(report, json.load(fh))
+        print(table.to_string(index=False) if not table.empty else "Sin etapas comparables.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
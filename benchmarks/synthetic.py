@@ -0,0 +1,111 @@
+"""
+Generador reproducible (con semilla) de conjuntos de datos 16S sintéticos:
+tabla OTU dispersa de cola larga, taxonomía jerárquica coherente y metadata
+con un efecto de tratamiento sobre una fracción de los OTUs.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+RANKS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+# Número de taxones distintos por nivel (se reparten jerárquicamente)
+RANK_SIZES = [2, 12, 30, 60, 150, 400, 1200]
+
+def synthetic_counts(n_samples, n_features=2000, seed=42, mean_depth=30000, effect_fraction=0.05, groups=3):
+    """
+    Conteos muestras x OTUs (CSR de enteros) con:
+    - abundancia base lognormal (cola larga: pocos OTUs dominantes)
+    - prevalencia ligada a la abundancia (los raros aparecen en pocas muestras)
+    - profundidad de secuenciación lognormal por muestra
+    - un efecto multiplicativo del grupo de tratamiento en effect_fraction de los OTUs
+    Devuelve (matriz, códigos de grupo por muestra).
+    """
+    rng = np.random.default_rng(seed)
+    base = rng.lognormal(mean=0.0, sigma=2.0, size=n_features)
+    base /= base.sum()
+    # Prevalencia entre ~1% (raros) y ~95% (dominantes) según el rango de abundancia:
+    # en torno al 95% de ceros, como en tablas reales
+    rank = np.argsort(np.argsort(-base))
+    prevalence = 0.95 * np.exp(-rank / (0.04 * n_features)) + 0.01
+    group = rng.integers(0, groups, size=n_samples)
+    fold = np.ones((groups, n_features))
+    affected = rng.choice(n_features, size=max(1, int(effect_fraction * n_features)), replace=False)
+    fold[1:, affected] = rng.choice([0.25, 4.0], size=(groups - 1, len(affected)))
+    depth = rng.lognormal(mean=np.log(mean_depth), sigma=0.5, size=n_samples).astype(np.int64)
+
+    # Presencia dispersa: solo se generan las entradas no nulas
+    present = rng.random((n_samples, n_features), dtype=np.float32) < prevalence.astype(np.float32)
+    rows, cols = np.nonzero(present)
+    del present
+    weights = base[cols] * fold[group[rows], cols] * rng.lognormal(0.0, 1.0, size=len(cols))
+    sums = np.bincount(rows, weights=weights, minlength=n_samples)
+    expected = depth[rows] * weights / np.where(sums[rows] > 0, sums[rows], 1)
+    values = rng.poisson(expected)
+    keep = values > 0
+    matrix = sparse.csr_matrix(
+        (values[keep].astype(np.uint32), (rows[keep], cols[keep])), shape=(n_samples, n_features)
+    )
+    return matrix, group
+
+def synthetic_taxonomy(n_features, seed=42):
+    """
+    Taxonomía OTU x niveles coherente: cada taxón tiene un único padre.
+    """
+    rng = np.random.default_rng(seed + 1)
+    parents = [np.zeros(RANK_SIZES[0], dtype=int)]
+    for i in range(1, len(RANK_SIZES)):
+        parents.append(rng.integers(0, RANK_SIZES[i - 1], size=RANK_SIZES[i]))
+    species = rng.integers(0, RANK_SIZES[-1], size=n_features)
+    codes = [species]
+    for i in range(len(RANKS) - 1, 0, -1):
+        codes.append(parents[i][codes[-1]])
+    codes = codes[::-1]
+    table = {rank: [f"{rank}_{c}" for c in code] for rank, code in zip(RANKS, codes)}
+    return pd.DataFrame(table, index=pd.Index([f"OTU{i}" for i in range(n_features)], name="OTU"))
+
+def synthetic_metadata(group, seed=42):
+    """
+    Metadata por muestra: tratamiento (el grupo del efecto), sexo y peso.
+    """
+    rng = np.random.default_rng(seed + 2)
+    n = len(group)
+    return pd.DataFrame({
+        "SampleID": [f"S{i}" for i in range(n)],
+        "Treatment": np.array(["A", "B", "C", "D", "E"])[group],
+        "Sex": rng.choice(["F", "M"], size=n),
+        "Weight": np.round(rng.normal(10.0, 1.5, size=n), 2),
+    })
+
+def write_dataset(folder, n_samples, n_features=2000, seed=42):
+    """
+    Escribe otus.csv (OTU x muestras), taxonomy.csv y metadata.csv en folder
+    y devuelve sus rutas. Los parámetros se anotan en params.json, que se
+    escribe al final: los archivos se reutilizan solo si existen y la nota
+    coincide; si no (otros parámetros, escritura interrumpida) se regeneran.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = {name: os.path.join(folder, f"{name}.csv") for name in ("otus", "taxonomy", "metadata")}
+    stamp_path = os.path.join(folder, "params.json")
+    stamp = {"n_samples": int(n_samples), "n_features": int(n_features), "seed": int(seed)}
+    try:
+        with open(stamp_path) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+    if previous == stamp and all(os.path.exists(p) for p in paths.values()):
+        return paths
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+    matrix, group = synthetic_counts(n_samples, n_features, seed=seed)
+    samples = [f"S{i}" for i in range(n_samples)]
+    otus = pd.DataFrame(matrix.T.toarray(), index=pd.Index([f"OTU{i}" for i in range(n_features)], name="OTU"),
+                        columns=samples)
+    otus.to_csv(paths["otus"])
+    synthetic_taxonomy(n_features, seed).to_csv(paths["taxonomy"])
+    synthetic_metadata(group, seed).to_csv(paths["metadata"], index=False)
+    with open(stamp_path, "w") as f:
+        json.dump(stamp, f)
+    return paths
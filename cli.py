@@ -0,0 +1,132 @@
+"""
+Análisis por lotes sin Streamlit.
+
+Ejemplos:
+    python cli.py --otus otus.csv --taxonomy tax.csv --metadata meta.csv --out resultados
+    python cli.py --manifest estudios.csv --jobs 8 --out resultados
+    python cli.py --study "Ensayo 2025" --permutations 9999
+    python cli.py --workspace uywa_mbio_admin --study "Ensayo 2025"
+    python cli.py --otus otus.csv --metadata meta.csv --min-prevalence 0.1 --exclude Family:Mitochondria
+    python cli.py --otus otus.csv --metadata meta.csv --rarefy 0 --rarefy-iterations 10
+
+El manifiesto (csv o json) tiene una fila por estudio con las columnas
+name, otus, taxonomy, metadata y, para UniFrac, tree (rutas). Con el mismo UYWA_CACHE_DIR que el
+servidor, la app reutiliza los resultados precalculados al abrir los mismos archivos.
+"""
+import argparse
+import json
+import os
+import sys
+
+import pandas as pd
+
+from modules.distances import BETA_METRICS
+from modules.pipeline import ORDINATION_METHODS, run_batch
+from modules.prefilter import TOP_BY
+from modules.store import list_studies, open_study
+
+def _manifest_studies(path):
+    if path.lower().endswith(".json"):
+        with open(path) as fh:
+            rows = json.load(fh)
+    else:
+        rows = pd.read_csv(path, sep=None, engine="python").to_dict("records")
+    studies = []
+    for i, row in enumerate(rows):
+        row = {k: v for k, v in row.items() if isinstance(v, str) and v.strip()}
+        if "otus" not in row:
+            raise ValueError(f"Fila {i + 1} del manifiesto sin columna 'otus'.")
+        row.setdefault("name", os.path.splitext(os.path.basename(row["otus"]))[0])
+        studies.append(row)
+    return studies
+
+def _stored_studies(names, workspace=None):
+    saved = {entry["name"]: entry for entry in list_studies(workspace)}
+    studies = []
+    for name in names:
+        if name not in saved:
+            raise ValueError(f"No existe el estudio guardado '{name}'.")
+        otus, taxonomy, metadata, tree = open_study(saved[name])
+        studies.append({"name": name, "otus": otus, "taxonomy": taxonomy, "metadata": metadata, "tree": tree})
+    return studies
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Análisis de microbiota 16S por lotes (UYWA-MICROBIOTA).")
+    source = parser.add_argument_group("estudios")
+    source.add_argument("--otus", help="Tabla OTU/ASV (csv/tsv/xlsx/biom) de un único estudio")
+    source.add_argument("--taxonomy", help="Taxonomía del estudio indicado con --otus")
+    source.add_argument("--metadata", help="Metadata del estudio indicado con --otus")
+    source.add_argument("--name", help="Nombre del estudio indicado con --otus (carpeta de salida)")
+    source.add_argument("--tree", help="Árbol Newick del estudio indicado con --otus (métricas UniFrac)")
+    source.add_argument("--manifest", help="csv/json con columnas name, otus, taxonomy, metadata")
+    source.add_argument("--study", action="append", default=[], help="Estudio guardado desde la app (repetible)")
+    source.add_argument("--workspace", help="Espacio de trabajo de los estudios de --study (uywa_mbio_<usuario>)")
+    parser.add_argument("--out", default="resultados", help="Carpeta de resultados (por defecto: resultados)")
+    parser.add_argument("--jobs", type=int, default=None, help="Procesos en paralelo (por defecto: todos los núcleos)")
+    parser.add_argument("--metric", choices=list(BETA_METRICS), default="braycurtis", help="Métrica de distancia beta")
+    parser.add_argument("--method", choices=ORDINATION_METHODS, default="nmds", help="Ordenación de las distancias")
+    parser.add_argument("--permutations", type=int, default=999, help="Permutaciones de PERMANOVA")
+    parser.add_argument("--vars", help="Variables de metadata para PERMANOVA, separadas por comas (por defecto: todas las categóricas)")
+    parser.add_argument("--sparse", action="store_true", help="Tabla OTU como matriz dispersa (tablas grandes)")
+    prefilter = parser.add_argument_group("prefiltrado de OTUs/ASVs")
+    prefilter.add_argument("--min-count", type=float, default=0, help="Lecturas totales mínimas por OTU")
+    prefilter.add_argument("--min-prevalence", type=float, default=0, help="Fracción mínima de muestras con el OTU (0-1)")
+    prefilter.add_argument("--top-n", type=int, default=0, help="Conserva solo los N OTUs principales (0: todos)")
+    prefilter.add_argument("--top-by", choices=list(TOP_BY), default="abundance", help="Criterio de --top-n")
+    prefilter.add_argument("--exclude", action="append", default=[], metavar="NIVEL:TEXTO",
+                           help="Excluye los OTUs cuyo taxón del nivel contiene el texto (repetible)")
+    rarefy = parser.add_argument_group("rarefacción de la tabla")
+    rarefy.add_argument("--rarefy", type=int, metavar="PROFUNDIDAD",
+                        help="Rarefacta todas las muestras a esta profundidad antes de los análisis (0: automática)")
+    rarefy.add_argument("--rarefy-iterations", type=int, default=1, help="Submuestreos promediados (con --rarefy)")
+    rarefy.add_argument("--seed", type=int, default=42, help="Semilla de la rarefacción")
+    return parser.parse_args(argv)
+
+def _prefilter_params(args):
+    exclude = []
+    for item in args.exclude:
+        level, sep, text = item.partition(":")
+        if not sep:
+            raise ValueError(f"--exclude espera NIVEL:TEXTO, no '{item}'.")
+        exclude.append((level, text))
+    return {
+        "min_count": args.min_count, "min_prevalence": args.min_prevalence,
+        "top_n": args.top_n, "top_by": args.top_by, "exclude": exclude,
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    studies = []
+    if args.otus:
+        studies.append({
+            "name": args.name or os.path.splitext(os.path.basename(args.otus))[0],
+            "otus": args.otus, "taxonomy": args.taxonomy, "metadata": args.metadata, "tree": args.tree,
+        })
+    if args.manifest:
+        studies += _manifest_studies(args.manifest)
+    if args.study:
+        studies += _stored_studies(args.study, args.workspace)
+    if not studies:
+        print("Indica al menos un estudio con --otus, --manifest o --study.", file=sys.stderr)
+        return 2
+
+    results = run_batch(
+        studies, args.out, n_jobs=args.jobs, method=args.method, metric=args.metric, permutations=args.permutations,
+        variables=[v.strip() for v in args.vars.split(",")] if args.vars else None, sparse=args.sparse,
+        prefilter=_prefilter_params(args),
+        rarefy=None if args.rarefy is None else {
+            "depth": args.rarefy, "iterations": args.rarefy_iterations, "seed": args.seed,
+        },
+    )
+    failed = 0
+    for res in results:
+        if "error" in res:
+            failed += 1
+            print(f"[ERROR] {res['name']}: {res['error']}", file=sys.stderr)
+        else:
+            print(f"[OK] {res['name']}: {res['samples']} muestras, {res['features']} OTUs/ASVs, {res['total_seconds']:.1f} s")
+    print(f"Resultados en {os.path.abspath(args.out)}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
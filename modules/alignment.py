@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+
+from modules.cache import hash_key, memoize
+from modules.prefilter import normalize_prefilter, prefilter_features, select_features
+from modules.rarefaction import normalize_rarefy, rarefy_table
+from modules.sparse import SparseCounts, row_slice
+from modules.utils import load_table, file_hash
+
+def normalize_ids(ids, upper=False):
+    """
+    Normaliza IDs de forma vectorizada: texto, sin espacios en los extremos
+    y sin el sufijo '.0' que deja Excel en los IDs numéricos.
+    Con upper=True además pasa a mayúsculas (IDs de OTU/ASV).
+    """
+    ids = pd.Index(ids).astype(str).str.strip().str.replace(r"\.0$", "", regex=True)
+    if upper:
+        ids = ids.str.upper()
+    return pd.Index(ids)
+
+def categorical_vars(metadata):
+    """
+    Variables de metadata útiles para agrupar: más de un valor y no un valor por muestra.
+    """
+    if metadata is None:
+        return []
+    return [col for col in metadata.columns if 1 < metadata[col].nunique() < len(metadata)]
+
+def _find_id_column(metadata, samples):
+    """
+    Columna de metadata (o None para el índice) que mejor cubre los IDs de muestra.
+    Prefiere el índice y las columnas llamadas 'SampleID'; cada candidata se
+    evalúa con un único isin vectorizado.
+    """
+    candidates = [(None, metadata.index)]
+    for col in metadata.columns:
+        if str(col).strip().replace(" ", "").lower() == "sampleid":
+            candidates.insert(0, (col, metadata[col]))
+        else:
+            candidates.append((col, metadata[col]))
+    best, best_hits = None, 0
+    for col, values in candidates:
+        hits = int(normalize_ids(values).isin(samples).sum())
+        if hits > best_hits:
+            best, best_hits = col, hits
+        if hits == len(samples):
+            break
+    return best, best_hits
+
+class Alignment:
+    """
+    Índices de IDs normalizados de un conjunto de datos y sus indexadores
+    posicionales hacia cada tabla, calculados una sola vez.
+    - features / samples: IDs normalizados de la tabla OTU (su orden)
+    - feature_tax_pos: fila de taxonomía de cada OTU (-1 si no tiene)
+    - sample_meta_pos: fila de metadata de cada muestra (-1 si no tiene)
+    - meta_id_col: columna de metadata con el ID de muestra (None = índice)
+    """
+
+    def __init__(self, features, samples, taxonomy=None, metadata=None):
+        self.features = normalize_ids(features, upper=True)
+        self.samples = normalize_ids(samples)
+        self.feature_tax_pos = np.full(len(self.features), -1)
+        self.sample_meta_pos = np.full(len(self.samples), -1)
+        self.meta_id_col = None
+        if taxonomy is not None:
+            tax_ids = normalize_ids(taxonomy.index, upper=True)
+            # Con IDs duplicados en la taxonomía se usa la primera aparición
+            first = ~tax_ids.duplicated(keep="first")
+            pos = pd.Index(tax_ids[first]).get_indexer(self.features)
+            self.feature_tax_pos = np.where(pos >= 0, np.flatnonzero(first)[np.clip(pos, 0, None)], -1)
+        if metadata is not None:
+            self.meta_id_col, _ = _find_id_column(metadata, self.samples)
+            meta_ids = normalize_ids(metadata.index if self.meta_id_col is None else metadata[self.meta_id_col])
+            first = ~meta_ids.duplicated(keep="first")
+            pos = pd.Index(meta_ids[first]).get_indexer(self.samples)
+            self.sample_meta_pos = np.where(pos >= 0, np.flatnonzero(first)[np.clip(pos, 0, None)], -1)
+
+    @property
+    def common_samples(self):
+        # Muestras con metadata, en el orden de la tabla OTU
+        return self.samples[self.sample_meta_pos >= 0]
+
+    @property
+    def n_tax_matched(self):
+        return int((self.feature_tax_pos >= 0).sum())
+
+    def counts(self, otus, common_only=False):
+        """
+        Tabla de conteos con IDs normalizados (y solo muestras con metadata si common_only).
+        Si las muestras que quedan son contiguas (en particular, todas) se
+        seleccionan con un slice: la tabla sigue siendo una vista de la
+        original, sin copiar los datos abiertos con memory-map del almacén.
+        """
+        keep = np.flatnonzero(self.sample_meta_pos >= 0) if common_only else np.arange(len(self.samples))
+        if len(keep) and keep[-1] - keep[0] + 1 == len(keep):
+            keep = slice(int(keep[0]), int(keep[-1]) + 1)
+        if isinstance(otus, SparseCounts):
+            matrix = row_slice(otus.matrix, keep.start, keep.stop) if isinstance(keep, slice) else otus.matrix[keep]
+            return SparseCounts(matrix, self.samples[keep], self.features)
+        out = otus.iloc[:, keep]
+        out.index = self.features
+        out.columns = self.samples[keep]
+        return out
+
+    def taxonomy(self, taxonomy):
+        """
+        Filas de taxonomía de los OTUs con asignación, indexadas por el ID normalizado.
+        """
+        matched = self.feature_tax_pos >= 0
+        out = taxonomy.iloc[self.feature_tax_pos[matched]]
+        out.index = self.features[matched]
+        return out
+
+    def metadata(self, metadata):
+        """
+        Metadata de las muestras comunes, indexada por el ID normalizado de
+        muestra y en el orden de la tabla OTU (sin la columna de ID).
+        """
+        matched = self.sample_meta_pos >= 0
+        out = metadata.iloc[self.sample_meta_pos[matched]]
+        if self.meta_id_col is not None:
+            out = out.drop(columns=[self.meta_id_col])
+        out.index = pd.Index(self.samples[matched], name="SampleID")
+        return out
+
+class Dataset:
+    """
+    Conjunto de datos alineado que comparten todas las pestañas.
+    - otus: conteos (DataFrame OTU x muestras o SparseCounts) con IDs normalizados
+    - taxonomy: taxonomía de los OTUs con asignación (o None)
+    - metadata: metadata de las muestras comunes (o None)
+    - key: huellas de contenido de los archivos, para las cachés de resultados
+    - prefilter: informe del prefiltrado de OTUs (None si no se filtró)
+    - rarefaction: profundidad, muestras descartadas e índices alfa de la
+      rarefacción de la tabla (None si no se rarefactó)
+    """
+
+    def __init__(self, otus, taxonomy, metadata, alignment, key, prefilter=None, rarefaction=None):
+        self.otus = otus
+        self.taxonomy = taxonomy
+        self.metadata = metadata
+        self.alignment = alignment
+        self.key = key
+        self.prefilter = prefilter
+        self.rarefaction = rarefaction
+
+    @property
+    def features(self):
+        # OTUs analizados (tras el prefiltrado), en el orden de la tabla de conteos
+        return self.otus.features if isinstance(self.otus, SparseCounts) else self.otus.index
+
+    @property
+    def common_samples(self):
+        # Muestras con metadata (la metadata ya excluye las descartadas al rarefactar)
+        return self.metadata.index if self.metadata is not None else self.alignment.common_samples
+
+    @property
+    def counts_key(self):
+        # Huella de los conteos tal como se analizan (archivo + opciones de carga + prefiltrado)
+        return hash_key(self.key[0], *self.key[3:])
+
+    def common_counts(self):
+        """
+        Conteos restringidos a las muestras con metadata (orden de la tabla OTU).
+        """
+        if self.metadata is None:
+            return self.otus
+        keep = self.otus.samples if isinstance(self.otus, SparseCounts) else self.otus.columns
+        keep = keep.isin(self.metadata.index)
+        if isinstance(self.otus, SparseCounts):
+            return self.otus.select_samples(self.otus.samples[keep])
+        return self.otus.loc[:, keep]
+
+def _build_dataset(otus_file, taxonomy_file, metadata_file, sparse, streaming, key):
+    otus = load_table(otus_file, index_col=0, sparse=sparse, streaming=streaming)
+    taxonomy = load_table(taxonomy_file, index_col=0, section="taxonomy") if taxonomy_file else None
+    metadata = load_table(metadata_file, section="metadata") if metadata_file else None
+    samples = otus.samples if sparse else otus.columns
+    features = otus.features if sparse else otus.index
+    alignment = Alignment(features, samples, taxonomy, metadata)
+    return Dataset(
+        alignment.counts(otus),
+        alignment.taxonomy(taxonomy) if taxonomy is not None else None,
+        alignment.metadata(metadata) if metadata is not None else None,
+        alignment,
+        key,
+    )
+
+def _prefilter_dataset(ds, params, key):
+    features, report = prefilter_features(ds.otus, ds.taxonomy, params)
+    return Dataset(select_features(ds.otus, features), ds.taxonomy, ds.metadata, ds.alignment, key, prefilter=report)
+
+def _rarefy_dataset(ds, params, key):
+    result = memoize("rarefied", (ds.counts_key, params), lambda: rarefy_table(ds.otus, **dict(params)))
+    report = {k: v for k, v in result.items() if k != "counts"}
+    metadata = ds.metadata
+    if metadata is not None and report["dropped"]:
+        metadata = metadata[~metadata.index.isin(report["dropped"])]
+    return Dataset(result["counts"], ds.taxonomy, metadata, ds.alignment, key, prefilter=ds.prefilter, rarefaction=report)
+
+def load_dataset(otus_file, taxonomy_file=None, metadata_file=None, sparse=False, streaming=False, prefilter=None,
+                 rarefy=None):
+    """
+    Carga y alinea OTUs, taxonomía y metadata una sola vez por conjunto de
+    datos (clave: huellas de contenido y opciones de carga). Todas las
+    pestañas reutilizan el mismo Dataset en lugar de repetir merges en cada rerun.
+    prefilter: parámetros de modules.prefilter; la vista filtrada se memoriza
+    aparte y sus resultados no se mezclan con los de la tabla completa.
+    rarefy: parámetros de rarefy_table (depth, iterations, seed); la tabla
+    rarefactada (tras el prefiltrado) se calcula una vez y se guarda en la caché de disco.
+    """
+    if otus_file is None:
+        return None
+    key = (
+        file_hash(otus_file),
+        file_hash(taxonomy_file) if taxonomy_file else None,
+        file_hash(metadata_file) if metadata_file else None,
+        bool(sparse),
+        bool(streaming),
+    )
+    ds = memoize(
+        "dataset", key,
+        lambda: _build_dataset(otus_file, taxonomy_file, metadata_file, sparse, streaming, key),
+        persist=False,
+    )
+    params = normalize_prefilter(prefilter)
+    if params is not None:
+        key = key + (params,)
+        ds = memoize("dataset", key, lambda: _prefilter_dataset(ds, params, key), persist=False)
+    rarefy = normalize_rarefy(rarefy)
+    if rarefy is not None:
+        key = key + (("rarefy",) + rarefy,)
+        ds = memoize("dataset", key, lambda: _rarefy_dataset(ds, rarefy, key), persist=False)
+    return ds
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from modules.sparse import SparseCounts
+
+# Métricas disponibles (clave -> etiqueta). Todas salen de las mismas sumas por
+# muestra, así que añadir una métrica no añade otra pasada sobre la matriz.
+ALPHA_METRICS = {
+    "shannon": "Shannon",
+    "simpson": "Simpson",
+    "chao1": "Chao1",
+    "observed_otus": "OTUs Observados",
+    "pielou_e": "Pielou",
+    "ace": "ACE",
+    "goods_coverage": "Cobertura de Good",
+}
+# Muestras por bloque con tablas densas: acota la memoria a BLOCK_SAMPLES x OTUs
+BLOCK_SAMPLES = 1024
+RARE_THRESHOLD = 10
+
+def _sample_stats(rows, values, nrows):
+    """
+    Sumas por muestra a partir de los valores no nulos (una pasada):
+    total de lecturas, OTUs observados, singletons, doubletons, sum(x ln x),
+    sum(x²) y, para ACE, las sumas de los OTUs raros (x <= RARE_THRESHOLD).
+    """
+    x = values.astype(np.float64)
+    rare = x <= RARE_THRESHOLD
+    total = lambda w: np.bincount(rows, weights=w, minlength=nrows)
+    return {
+        "n": total(x),
+        "s": np.bincount(rows, minlength=nrows).astype(np.float64),
+        "f1": total(x == 1),
+        "f2": total(x == 2),
+        "xlogx": total(x * np.log(x)),
+        "x2": total(x * x),
+        "s_rare": total(rare),
+        "n_rare": total(np.where(rare, x, 0.0)),
+        "gamma_rare": total(np.where(rare, x * (x - 1), 0.0)),
+    }
+
+def _metric(stats, metric):
+    n, s, f1, f2 = stats["n"], stats["s"], stats["f1"], stats["f2"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if metric == "observed_otus":
+            return s
+        if metric == "shannon":
+            return np.log(n) - stats["xlogx"] / n
+        if metric == "simpson":
+            return 1 - stats["x2"] / (n * n)
+        if metric == "chao1":
+            # Versión con corrección de sesgo (la de scikit-bio por defecto)
+            return s + f1 * (f1 - 1) / (2 * (f2 + 1))
+        if metric == "pielou_e":
+            return (np.log(n) - stats["xlogx"] / n) / np.log(s)
+        if metric == "goods_coverage":
+            return 1 - f1 / n
+        if metric == "ace":
+            s_rare, n_rare = stats["s_rare"], stats["n_rare"]
+            c_ace = 1 - f1 / n_rare
+            gamma = s_rare * stats["gamma_rare"] / (c_ace * n_rare * (n_rare - 1)) - 1
+            ace = (s - s_rare) + s_rare / c_ace + f1 / c_ace * np.clip(gamma, 0, None)
+            # Sin OTUs raros ACE es el número de abundantes; indefinido si todos los raros son singletons
+            ace = np.where(s_rare == 0, s - s_rare, ace)
+            return np.where((f1 > 0) & (f1 == s_rare), np.nan, ace)
+    raise ValueError(f"Métrica alfa no soportada: {metric}")
+
+def _dense_blocks(otus, block_size):
+    # Bloques muestras x OTUs de una tabla densa OTU x muestras
+    for start in range(0, otus.shape[1], block_size):
+        block = otus.iloc[:, start:start + block_size].apply(pd.to_numeric, errors="coerce")
+        yield np.clip(block.fillna(0).to_numpy(dtype=np.float64).T, 0, None)
+
+def alpha_diversity_table(otus, metrics=None, block_size=BLOCK_SAMPLES):
+    """
+    Todas las métricas alfa pedidas en una sola pasada vectorizada.
+    - otus: DataFrame OTU x muestras, SparseCounts o matriz muestras x OTUs (densa o dispersa)
+    - metrics: claves de ALPHA_METRICS (por defecto todas)
+    Se procesa por bloques de block_size muestras; con matrices dispersas
+    solo se recorren los valores no nulos de cada bloque de la CSR.
+    Devuelve un DataFrame muestras x etiquetas de ALPHA_METRICS. Las métricas
+    indefinidas para una muestra (vacía, o ACE solo con singletons) quedan NaN.
+    """
+    metrics = list(ALPHA_METRICS) if metrics is None else list(metrics)
+    unknown = [m for m in metrics if m not in ALPHA_METRICS]
+    if unknown:
+        raise ValueError(f"Métrica alfa no soportada: {', '.join(unknown)}")
+
+    if isinstance(otus, pd.DataFrame):
+        samples, blocks = otus.columns, _dense_blocks(otus, block_size)
+    else:
+        matrix = otus.matrix if isinstance(otus, SparseCounts) else otus
+        samples = otus.samples if isinstance(otus, SparseCounts) else pd.RangeIndex(matrix.shape[0])
+        if sparse.issparse(matrix):
+            matrix = sparse.csr_matrix(matrix)
+            if not matrix.has_canonical_format:
+                matrix = matrix.copy()
+                matrix.sum_duplicates()
+        else:
+            matrix = np.asarray(matrix)
+        blocks = (matrix[s:s + block_size] for s in range(0, matrix.shape[0], block_size))
+
+    parts = []
+    for block in blocks:
+        if sparse.issparse(block):
+            nrows = block.shape[0]
+            rows = np.repeat(np.arange(nrows), np.diff(block.indptr))
+            values = block.data
+            keep = values > 0
+            rows, values = rows[keep], values[keep]
+        else:
+            nrows = block.shape[0]
+            rows, cols = np.nonzero(block > 0)
+            values = block[rows, cols]
+        stats = _sample_stats(rows, values, nrows)
+        parts.append(np.column_stack([_metric(stats, m) for m in metrics]) if metrics else np.empty((nrows, 0)))
+
+    values = np.vstack(parts) if parts else np.empty((0, len(metrics)))
+    return pd.DataFrame(values, index=samples, columns=[ALPHA_METRICS[m] for m in metrics])
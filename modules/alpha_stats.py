@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2, f as f_dist, norm, rankdata, t as t_dist
+
+from modules.differential import bh_adjust
+
+# Pruebas de grupo de la diversidad alfa para todas las métricas y todas las
+# variables de agrupación de una vez. Los grupos se codifican como enteros
+# (pd.factorize) y todas las sumas por grupo y métrica salen de bincount sobre
+# códigos desplazados (código + grupos * métrica): sin máscaras por grupo.
+SUMMARY_COLUMNS = [
+    "Métrica", "Variable", "Grupos", "N", "ANOVA F", "ANOVA p", "ANOVA FDR",
+    "Kruskal H", "Kruskal p", "Kruskal FDR",
+]
+POSTHOC_COLUMNS = [
+    "Métrica", "Variable", "Grupo A", "Grupo B", "n A", "n B", "Diferencia de medias",
+    "Welch t", "Welch p", "Welch FDR", "Dunn z", "Dunn p", "Dunn FDR",
+]
+
+def _by_group(idx, weights, m, k):
+    # Suma por (métrica, grupo) como matriz métricas x grupos
+    return np.bincount(idx, weights=weights, minlength=m * k).reshape(m, k)
+
+def _tie_terms(values, valid):
+    # sum(t³ - t) de los empates de cada métrica (solo valores válidos)
+    out = np.zeros(values.shape[1])
+    for j in range(values.shape[1]):
+        _, t = np.unique(values[valid[:, j], j], return_counts=True)
+        out[j] = (t.astype(np.float64) ** 3 - t).sum()
+    return out
+
+def _variable_tests(values, codes, k):
+    """
+    ANOVA, Kruskal-Wallis y post-hoc por pares (Welch t y Dunn) de todas las
+    métricas (columnas de values) para una variable con códigos 0..k-1
+    (-1 = sin grupo). Los NaN de cada métrica se ignoran.
+    """
+    n, m = values.shape
+    valid = ~np.isnan(values) & (codes >= 0)[:, None]
+    idx = (codes[:, None] + k * np.arange(m))[valid]
+    x = values[valid]
+    ranks = rankdata(np.where(valid, values, np.nan), axis=0, nan_policy="omit")[valid]
+
+    cnt = _by_group(idx, None, m, k)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = _by_group(idx, x, m, k) / cnt
+        # Suma de cuadrados centrada en la media de cada grupo (segunda pasada, más estable)
+        ssw_g = _by_group(idx, (x - means.ravel()[idx]) ** 2, m, k)
+        mean_ranks = _by_group(idx, ranks, m, k) / cnt
+
+        total = cnt.sum(axis=1)
+        groups = (cnt > 0).sum(axis=1)
+        grand = np.nansum(means * cnt, axis=1) / total
+        ssb = np.nansum(cnt * (means - grand[:, None]) ** 2, axis=1)
+        ssw = ssw_g.sum(axis=1)
+        df1, df2 = groups - 1, total - groups
+        F = (ssb / df1) / (ssw / df2)
+        anova_p = f_dist.sf(F, df1, df2)
+
+        ties = _tie_terms(values, valid)
+        H = 12 / (total * (total + 1)) * np.nansum(cnt * mean_ranks ** 2, axis=1) - 3 * (total + 1)
+        H = H / (1 - ties / (total ** 3 - total))
+        kruskal_p = chi2.sf(H, df1)
+
+    # Mismo criterio que la prueba por variable de la pestaña: todos los grupos con réplicas
+    ok = (groups >= 2) & ((cnt == 0) | (cnt >= 2)).all(axis=1)
+    summary = {
+        "Grupos": groups, "N": total,
+        "ANOVA F": np.where(ok, F, np.nan), "ANOVA p": np.where(ok, anova_p, np.nan),
+        "Kruskal H": np.where(ok, H, np.nan), "Kruskal p": np.where(ok, kruskal_p, np.nan),
+    }
+
+    a, b = np.triu_indices(k, 1)
+    na, nb = cnt[:, a], cnt[:, b]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        va, vb = ssw_g[:, a] / (na - 1) / na, ssw_g[:, b] / (nb - 1) / nb
+        diff = means[:, a] - means[:, b]
+        t = diff / np.sqrt(va + vb)
+        df = (va + vb) ** 2 / (va ** 2 / (na - 1) + vb ** 2 / (nb - 1))
+        welch_p = 2 * t_dist.sf(np.abs(t), df)
+        sigma2 = (total * (total + 1) / 12 - ties / (12 * (total - 1)))[:, None]
+        z = (mean_ranks[:, a] - mean_ranks[:, b]) / np.sqrt(sigma2 * (1 / na + 1 / nb))
+        dunn_p = 2 * norm.sf(np.abs(z))
+    replicated = (na >= 2) & (nb >= 2)
+    posthoc = {
+        "a": a, "b": b, "n A": na, "n B": nb, "Diferencia de medias": diff,
+        "Welch t": np.where(replicated, t, np.nan), "Welch p": np.where(replicated, welch_p, np.nan),
+        "Dunn z": np.where(replicated, z, np.nan), "Dunn p": np.where(replicated, dunn_p, np.nan),
+    }
+    return summary, posthoc
+
+def alpha_group_tests(alpha, metadata, variables):
+    """
+    Matriz de pruebas de grupo: cada métrica alfa (columnas de alpha) por cada
+    variable de metadata en variables.
+    - resumen: una fila por métrica x variable con ANOVA y Kruskal-Wallis; el
+      FDR (Benjamini-Hochberg) corrige sobre todas las filas
+    - post-hoc: una fila por par de grupos con Welch t y Dunn; el FDR corrige
+      dentro de cada métrica x variable
+    Las muestras sin valor en la variable no cuentan en ningún grupo.
+    Devuelve (resumen, post-hoc) como DataFrames.
+    """
+    metrics = list(alpha.columns)
+    values = alpha.to_numpy(dtype=np.float64)
+    rows, pairs = [], []
+    for var in variables:
+        codes, labels = pd.factorize(metadata[var].reindex(alpha.index))
+        labels = labels.astype(str)
+        summary, posthoc = _variable_tests(values, codes, len(labels))
+        for j, metric in enumerate(metrics):
+            rows.append({"Métrica": metric, "Variable": var, **{c: v[j] for c, v in summary.items()}})
+            family = {c: v[j] for c, v in posthoc.items() if c not in ("a", "b")}
+            family["Welch FDR"] = bh_adjust(family["Welch p"])
+            family["Dunn FDR"] = bh_adjust(family["Dunn p"])
+            pairs.append(pd.DataFrame({
+                "Métrica": metric, "Variable": var,
+                "Grupo A": labels[posthoc["a"]], "Grupo B": labels[posthoc["b"]], **family,
+            }))
+
+    summary = pd.DataFrame(rows, columns=[c for c in SUMMARY_COLUMNS if "FDR" not in c])
+    summary["ANOVA FDR"] = bh_adjust(summary["ANOVA p"].to_numpy())
+    summary["Kruskal FDR"] = bh_adjust(summary["Kruskal p"].to_numpy())
+    summary[["Grupos", "N"]] = summary[["Grupos", "N"]].astype(int)
+    posthoc = pd.concat(pairs, ignore_index=True) if pairs else pd.DataFrame(columns=POSTHOC_COLUMNS)
+    posthoc[["n A", "n B"]] = posthoc[["n A", "n B"]].astype(int)
+    return summary[SUMMARY_COLUMNS], posthoc[POSTHOC_COLUMNS]
@@ -0,0 +1,108 @@
+import io
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from modules.sparse import SparseCounts, smallest_int_dtype
+
+try:
+    import h5py
+    HAS_H5PY = True
+except ImportError:
+    HAS_H5PY = False
+
+# Niveles de la taxonomía de observación (BIOM guarda una lista por OTU)
+TAX_LEVELS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+
+def is_biom(filename):
+    return str(filename).lower().endswith(".biom")
+
+def _open(data):
+    """
+    Abre una tabla BIOM v2.1 (HDF5) desde sus bytes. h5py solo lee los
+    datasets que se piden, así que cada sección se carga por separado.
+    """
+    if not HAS_H5PY:
+        raise ValueError("Para leer archivos BIOM (HDF5) instala h5py.")
+    try:
+        return h5py.File(io.BytesIO(data), "r")
+    except OSError:
+        raise ValueError("El archivo .biom no es una tabla BIOM v2.1 (HDF5).")
+
+def _text(values):
+    values = np.asarray(values)
+    if values.dtype.kind in "SO":
+        return np.array([v.decode("utf-8") if isinstance(v, bytes) else str(v) for v in values.ravel()],
+                        dtype=object).reshape(values.shape)
+    return values
+
+def biom_info(data):
+    """
+    Resumen de una tabla BIOM sin leer la matriz: dimensiones, no ceros y
+    si trae taxonomía de observaciones y metadata de muestras.
+    """
+    with _open(data) as f:
+        n_features, n_samples = (int(x) for x in f.attrs["shape"])
+        return {
+            "n_features": n_features,
+            "n_samples": n_samples,
+            "nnz": int(f.attrs.get("nnz", f["sample/matrix/data"].shape[0])),
+            "taxonomy": "observation/metadata/taxonomy" in f,
+            "metadata": [str(k) for k in f["sample/metadata"].keys()] if "sample/metadata" in f else [],
+        }
+
+def biom_counts(data):
+    """
+    Conteos como SparseCounts (muestras x OTUs). La matriz CSC de BIOM por
+    muestra (sample/matrix) es exactamente la CSR en esta orientación, así que
+    se lee tal cual, sin pasar por una tabla densa. Los conteos enteros se
+    guardan con el entero sin signo mínimo.
+    """
+    with _open(data) as f:
+        samples = pd.Index(_text(f["sample/ids"][:]))
+        features = pd.Index(_text(f["observation/ids"][:]))
+        values = f["sample/matrix/data"][:]
+        indices = f["sample/matrix/indices"][:]
+        indptr = f["sample/matrix/indptr"][:]
+    if values.size and np.all(values >= 0) and np.all(values == np.rint(values)):
+        values = values.astype(smallest_int_dtype(values.max()))
+    matrix = sparse.csr_matrix((values, indices, indptr), shape=(len(samples), len(features)))
+    return SparseCounts(matrix, samples, features)
+
+def biom_taxonomy(data):
+    """
+    Taxonomía de observaciones (OTU x niveles) o None si el archivo no la trae.
+    Se quitan los prefijos de rango (k__, p__...) y los niveles vacíos quedan NaN.
+    """
+    with _open(data) as f:
+        if "observation/metadata/taxonomy" not in f:
+            return None
+        features = pd.Index(_text(f["observation/ids"][:]))
+        lineages = _text(f["observation/metadata/taxonomy"][:])
+    if lineages.ndim == 1:
+        lineages = np.array([str(x).split(";") for x in lineages], dtype=object)
+    n_levels = lineages.shape[1] if lineages.ndim == 2 else 0
+    columns = TAX_LEVELS[:n_levels] + [f"Level{i + 1}" for i in range(len(TAX_LEVELS), n_levels)]
+    df = pd.DataFrame(lineages, index=features, columns=columns)
+    df = df.apply(lambda col: col.astype(str).str.strip().str.replace(r"^[a-zA-Z]__", "", regex=True))
+    df = df.replace({"": np.nan, "None": np.nan, "nan": np.nan})
+    df.index.name = "OTU"
+    return df
+
+def biom_metadata(data):
+    """
+    Metadata de muestras (muestras x variables) o None si no hay. BIOM guarda
+    todo como texto: las variables que son números se convierten.
+    """
+    with _open(data) as f:
+        if "sample/metadata" not in f or not len(f["sample/metadata"]):
+            return None
+        samples = pd.Index(_text(f["sample/ids"][:]), name="SampleID")
+        fields = {str(k): _text(f["sample/metadata"][k][:]) for k in f["sample/metadata"].keys()}
+    df = pd.DataFrame(fields, index=samples)
+    for col in df.columns:
+        numeric = pd.to_numeric(df[col], errors="coerce")
+        if numeric.notna().all():
+            df[col] = numeric
+    return df
@@ -0,0 +1,240 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from modules.instrumentation import count, span
+
+def hash_bytes(data):
+    """
+    Huella de contenido (hex) de un bloque de bytes.
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def hash_key(*parts):
+    """
+    Huella estable de una clave compuesta (cadenas, números, tuplas de parámetros).
+    """
+    return hash_bytes(repr(parts).encode("utf-8"))
+
+def estimate_nbytes(obj):
+    """
+    Estima la memoria ocupada por un objeto para el presupuesto de la caché.
+    Soporta DataFrame/Series, arrays de numpy y matrices dispersas de scipy;
+    para otros objetos devuelve una estimación mínima.
+    """
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=True))
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if hasattr(obj, "indptr") and hasattr(obj, "data"):
+        return int(obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes)
+    if isinstance(obj, (tuple, list)):
+        return sum(estimate_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(o) for o in obj.values())
+    # SparseCounts expone nbytes; DistanceMatrix guarda la matriz en .data
+    if isinstance(getattr(obj, "nbytes", None), int):
+        return obj.nbytes
+    if isinstance(getattr(obj, "data", None), np.ndarray):
+        return int(obj.data.nbytes)
+    return 1024
+
+class LRUCache:
+    """
+    Caché en memoria con presupuesto de bytes y expulsión LRU.
+    Es segura entre hilos: Streamlit atiende cada sesión en un hilo distinto
+    y todas comparten las cachés a nivel de módulo.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, nbytes=None):
+        nbytes = estimate_nbytes(value) if nbytes is None else int(nbytes)
+        with self._lock:
+            if key in self._data:
+                self._total -= self._sizes.pop(key)
+                del self._data[key]
+            # Un objeto mayor que todo el presupuesto no se guarda
+            if nbytes > self.max_bytes:
+                return value
+            self._data[key] = value
+            self._sizes[key] = nbytes
+            self._total += nbytes
+            while self._total > self.max_bytes and self._data:
+                old_key, _ = self._data.popitem(last=False)
+                self._total -= self._sizes.pop(old_key)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._total = 0
+
+    @property
+    def total_bytes(self):
+        return self._total
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+CACHE_SUFFIXES = (".pkl", ".npy")
+# Versión del formato de los resultados en disco: subirla al cambiar lo que
+# devuelve un cálculo memorizado deja sin efecto los pickles anteriores
+CACHE_VERSION = 1
+
+class DiskCache:
+    """
+    Almacén de resultados en disco (un pickle por clave) con límite de tamaño.
+    Sobrevive a reinicios del servidor; al superar max_bytes se eliminan los
+    archivos usados hace más tiempo (la lectura actualiza su fecha). Los .npy
+    del mismo directorio (distancias con memory-map) cuentan en el límite.
+    Las claves incluyen CACHE_VERSION y un pickle ilegible es un fallo, nunca un error.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{hash_key(CACHE_VERSION, key)}.pkl")
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                value = pickle.load(fh)
+            os.utime(path)
+            return value
+        except FileNotFoundError:
+            return default
+        except Exception:
+            # Pickle truncado o de otra versión del código (clases movidas o
+            # renombradas): se descarta y cuenta como fallo de caché
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return default
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as fh:
+                pickle.dump(value, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return value
+        self._evict()
+        return value
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(CACHE_SUFFIXES):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+            total = sum(e[1] for e in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    total -= size
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            for name in os.listdir(self.directory):
+                if name.endswith(CACHE_SUFFIXES):
+                    os.remove(os.path.join(self.directory, name))
+
+# Resultados de análisis (distancias, ordenaciones...): en memoria y en disco.
+# Configurables con UYWA_RESULT_CACHE_MB, UYWA_CACHE_DIR y UYWA_DISK_CACHE_MB.
+RESULT_CACHE = LRUCache(max_bytes=int(os.environ.get("UYWA_RESULT_CACHE_MB", "1024")) * 1024 ** 2)
+DISK_CACHE_DIR = os.environ.get(
+    "UYWA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "uywa-microbiota")
+)
+_disk_cache = None
+
+def disk_cache():
+    global _disk_cache
+    if _disk_cache is None:
+        _disk_cache = DiskCache(DISK_CACHE_DIR, int(os.environ.get("UYWA_DISK_CACHE_MB", "2048")) * 1024 ** 2)
+    return _disk_cache
+
+def lookup(namespace, key, persist=True):
+    """
+    Resultado ya calculado para (namespace, key), en memoria o en disco, o
+    None si no está (nunca calcula).
+    """
+    full_key = (namespace,) + tuple(key)
+    value = RESULT_CACHE.get(full_key)
+    if value is None and persist:
+        value = disk_cache().get(full_key)
+        if value is not None:
+            RESULT_CACHE.put(full_key, value)
+    return value
+
+def memoize(namespace, key, compute, persist=True):
+    """
+    Devuelve el resultado de compute() para (namespace, key), buscándolo
+    primero en memoria y después en disco. Solo se calcula si no está en
+    ninguna de las dos; el resultado se guarda en ambas. Cada cálculo es un
+    tramo "calculo.<namespace>" de la instrumentación.
+    """
+    full_key = (namespace,) + tuple(key)
+    value = RESULT_CACHE.get(full_key)
+    if value is not None:
+        count(f"cache.{namespace}.memoria")
+        return value
+    if persist:
+        value = disk_cache().get(full_key)
+        if value is not None:
+            count(f"cache.{namespace}.disco")
+            return RESULT_CACHE.put(full_key, value)
+    count(f"cache.{namespace}.calculo")
+    with span(f"calculo.{namespace}"):
+        value = compute()
+    RESULT_CACHE.put(full_key, value)
+    if persist:
+        disk_cache().put(full_key, value)
+    return value
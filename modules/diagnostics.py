@@ -0,0 +1,72 @@
+import streamlit as st
+import pandas as pd
+from modules.cache import RESULT_CACHE
+from modules.jobs import JOBS
+from modules.instrumentation import ENABLED, counters, recent_spans, reset, span_summary
+from modules.utils import PARSE_CACHE
+
+def _cache_row(name, cache):
+    total = cache.hits + cache.misses
+    return {
+        "caché": name,
+        "aciertos": cache.hits,
+        "fallos": cache.misses,
+        "tasa": f"{cache.hits / total:.0%}" if total else "-",
+        "uso_mb": round(cache.total_bytes / 2 ** 20, 1),
+        "límite_mb": round(cache.max_bytes / 2 ** 20),
+    }
+
+def diagnostics_panel():
+    """
+    Panel de diagnóstico (solo administradores, en la barra lateral): tiempos
+    y memoria por etapa, contadores de caché y los últimos tramos medidos.
+    """
+    if not st.checkbox("Diagnóstico de rendimiento", key="show_diagnostics"):
+        return
+    if not ENABLED:
+        st.caption("Instrumentación desactivada (UYWA_INSTRUMENTATION=0).")
+        return
+    st.markdown("**Etapas (acumulado)**")
+    st.dataframe(span_summary().round(3), hide_index=True, use_container_width=True)
+
+    st.markdown("**Cachés**")
+    st.dataframe(
+        pd.DataFrame([_cache_row("Resultados", RESULT_CACHE), _cache_row("Parseo", PARSE_CACHE)]),
+        hide_index=True, use_container_width=True
+    )
+    hits = counters()
+    cache_hits = {name: n for name, n in hits.items() if name.startswith("cache.")}
+    if cache_hits:
+        # cache.<espacio>.<memoria|disco|almacen|calculo> -> tabla espacio x origen
+        rows = [dict(zip(("espacio", "origen"), name.split(".")[1:3]), veces=n) for name, n in cache_hits.items()]
+        table = pd.DataFrame(rows).pivot_table(index="espacio", columns="origen", values="veces", fill_value=0).astype(int)
+        st.dataframe(table, use_container_width=True)
+    others = {name: n for name, n in hits.items() if not name.startswith("cache.")}
+    if others:
+        st.markdown("**Otros contadores**")
+        st.dataframe(
+            pd.DataFrame(sorted(others.items()), columns=["contador", "veces"]), hide_index=True, use_container_width=True
+        )
+
+    jobs = JOBS.jobs()
+    if jobs:
+        st.markdown("**Trabajos en segundo plano**")
+        st.dataframe(
+            pd.DataFrame([
+                {"trabajo": j.label, "estado": j.status, "avance": f"{j.progress:.0%}", "segundos": round(j.elapsed, 1)}
+                for j in jobs[::-1]
+            ]),
+            hide_index=True, use_container_width=True
+        )
+
+    with st.expander("Últimos tramos"):
+        last = pd.DataFrame(recent_spans(50)[::-1])
+        if not last.empty:
+            last["span"] = ["  " * d + s for d, s in zip(last["depth"], last["span"])]
+            st.dataframe(
+                last[["span", "seconds", "rss_delta_mb", "peak_growth_mb"]],
+                hide_index=True, use_container_width=True
+            )
+    if st.button("Reiniciar métricas", key="reset_diagnostics"):
+        reset()
+        st.rerun()
@@ -0,0 +1,180 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import chi2, norm, rankdata, t as t_dist
+
+from modules.parallel import run_chunks
+from modules.sparse import as_sample_matrix
+
+# Columnas (OTUs) por bloque: acota la memoria a muestras x BLOCK_SIZE valores densos
+BLOCK_SIZE = 2000
+TESTS = {"welch": "Welch t", "wilcoxon": "Wilcoxon (Mann-Whitney)", "kruskal": "Kruskal-Wallis"}
+
+def bh_adjust(pvalues):
+    """
+    Corrección de Benjamini-Hochberg (FDR); los NaN se conservan.
+    """
+    p = np.asarray(pvalues, dtype=np.float64)
+    out = np.full(p.shape, np.nan)
+    ok = ~np.isnan(p)
+    m = ok.sum()
+    if m == 0:
+        return out
+    order = np.argsort(p[ok])
+    ranked = p[ok][order] * m / np.arange(1, m + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    adj = np.empty(m)
+    adj[order] = np.clip(ranked, 0, 1)
+    out[ok] = adj
+    return out
+
+def clr_offsets(matrix, pseudocount=0.5):
+    """
+    Media por muestra de log(x + pseudocount) sobre TODOS los OTUs, necesaria
+    para la CLR. Con matrices dispersas los ceros se suman de una vez.
+    """
+    n_features = matrix.shape[1]
+    if sparse.issparse(matrix):
+        m = sparse.csr_matrix(matrix)
+        logs = sparse.csr_matrix((np.log(m.data + pseudocount), m.indices, m.indptr), shape=m.shape)
+        nnz = np.diff(m.indptr)
+        total = np.asarray(logs.sum(axis=1)).ravel() + (n_features - nnz) * np.log(pseudocount)
+        return total / n_features
+    return np.log(np.asarray(matrix, dtype=np.float64) + pseudocount).mean(axis=1)
+
+def _column_block(matrix, start, stop):
+    block = matrix[:, start:stop]
+    if sparse.issparse(block):
+        block = block.toarray()
+    return np.asarray(block, dtype=np.float64)
+
+def _tie_sums(sorted_block):
+    """
+    sum(t³ - t) por columna, siendo t el tamaño de cada grupo de empates.
+    Las columnas se recorren aplanadas: cada una aporta un marcador de inicio
+    y otro de fin, y el tramo entre columnas mide 1 (no suma nada).
+    """
+    n, f = sorted_block.shape
+    change = np.ones((f, n + 1), dtype=bool)
+    change[:, 1:n] = sorted_block.T[:, 1:] != sorted_block.T[:, :-1]
+    pos = np.flatnonzero(change.ravel())
+    runs = np.diff(pos).astype(np.float64)
+    return np.bincount(pos[:-1] // (n + 1), weights=runs ** 3 - runs, minlength=f)
+
+def _welch(a, b):
+    na, nb = a.shape[0], b.shape[0]
+    va, vb = a.var(axis=0, ddof=1) / na, b.var(axis=0, ddof=1) / nb
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stat = (a.mean(axis=0) - b.mean(axis=0)) / np.sqrt(va + vb)
+        df = (va + vb) ** 2 / (va ** 2 / (na - 1) + vb ** 2 / (nb - 1))
+    return stat, 2 * t_dist.sf(np.abs(stat), df)
+
+def _mannwhitney(a, b):
+    na, nb = a.shape[0], b.shape[0]
+    n = na + nb
+    both = np.vstack([a, b])
+    ranks = rankdata(both, axis=0)
+    u = ranks[:na].sum(axis=0) - na * (na + 1) / 2
+    ties = _tie_sums(np.sort(both, axis=0))
+    sigma = np.sqrt(na * nb / 12 * ((n + 1) - ties / (n * (n - 1))))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (np.abs(u - na * nb / 2) - 0.5) / sigma
+    return u, 2 * norm.sf(np.clip(z, 0, None))
+
+def _kruskal(values, codes):
+    n = values.shape[0]
+    k = codes.max() + 1
+    ranks = rankdata(values, axis=0)
+    sizes = np.bincount(codes, minlength=k).astype(np.float64)
+    # Suma de rangos por grupo para todas las columnas con un único producto
+    indicator = np.zeros((k, n))
+    indicator[codes, np.arange(n)] = 1.0
+    rank_sums = indicator @ ranks
+    h = 12.0 / (n * (n + 1)) * (rank_sums ** 2 / sizes[:, None]).sum(axis=0) - 3 * (n + 1)
+    ties = _tie_sums(np.sort(values, axis=0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        h = h / (1 - ties / (n ** 3 - n))
+    return h, chi2.sf(h, k - 1)
+
+def _test_block(matrix, offsets, lib_sizes, codes, a_mask, b_mask, test, pseudocount, start, stop):
+    counts = _column_block(matrix, start, stop)
+    clr = np.log(counts + pseudocount) - offsets[:, None]
+    # Abundancia relativa respecto al total de lecturas de la muestra (no del bloque)
+    rel = counts / np.clip(lib_sizes, 1, None)[:, None]
+    mean_a, mean_b = clr[a_mask].mean(axis=0), clr[b_mask].mean(axis=0)
+    if test == "welch":
+        stat, p = _welch(clr[a_mask], clr[b_mask])
+    elif test == "wilcoxon":
+        stat, p = _mannwhitney(clr[a_mask], clr[b_mask])
+    elif test == "kruskal":
+        keep = codes >= 0
+        stat, p = _kruskal(clr[keep], codes[keep])
+    else:
+        raise ValueError(f"Prueba no soportada: {test}")
+    return np.column_stack([
+        (mean_a - mean_b) / np.log(2),
+        np.log2((rel[a_mask].mean(axis=0) + 1e-9) / (rel[b_mask].mean(axis=0) + 1e-9)),
+        mean_a, mean_b, stat, p,
+        (counts > 0).mean(axis=0),
+    ])
+
+_WORKER_STATE = None
+
+def _init_worker(state):
+    # La matriz y las etiquetas se envían una vez por proceso
+    global _WORKER_STATE
+    _WORKER_STATE = state
+
+def _test_block_worker(start, stop):
+    return _test_block(*_WORKER_STATE, start, stop)
+
+def differential_abundance(otus, groups, contrast, test="welch", pseudocount=0.5,
+                           block_size=BLOCK_SIZE, n_jobs=1, progress=None):
+    """
+    Abundancia diferencial por OTU/ASV, en bloques vectorizados de columnas.
+    - otus: conteos (DataFrame OTU x muestras o SparseCounts)
+    - groups: etiqueta de grupo por muestra (Serie indexada por muestra)
+    - contrast: (grupo_a, grupo_b); Welch y Wilcoxon comparan esos dos
+      grupos, Kruskal-Wallis usa todos los grupos de la variable
+    - test: "welch", "wilcoxon" o "kruskal" (todas sobre valores CLR)
+    - n_jobs: procesos para repartir los bloques (1 = en serie, None = todos los núcleos)
+    - progress(fracción) informa del avance por bloques
+    Devuelve un DataFrame por OTU con log2FC (CLR), log2FC de abundancias
+    relativas, medias CLR, estadístico, p-valor, p-valor ajustado (BH) y prevalencia.
+    """
+    matrix, samples, features = as_sample_matrix(otus)
+    if sparse.issparse(matrix):
+        matrix = sparse.csc_matrix(matrix)
+    labels = pd.Series(groups).reindex(samples).astype(object)
+    labels = labels.where(labels.notna(), None)
+    a_mask = (labels == contrast[0]).to_numpy()
+    b_mask = (labels == contrast[1]).to_numpy()
+    if a_mask.sum() < 2 or b_mask.sum() < 2:
+        raise ValueError("Cada grupo del contraste necesita al menos dos muestras.")
+    codes, _ = pd.factorize(labels)
+    offsets = clr_offsets(matrix, pseudocount)
+    lib_sizes = np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel()
+    state = (matrix, offsets, lib_sizes, codes, a_mask, b_mask, test, pseudocount)
+    bounds = [(s, min(s + block_size, len(features))) for s in range(0, len(features), block_size)]
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs > 1 and len(bounds) > 1:
+        blocks = run_chunks(_test_block_worker, bounds, min(n_jobs, len(bounds)), _init_worker, (state,), progress=progress)
+    else:
+        blocks = []
+        for s, e in bounds:
+            blocks.append(_test_block(*state, s, e))
+            if progress:
+                progress(len(blocks) / len(bounds))
+
+    res = pd.DataFrame(
+        np.vstack(blocks) if blocks else np.empty((0, 7)),
+        index=features,
+        columns=["log2FC", "log2FC_rel", "CLR_a", "CLR_b", "estadistico", "pvalue", "prevalencia"],
+    )
+    res["padj"] = bh_adjust(res["pvalue"].to_numpy())
+    res.index.name = "ASV"
+    return res
@@ -0,0 +1,321 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.metrics.pairwise import manhattan_distances
+
+from modules.alignment import normalize_ids
+from modules.parallel import run_chunks
+from modules.sparse import as_sample_matrix
+
+# Métricas beta disponibles (clave -> etiqueta). Las UniFrac necesitan un árbol Newick.
+BETA_METRICS = {
+    "braycurtis": "Bray-Curtis",
+    "jaccard": "Jaccard",
+    "aitchison": "Aitchison (rCLR)",
+    "weighted_unifrac": "UniFrac ponderado",
+    "unweighted_unifrac": "UniFrac no ponderado",
+}
+TREE_METRICS = ("weighted_unifrac", "unweighted_unifrac")
+# Filas (muestras) por bloque: la memoria temporal es BLOCK_SAMPLES x n valores
+BLOCK_SAMPLES = 256
+# Por debajo de estas muestras no compensa abrir un pool de procesos
+PARALLEL_MIN_SAMPLES = 2000
+
+class CondensedDistances:
+    """
+    Distancias entre muestras en forma condensada (triángulo superior, float32):
+    n(n-1)/2 valores en lugar de la matriz n x n en float64, 1/8 de la memoria.
+    condensed puede ser un array en memoria o un archivo .npy abierto con
+    memory-map (path); en ese caso al serializarse solo se guarda la ruta.
+    ordinate() y permanova() aceptan este objeto directamente.
+    """
+
+    def __init__(self, condensed, ids, metric, path=None):
+        self.condensed = condensed
+        self.ids = list(ids)
+        self.metric = metric
+        self.path = path
+        self.attrs = {}
+
+    @property
+    def shape(self):
+        return (len(self.ids), len(self.ids))
+
+    @property
+    def nbytes(self):
+        # Con memory-map los datos viven en disco, no en la caché de memoria
+        return 1024 if self.path else int(self.condensed.nbytes)
+
+    def to_square(self):
+        """
+        Matriz cuadrada float64 (8·n² bytes: unos 3 GB con 20.000 muestras),
+        para los métodos que la necesitan (PCoA, NMDS). Se rellena fila a
+        fila desde el vector condensado, sin arrays de índices de n² valores.
+        """
+        n = len(self.ids)
+        square = np.zeros((n, n))
+        for i in range(n - 1):
+            row = self.condensed[_row_offset(i, n):_row_offset(i + 1, n)]
+            square[i, i + 1:] = row
+            square[i + 1:, i] = row
+        return square
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.path:
+            state["condensed"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path:
+            # FileNotFoundError (OSError) si el archivo se expulsó: la caché lo trata como fallo
+            self.condensed = np.load(self.path, mmap_mode="r")
+
+    def __repr__(self):
+        return f"CondensedDistances({self.metric!r}, n={len(self.ids)})"
+
+def condensed_size(n):
+    return n * (n - 1) // 2
+
+def _row_offset(i, n):
+    # Posición en el vector condensado del par (i, i + 1)
+    return n * i - i * (i + 1) // 2
+
+def load_tree(data):
+    """
+    Árbol Newick (bytes o texto) como TreeNode de scikit-bio. Los guiones
+    bajos de los nombres se conservan: son habituales en IDs de ASV.
+    """
+    from skbio import TreeNode
+    text = data.decode("utf-8") if isinstance(data, bytes) else data
+    try:
+        return TreeNode.read(io.StringIO(text), format="newick", convert_underscores=False)
+    except Exception as e:
+        raise ValueError(f"No se pudo leer el árbol Newick: {e}")
+
+def _branch_matrix(tree, features):
+    """
+    Matriz dispersa OTUs x ramas: 1 si la rama está en el camino de la hoja
+    del OTU a la raíz (incluida la de la raíz, como scikit-bio), y la longitud de cada rama. Con ella las UniFrac se
+    reducen a métricas ponderadas sobre las abundancias por rama.
+    Devuelve (matriz, longitudes, posiciones de los OTUs presentes en el árbol).
+    """
+    nodes = list(tree.postorder(include_self=True))
+    node_pos = {id(node): i for i, node in enumerate(nodes)}
+    lengths = np.array([node.length or 0.0 for node in nodes], dtype=np.float64)
+    tips = {}
+    for tip in tree.tips():
+        if tip.name is not None:
+            tips[normalize_ids([tip.name], upper=True)[0]] = tip
+    rows, cols, kept = [], [], []
+    for f, feature in enumerate(features):
+        node = tips.get(feature)
+        if node is None:
+            continue
+        r = len(kept)
+        kept.append(f)
+        while node is not None:
+            rows.append(r)
+            cols.append(node_pos[id(node)])
+            node = node.parent
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(len(kept), len(nodes))
+    )
+    return matrix, lengths, np.asarray(kept, dtype=np.int64)
+
+def _prepare(otus, metric, tree=None):
+    """
+    Matriz muestras x columnas sobre la que se calcula cada métrica y el
+    núcleo que le corresponde:
+    - "l1": Manhattan (normalizada por totales en Bray-Curtis)
+    - "overlap": 1 - intersección/unión ponderada (Jaccard, UniFrac no ponderado)
+    - "euclidean": euclídea (Aitchison sobre rCLR)
+    """
+    if metric not in BETA_METRICS:
+        raise ValueError(f"Métrica beta no soportada: {metric}")
+    matrix, samples, features = as_sample_matrix(otus)
+    # Copia propia: las tablas del almacén están abiertas con memory-map de solo lectura
+    X = sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+    X.data = np.clip(X.data, 0, None)
+    X.eliminate_zeros()
+    info = {}
+
+    if metric in TREE_METRICS:
+        if tree is None:
+            raise ValueError("Las métricas UniFrac necesitan un árbol filogenético (Newick).")
+        branches, lengths, kept = _branch_matrix(tree, normalize_ids(features, upper=True))
+        if len(kept) == 0:
+            raise ValueError("Ningún OTU/ASV de la tabla aparece en las hojas del árbol.")
+        info["features_outside_tree"] = len(features) - len(kept)
+        X = X[:, kept]
+        if metric == "weighted_unifrac":
+            # Proporciones por muestra acumuladas en cada rama, multiplicadas por su longitud
+            totals = np.asarray(X.sum(axis=1)).ravel()
+            scale = sparse.diags(np.divide(1.0, totals, out=np.zeros_like(totals), where=totals > 0))
+            X = sparse.csr_matrix(scale @ X @ branches @ sparse.diags(lengths))
+            return X, samples, "l1", None, info
+        X = sparse.csr_matrix((X @ branches) > 0, dtype=np.float64)
+        return X, samples, "overlap", lengths, info
+
+    if metric == "braycurtis":
+        return X, samples, "braycurtis", None, info
+    if metric == "jaccard":
+        X.data[:] = 1.0
+        return X, samples, "overlap", np.ones(X.shape[1]), info
+    # Aitchison robusto: CLR solo sobre los valores no nulos de cada muestra
+    logs = np.log(X.data)
+    counts = np.diff(X.indptr)
+    sums = np.bincount(np.repeat(np.arange(len(counts)), counts), weights=logs, minlength=len(counts))
+    means = np.divide(sums, counts, out=np.zeros(len(counts)), where=counts > 0)
+    X.data = logs - np.repeat(means, counts)
+    return X, samples, "euclidean", None, info
+
+def _sample_terms(X, kind, weights):
+    # Términos por muestra que necesita el núcleo (totales, tamaños, normas)
+    if kind == "braycurtis":
+        return np.asarray(X.sum(axis=1)).ravel()
+    if kind == "overlap":
+        return X @ weights
+    if kind == "euclidean":
+        return np.asarray(X.multiply(X).sum(axis=1)).ravel()
+    return None
+
+def _kernel(X, kind, weights, terms, rows, cols):
+    """
+    Bloque denso de distancias entre las filas rows y las filas cols de X
+    (slices o arrays de posiciones).
+    """
+    R, C = X[rows], X[cols]
+    t_rows = terms[rows] if terms is not None else None
+    t_cols = terms[cols] if terms is not None else None
+    if kind in ("l1", "braycurtis"):
+        block = manhattan_distances(R, C)
+        if kind == "braycurtis":
+            with np.errstate(divide="ignore", invalid="ignore"):
+                block /= t_rows[:, None] + t_cols[None, :]
+    elif kind == "overlap":
+        inter = (R @ sparse.diags(weights) @ C.T).toarray()
+        union = t_rows[:, None] + t_cols[None, :] - inter
+        with np.errstate(divide="ignore", invalid="ignore"):
+            block = 1.0 - inter / union
+    else:
+        block = t_rows[:, None] + t_cols[None, :] - 2.0 * (R @ C.T).toarray()
+        block = np.sqrt(np.clip(block, 0, None))
+    return np.nan_to_num(block, nan=0.0)
+
+def _block_distances(X, kind, weights, terms, start, stop):
+    """
+    Distancias de las filas [start, stop) contra las filas [start, n), en
+    forma condensada (solo los pares i < j) y en float32.
+    """
+    block = _kernel(X, kind, weights, terms, slice(start, stop), slice(start, None))
+    # Fila r del bloque: pares (start + r, j) con j > start + r
+    return np.concatenate([block[r, r + 1:] for r in range(stop - start)]).astype(np.float32)
+
+_WORKER_STATE = None
+
+def _init_worker(state):
+    # La matriz preparada se envía una vez por proceso
+    global _WORKER_STATE
+    _WORKER_STATE = state
+
+def _block_worker(start, stop):
+    return _block_distances(*_WORKER_STATE, start, stop)
+
+def pairwise_distances(otus, metric="braycurtis", tree=None, block_size=BLOCK_SAMPLES, n_jobs=1,
+                       out=None, progress=None):
+    """
+    Distancias beta entre todas las muestras por bloques de filas, sin
+    materializar nunca la matriz n x n.
+    - otus: conteos (DataFrame OTU x muestras o SparseCounts)
+    - metric: clave de BETA_METRICS; las UniFrac necesitan tree (TreeNode)
+    - block_size: muestras por bloque (la memoria temporal es block_size x n)
+    - n_jobs: procesos para repartir los bloques (1 = en serie, None = todos los núcleos)
+    - out: ruta de un .npy donde escribir el resultado con memory-map (None = en memoria)
+    - progress(fracción) informa del avance por bloques
+    Devuelve CondensedDistances (float32).
+    """
+    X, samples, kind, weights, info = _prepare(otus, metric, tree)
+    terms = _sample_terms(X, kind, weights)
+    n = X.shape[0]
+    condensed = _allocate(n, out)
+
+    bounds = [(s, min(s + block_size, n)) for s in range(0, n, block_size)]
+    state = (X, kind, weights, terms)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    def store(i, values):
+        start, stop = bounds[i]
+        condensed[_row_offset(start, n):_row_offset(stop, n)] = values
+
+    if n_jobs > 1 and len(bounds) > 1 and n >= PARALLEL_MIN_SAMPLES:
+        run_chunks(_block_worker, bounds, min(n_jobs, len(bounds)), _init_worker, (state,), on_result=store, progress=progress)
+    else:
+        for i, (start, stop) in enumerate(bounds):
+            store(i, _block_distances(*state, start, stop))
+            if progress:
+                progress((i + 1) / len(bounds))
+
+    return _finish(condensed, samples, metric, out, info)
+
+def _allocate(n, out=None):
+    if out is None:
+        return np.empty(condensed_size(n), dtype=np.float32)
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    return np.lib.format.open_memmap(out, mode="w+", dtype=np.float32, shape=(condensed_size(n),))
+
+def _finish(condensed, samples, metric, out, info):
+    if out is not None:
+        condensed.flush()
+        del condensed
+        condensed = np.load(out, mmap_mode="r")
+    result = CondensedDistances(condensed, samples, metric, path=out)
+    result.attrs.update(info)
+    return result
+
+def pair_index(i, j, n):
+    # Posiciones en el vector condensado de los pares (i, j), i != j (vectorizado)
+    lo, hi = np.minimum(i, j), np.maximum(i, j)
+    return n * lo - lo * (lo + 1) // 2 + (hi - lo - 1)
+
+def extend_distances(base, otus, metric="braycurtis", tree=None, block_size=BLOCK_SAMPLES, out=None,
+                     progress=None):
+    """
+    Distancias de una tabla que amplía otra ya analizada: base son las
+    distancias (CondensedDistances) de un subconjunto de sus muestras con
+    conteos idénticos. Los pares antiguos se copian de base y solo se
+    calculan las filas de las muestras nuevas: O(nuevas x n) en lugar de O(n²).
+    Todas las métricas de BETA_METRICS dependen solo del par de muestras,
+    así que el resultado es el mismo que con pairwise_distances.
+    """
+    X, samples, kind, weights, info = _prepare(otus, metric, tree)
+    terms = _sample_terms(X, kind, weights)
+    n = X.shape[0]
+    pos = pd.Index(samples).get_indexer(base.ids)
+    if (pos < 0).any():
+        raise ValueError("Las distancias de base tienen muestras que no están en la tabla.")
+    condensed = _allocate(n, out)
+
+    old = np.asarray(base.condensed)
+    m = len(pos)
+    for a in range(m - 1):
+        condensed[pair_index(pos[a], pos[a + 1:], n)] = old[_row_offset(a, m):_row_offset(a + 1, m)]
+
+    new = np.flatnonzero(~np.isin(np.arange(n), pos))
+    everything = np.arange(n)
+    for k, start in enumerate(range(0, len(new), block_size)):
+        rows = new[start:start + block_size]
+        block = _kernel(X, kind, weights, terms, rows, slice(None)).astype(np.float32)
+        for r, q in enumerate(rows):
+            others = everything != q
+            condensed[pair_index(q, everything[others], n)] = block[r, others]
+        if progress:
+            progress(min(1.0, (start + len(rows)) / len(new)))
+
+    info["incremental"] = {"base_samples": m, "new_samples": len(new)}
+    return _finish(condensed, samples, metric, out, info)
@@ -1,53 +1,24 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-import plotly.graph_objects as go
-from skbio.diversity import alpha_diversity, beta_diversity
-from skbio.stats.distance import permanova, DistanceMatrix
-from scipy.stats import kruskal, f_oneway
-from sklearn.manifold import MDS
-from modules.utils import load_table
-import numpy as np
+from modules.alignment import categorical_vars, load_dataset
+from modules.utils import session_load_options
+from modules.prefilter import prefilter_summary
+from modules.rarefaction import rarefy_summary
+from modules.instrumentation import span
+from modules.alpha import ALPHA_METRICS
+from modules.distances import BETA_METRICS, TREE_METRICS
+from modules.visualization import WEBGL_MIN_POINTS, grouped_lines_figure, ordination_figure
+from modules.jobs import background_result
+from modules.pipeline import (
+    alpha_table, alpha_tests, metric_key, ordination_coords, ordination_result, permanova_result, rarefaction_table, subset_key
+)
 
-def rarefaction_curve(sample, steps=10):
-    nseqs = int(sample.sum())
-    depths = np.linspace(10, nseqs, steps, dtype=int)
-    values = []
-    population = []
-    for otu, count in sample.items():
-        if count > 0:
-            population.extend([otu] * int(count))
-    population = np.array(population)
-    for d in depths:
-        if d > len(population) or d == 0:
-            values.append(np.nan)
-            continue
-        outs = []
-        for _ in range(10):
-            subsample = np.random.choice(population, d, replace=False)
-            outs.append(len(np.unique(subsample)))
-        values.append(np.mean(outs))
-    return depths, values
+# Más puntos que esto en una ordenación se ofrecen submuestreados
+MAX_ORDINATION_POINTS = 5000
 
-def get_ellipse(x, y, n_std=2.0, num_points=100):
-    if len(x) < 3:
-        return None, None
-    cov = np.cov(x, y)
-    vals, vecs = np.linalg.eigh(cov)
-    order = vals.argsort()[::-1]
-    vals = vals[order]
-    vecs = vecs[:, order]
-    theta = np.degrees(np.arctan2(*vecs[:,0][::-1]))
-    width, height = 2 * n_std * np.sqrt(vals)
-    t = np.linspace(0, 2 * np.pi, num_points)
-    ellipse = np.array([width/2 * np.cos(t), height/2 * np.sin(t)])
-    R = np.array([[np.cos(np.radians(theta)), -np.sin(np.radians(theta))],
-                  [np.sin(np.radians(theta)),  np.cos(np.radians(theta))]])
-    ellipse_rot = R @ ellipse
-    x0, y0 = np.mean(x), np.mean(y)
-    return ellipse_rot[0] + x0, ellipse_rot[1] + y0
-
-def plot_alpha_index_tabbed(alpha_df, cat_vars, alpha_metrics):
+def plot_alpha_index_tabbed(alpha_df, cat_vars, alpha_metrics, tests):
+    summary, posthoc = tests
     color_var = st.selectbox("Variable de agrupación", cat_vars, index=0 if cat_vars else None, key="alpha_color")
     use_interaction = st.checkbox("¿Mostrar interacción entre dos variables? (alfa diversidad)", value=False)
     symbol_var = None
@@ -61,7 +32,8 @@ def plot_alpha_index_tabbed(alpha_df, cat_vars, alpha_metrics):
         with tabs[i]:
             st.markdown(f"**{metric}**")
             fig = px.box(
-                alpha_df, x=color_var, y=metric, color=color_var, points="all",
+                alpha_df, x=color_var, y=metric, color=color_var,
+                points="all" if len(alpha_df) < WEBGL_MIN_POINTS else "outliers",
                 title=f"{metric} por grupo"
             )
             st.plotly_chart(fig, use_container_width=True)
@@ -71,182 +43,176 @@ def plot_alpha_index_tabbed(alpha_df, cat_vars, alpha_metrics):
                     title=f"{metric}: interacción {color_var} y {symbol_var}"
                 )
                 st.plotly_chart(fig_scatter, use_container_width=True)
-            groups = [alpha_df[alpha_df[color_var] == g][metric].dropna() for g in alpha_df[color_var].unique()]
-            if all(len(g) > 1 for g in groups) and len(groups) > 1:
-                try:
-                    fval, pval = f_oneway(*groups)
-                    st.caption(f"ANOVA: p = {pval:.3g}")
-                except Exception:
-                    kw = kruskal(*groups)
-                    st.caption(f"Kruskal-Wallis: p = {kw.pvalue:.3g}")
-            else:
+            # Resultados precalculados para todas las métricas y variables: solo se consultan
+            row = summary[(summary["Métrica"] == metric) & (summary["Variable"] == color_var)]
+            if row.empty or pd.isna(row["ANOVA p"].iloc[0]):
                 st.caption("No hay replicación suficiente para ANOVA/Kruskal-Wallis.")
+            else:
+                row = row.iloc[0]
+                st.caption(
+                    f"ANOVA: p = {row['ANOVA p']:.3g} (FDR {row['ANOVA FDR']:.3g}) · "
+                    f"Kruskal-Wallis: p = {row['Kruskal p']:.3g} (FDR {row['Kruskal FDR']:.3g})"
+                )
+                pairs = posthoc[(posthoc["Métrica"] == metric) & (posthoc["Variable"] == color_var)]
+                if len(pairs) > 1:
+                    with st.expander("Comparaciones por pares (Welch t y Dunn, FDR por métrica y variable)"):
+                        st.dataframe(pairs.drop(columns=["Métrica", "Variable"]).round(4), hide_index=True,
+                                     use_container_width=True)
+
+    with st.expander("Resumen de pruebas: todas las métricas x variables"):
+        st.caption("FDR (Benjamini-Hochberg) sobre todas las combinaciones; ordena pulsando en las columnas.")
+        st.dataframe(summary.round(4), hide_index=True, use_container_width=True)
 
-def plot_beta_diversity(coords, metadata, dist, cat_vars_beta):
-    color_var_beta = st.selectbox("Variable para color NMDS", cat_vars_beta, index=0, key="beta_color")
+def plot_beta_diversity(coords, ds, cat_vars_beta, metric="braycurtis", tree_file=None):
+    color_var_beta = st.selectbox("Variable para color (ordenación)", cat_vars_beta, index=0, key="beta_color")
     use_interaction_beta = st.checkbox("¿Mostrar interacción entre dos variables? (beta diversidad)", value=False)
     symbol_var_beta = None
     if use_interaction_beta:
-        symbol_var_beta = st.selectbox("Variable para símbolo NMDS", cat_vars_beta, index=1 if len(cat_vars_beta) > 1 else 0, key="beta_symbol")
+        symbol_var_beta = st.selectbox("Variable para símbolo (ordenación)", cat_vars_beta, index=1 if len(cat_vars_beta) > 1 else 0, key="beta_symbol")
         if symbol_var_beta == color_var_beta:
             st.info("Selecciona dos variables diferentes para la interacción.")
     else:
         symbol_var_beta = color_var_beta
 
-    # --- Gráfico de NMDS + elipses ---
-    fig = go.Figure()
-    palette = px.colors.qualitative.Dark24
-    color_map = {g: palette[i % len(palette)] for i, g in enumerate(coords[color_var_beta].unique())}
-    symbol_types = ['circle', 'triangle-up', 'square', 'star', 'diamond', 'cross', 'x', 'triangle-down']
-
-    if use_interaction_beta and symbol_var_beta and symbol_var_beta != color_var_beta:
-        symbol_vals = {}
-        for i, val in enumerate(coords[symbol_var_beta].unique()):
-            symbol_vals[val] = symbol_types[i % len(symbol_types)]
-        for i, (group, group_df) in enumerate(coords.groupby(color_var_beta)):
-            fig.add_trace(go.Scatter(
-                x=group_df["NMDS1"], y=group_df["NMDS2"],
-                mode="markers",
-                name=str(group),
-                marker=dict(
-                    color=color_map[group],
-                    symbol=[symbol_vals[v] for v in group_df[symbol_var_beta]],
-                    size=14,
-                    line=dict(width=1, color="black")
-                ),
-                customdata=group_df.index,
-                hovertemplate="Sample: %{customdata}<br>NMDS1: %{x:.2f}<br>NMDS2: %{y:.2f}<br>" + color_var_beta + ": " + str(group)
-            ))
-            ex, ey = get_ellipse(group_df["NMDS1"].values, group_df["NMDS2"].values)
-            if ex is not None:
-                fig.add_trace(go.Scatter(
-                    x=ex, y=ey,
-                    mode="lines",
-                    line=dict(color=color_map[group], width=2),
-                    name=f"{group} ellipse",
-                    showlegend=False,
-                    hoverinfo="skip"
-                ))
-    else:
-        for i, (group, group_df) in enumerate(coords.groupby(color_var_beta)):
-            fig.add_trace(go.Scatter(
-                x=group_df["NMDS1"], y=group_df["NMDS2"],
-                mode="markers",
-                name=str(group),
-                marker=dict(
-                    color=color_map[group],
-                    size=14,
-                    line=dict(width=1, color="black")
-                ),
-                customdata=group_df.index,
-                hovertemplate="Sample: %{customdata}<br>NMDS1: %{x:.2f}<br>NMDS2: %{y:.2f}<br>" + color_var_beta + ": " + str(group)
-            ))
-            ex, ey = get_ellipse(group_df["NMDS1"].values, group_df["NMDS2"].values)
-            if ex is not None:
-                fig.add_trace(go.Scatter(
-                    x=ex, y=ey,
-                    mode="lines",
-                    line=dict(color=color_map[group], width=2),
-                    name=f"{group} ellipse",
-                    showlegend=False,
-                    hoverinfo="skip"
-                ))
-    fig.update_layout(
-        xaxis_title="NMDS1",
-        yaxis_title="NMDS2",
-        legend_title=color_var_beta,
-        title="NMDS Bray-Curtis con elipses de grupo",
-        width=800,
-        height=600
+    # --- Gráfico de ordenación (NMDS o PCoA) + elipses ---
+    ax1 = coords.columns[0]
+    method_label = ax1.rstrip("0123456789")
+    max_points = None
+    if len(coords) > MAX_ORDINATION_POINTS:
+        if st.checkbox(
+            f"Submuestrear a {MAX_ORDINATION_POINTS} puntos (más rápido en el navegador)",
+            value=True, key="beta_downsample"
+        ):
+            max_points = MAX_ORDINATION_POINTS
+    fig, n_shown = ordination_figure(
+        coords, color_var_beta, symbol_var_beta if use_interaction_beta else None,
+        title=f"{method_label} {BETA_METRICS[metric]} con elipses de grupo", max_points=max_points,
     )
+    if n_shown < len(coords):
+        st.caption(f"Se muestran {n_shown} de {len(coords)} muestras (submuestreo estratificado); las elipses usan todas.")
     st.plotly_chart(fig, use_container_width=True)
 
     # --- PERMANOVA: solo mostrar tabla de resultados y p-value ---
-    if color_var_beta and color_var_beta in metadata.columns:
-        grouping = metadata.loc[coords.index, color_var_beta].astype(str)
-        if grouping.nunique() < 2:
+    if color_var_beta and color_var_beta in ds.metadata.columns:
+        if ds.metadata.loc[coords.index, color_var_beta].astype(str).nunique() < 2:
             st.warning("PERMANOVA requiere al menos dos grupos diferentes en la variable de agrupación seleccionada.")
         else:
+            permutations = st.selectbox(
+                "Permutaciones PERMANOVA", [999, 9999, 99999], index=0, key="permanova_perms",
+                help="9.999 o más para p-valores de publicación; se reparten entre los núcleos disponibles."
+            )
             try:
-                dm = DistanceMatrix(dist.data.copy(order="C"), ids=dist.ids)
-                permanova_res = permanova(dm, grouping=grouping, permutations=999)
+                # Resultado memorizado por distancias + variable de agrupación + permutaciones;
+                # se calcula en segundo plano (None mientras sigue en curso)
+                permanova_res = background_result(
+                    ("permanova", ds.counts_key, subset_key(ds), metric_key(metric, tree_file),
+                     color_var_beta, permutations),
+                    "PERMANOVA",
+                    lambda job: permanova_result(
+                        ds, color_var_beta, permutations, progress=job.report, metric=metric, tree_file=tree_file
+                    ),
+                )
+                if permanova_res is None:
+                    return
                 st.subheader("PERMANOVA")
                 # Mostrar la tabla de resultados de PERMANOVA
-                if hasattr(permanova_res, "to_dataframe"):
-                    permanova_df = permanova_res.to_dataframe()
-                    st.dataframe(permanova_df, use_container_width=True)
-                    # Resaltar p-valor si existe
-                    if "p-value" in permanova_df.columns:
-                        pval = permanova_df.iloc[0]["p-value"]
-                        st.markdown(f"**p-value:** `{pval:.4g}`")
-                else:
-                    st.write(permanova_res)
+                permanova_df = permanova_res.to_frame().T
+                st.dataframe(permanova_df, use_container_width=True)
+                pval = permanova_res["p-value"]
+                st.markdown(f"**p-value:** `{pval:.4g}`")
             except Exception as e:
                 st.error(f"No se pudo calcular PERMANOVA: {e}")
 
+@st.fragment
 def diversity_tab(otus_file, taxonomy_file, metadata_file):
     st.header("Análisis de Diversidad Alfa y Beta")
     if not otus_file or not metadata_file:
         st.warning("Por favor, sube la tabla de OTUs/ASVs y la metadata en la pestaña de carga.")
         return
 
-    otus = load_table(otus_file, index_col="OTU")
-    metadata = load_table(metadata_file, index_col="SampleID")
-    if otus is None or metadata is None:
+    try:
+        ds = load_dataset(otus_file, taxonomy_file, metadata_file, **session_load_options())
+    except ValueError as e:
+        st.error(str(e))
+        return
+    if ds is None or ds.metadata is None:
         st.error("No se pudo cargar los archivos correctamente.")
         return
 
-    common_samples = [s for s in otus.columns if s in metadata.index]
+    common_samples = list(ds.common_samples)
     if not common_samples:
         st.error("No hay coincidencias entre los nombres de muestra en la tabla OTU y la metadata.")
         return
-    otus = otus[common_samples]
-    metadata = metadata.loc[common_samples]
+    metadata = ds.metadata
+    if ds.prefilter is not None:
+        st.caption(prefilter_summary(ds.prefilter) + " · Chao1 y ACE dependen de los singletons: interprétalos con cautela.")
+    if ds.rarefaction is not None:
+        st.caption(rarefy_summary(ds.rarefaction))
 
     # =================== DIVERSIDAD ALFA ===================
     st.subheader("Diversidad Alfa")
-    alpha_metrics = {
-        "shannon": "Shannon",
-        "simpson": "Simpson",
-        "chao1": "Chao1",
-        "observed_otus": "OTUs Observados"
-    }
-    alpha_df = pd.DataFrame(index=common_samples)
-    otus_T = otus.T
-    for m in alpha_metrics:
-        try:
-            alpha_df[alpha_metrics[m]] = alpha_diversity(m, otus_T.values, ids=otus_T.index)
-        except Exception:
-            alpha_df[alpha_metrics[m]] = np.nan
-    alpha_df = alpha_df.join(metadata)
-    cat_vars = [col for col in metadata.columns if 1 < metadata[col].nunique() < len(metadata)]
-    plot_alpha_index_tabbed(alpha_df, cat_vars, alpha_metrics)
+    alpha_df = alpha_table(ds).join(metadata)
+    cat_vars = categorical_vars(metadata)
+    with span("grafico.alfa", muestras=len(alpha_df)):
+        plot_alpha_index_tabbed(alpha_df, cat_vars, ALPHA_METRICS, alpha_tests(ds, cat_vars))
 
-    # =================== DIVERSIDAD BETA (NMDS + elipses) ===================
-    st.subheader("Diversidad Beta (NMDS Bray-Curtis + Elipses)")
+    # =================== DIVERSIDAD BETA (NMDS/PCoA + elipses) ===================
+    tree_file = st.session_state.get("tree_file")
+    metrics = [m for m in BETA_METRICS if tree_file is not None or m not in TREE_METRICS]
+    metric = st.selectbox(
+        "Métrica de distancia", metrics, format_func=BETA_METRICS.get, index=0, key="beta_metric",
+        help="UniFrac requiere subir un árbol filogenético (Newick) en la pestaña de carga."
+    )
+    st.subheader(f"Diversidad Beta ({BETA_METRICS[metric]} + Elipses)")
+    methods = {"NMDS (inicio PCoA, multi-arranque)": "nmds", "PCoA (rápido)": "pcoa"}
+    method_label = st.radio(
+        "Método de ordenación", list(methods),
+        index=1 if len(common_samples) > 2000 else 0, horizontal=True, key="beta_method"
+    )
+    method = methods[method_label]
     try:
-        otus_T = otus.T
-        dist = beta_diversity("braycurtis", otus_T.values, ids=otus_T.index)
-        mds = MDS(n_components=2, metric=False, dissimilarity='precomputed', random_state=42, n_init=10, max_iter=300)
-        nmds_coords = mds.fit_transform(dist.data)
-        coords = pd.DataFrame(nmds_coords, index=otus_T.index, columns=["NMDS1", "NMDS2"])
-        coords = coords.join(metadata, how="left")
-        cat_vars_beta = [col for col in metadata.columns if 1 < metadata[col].nunique() < len(metadata)]
-        plot_beta_diversity(coords, metadata, dist, cat_vars_beta)
+        # Distancias y ordenación se memorizan (memoria + disco) por datos, métrica,
+        # parámetros y subconjunto de muestras: cambiar el color no recalcula nada.
+        # El cálculo va a la cola de trabajos: un rerun no lo reinicia.
+        ordination = background_result(
+            ("ordination", ds.counts_key, method, subset_key(ds), metric_key(metric, tree_file)), f"Ordenación {method.upper()}",
+            lambda job: ordination_result(ds, method, progress=job.report, metric=metric, tree_file=tree_file),
+        )
+        if ordination is not None:
+            coords = ordination_coords(ds, ordination, metric, tree_file)
+            caption = f"Stress (Kruskal): {ordination['stress']:.3f}"
+            if ordination.get("explained") is not None:
+                caption += " · Varianza explicada: " + ", ".join(f"{v:.1%}" for v in ordination["explained"])
+            elif len(ordination["stresses"]) > 1:
+                caption += f" · mejor de {len(ordination['stresses'])} arranques"
+            if ordination.get("warm_start"):
+                warm = ordination["warm_start"]
+                caption += (f" · {warm['new_samples']} muestras nuevas, inicio desde la ordenación "
+                            f"previa de {warm['base_samples']} muestras")
+            st.caption(caption)
+            coords = coords.join(metadata, how="left")
+            with span("grafico.beta", muestras=len(coords)):
+                plot_beta_diversity(coords, ds, cat_vars, metric, tree_file)
     except Exception as e:
-        st.warning(f"No se pudo calcular NMDS Bray-Curtis: {e}")
+        st.warning(f"No se pudo calcular la ordenación {BETA_METRICS[metric]}: {e}")
 
     # =================== CURVAS DE RAREFACCIÓN ===================
-    st.subheader("Curvas de Rarefacción (experimental)")
-    sample_sel = st.selectbox("Muestra para rarefacción", common_samples)
-    if sample_sel:
-        sample = otus[sample_sel]
-        sample = pd.to_numeric(sample, errors="coerce").fillna(0)
-        if sample.sum() == 0:
-            st.error("La muestra seleccionada está vacía. Prueba otra muestra.")
-        else:
-            depths, values = rarefaction_curve(sample)
-            fig = go.Figure()
-            fig.add_trace(go.Scatter(x=depths, y=values, mode="lines+markers"))
-            fig.update_layout(title=f"Rarefacción: {sample_sel}", xaxis_title="Profundidad", yaxis_title="OTUs Observados")
-            st.plotly_chart(fig, use_container_width=True)
+    st.subheader("Curvas de Rarefacción")
+    rare_df = background_result(
+        ("rarefaction", ds.counts_key, subset_key(ds)), "Rarefacción",
+        lambda job: rarefaction_table(ds, progress=job.report),
+    )
+    if rare_df is None:
+        return
+    if rare_df.empty:
+        st.error("Todas las muestras están vacías; no se pueden calcular curvas de rarefacción.")
+        return
+    rare_color = st.selectbox("Variable para color (rarefacción)", cat_vars, index=0 if cat_vars else None, key="rare_color")
+    if rare_color:
+        rare_df = rare_df.join(metadata[[rare_color]], on="Muestra")
+    with span("grafico.rarefaccion", puntos=len(rare_df)):
+        fig = grouped_lines_figure(
+            rare_df, x="Profundidad", y="OTUs Observados", line_group="Muestra", color=rare_color,
+            title="Curvas de rarefacción por muestra"
+        )
+        st.plotly_chart(fig, use_container_width=True)
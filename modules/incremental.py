@@ -0,0 +1,94 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from modules.cache import disk_cache
+from modules.distances import pair_index
+from modules.sparse import as_sample_matrix
+
+# Actualización incremental de la diversidad beta cuando una tabla nueva amplía
+# otra ya analizada (mismas muestras con los mismos conteos, más muestras nuevas).
+# Por cada métrica se recuerdan los últimos MAX_BASES conjuntos de distancias
+# calculados, con una huella por muestra para comprobar que no cambiaron.
+MAX_BASES = 20
+# Vecinos más cercanos con los que se coloca una muestra nueva en el inicio del NMDS
+WARM_START_NEIGHBORS = 5
+
+_lock = threading.Lock()
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+def sample_fingerprints(otus):
+    """
+    Huella (uint64) del vector de conteos de cada muestra. No depende del
+    orden de los OTUs ni de los OTUs sin lecturas en la muestra, así que una
+    muestra conserva su huella aunque la tabla nueva tenga OTUs añadidos.
+    """
+    matrix, samples, features = as_sample_matrix(otus)
+    X = sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+    X.eliminate_zeros()
+    feature_hash = pd.util.hash_pandas_object(pd.Index(features).astype(str), index=False).to_numpy()
+    mixed = (feature_hash[X.indices] * _MIX) ^ X.data.view(np.uint64)
+    out = np.zeros(X.shape[0], dtype=np.uint64)
+    np.add.at(out, np.repeat(np.arange(X.shape[0]), np.diff(X.indptr)), mixed)
+    return out
+
+def _registry_key(metric_key):
+    return ("distindex", metric_key)
+
+def register_distances(metric_key, counts_key, subset, samples, fingerprints):
+    """
+    Anota un conjunto de distancias calculado como posible base de futuras ampliaciones.
+    """
+    entry = {
+        "counts_key": counts_key, "subset": subset, "samples": list(samples),
+        "fingerprints": np.asarray(fingerprints), "time": time.time(),
+    }
+    with _lock:
+        entries = disk_cache().get(_registry_key(metric_key)) or []
+        entries = [e for e in entries if (e["counts_key"], e["subset"]) != (counts_key, subset)]
+        disk_cache().put(_registry_key(metric_key), ([entry] + entries)[:MAX_BASES])
+
+def find_base(metric_key, samples, fingerprints, exclude=None):
+    """
+    El mayor conjunto de distancias ya calculado cuyas muestras están todas en
+    samples con idéntica huella (y que tiene menos muestras), o None.
+    exclude: (counts_key, subset) del propio conjunto, que no cuenta como base.
+    """
+    with _lock:
+        entries = disk_cache().get(_registry_key(metric_key)) or []
+    samples = pd.Index(samples)
+    fingerprints = np.asarray(fingerprints)
+    best = None
+    for entry in entries:
+        if (entry["counts_key"], entry["subset"]) == exclude:
+            continue
+        m = len(entry["samples"])
+        if m < 2 or m >= len(samples) or (best is not None and m <= len(best["samples"])):
+            continue
+        pos = samples.get_indexer(entry["samples"])
+        if (pos >= 0).all() and np.array_equal(fingerprints[pos], entry["fingerprints"]):
+            best = entry
+    return best
+
+def warm_start_coords(dist, base_ids, base_coords, k=WARM_START_NEIGHBORS):
+    """
+    Configuración inicial para el NMDS de la tabla ampliada: las muestras
+    antiguas conservan sus coordenadas y cada muestra nueva se coloca en la
+    media (ponderada por 1/distancia) de sus k vecinas antiguas más cercanas.
+    """
+    n = len(dist.ids)
+    base_coords = np.asarray(base_coords, dtype=np.float64)
+    pos = pd.Index(dist.ids).get_indexer(list(base_ids))
+    init = np.zeros((n, base_coords.shape[1]))
+    init[pos] = base_coords
+    condensed = np.asarray(dist.condensed)
+    k = min(k, len(pos))
+    for q in np.flatnonzero(~np.isin(np.arange(n), pos)):
+        d = condensed[pair_index(q, pos, n)].astype(np.float64)
+        nearest = np.argpartition(d, k - 1)[:k]
+        w = 1.0 / (d[nearest] + 1e-9)
+        init[q] = (w[:, None] * base_coords[nearest]).sum(axis=0) / w.sum()
+    return init
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Instrumentación ligera de las etapas costosas: tiempos, memoria y aciertos de
+# caché. Cada tramo cuesta unos microsegundos (reloj + getrusage), así que puede
+# quedar activa en producción; UYWA_INSTRUMENTATION=0 la desactiva.
+ENABLED = os.environ.get("UYWA_INSTRUMENTATION", "1") != "0"
+MAX_SPANS = 500
+
+logger = logging.getLogger("uywa.perf")
+if os.environ.get("UYWA_PERF_LOG"):
+    # Una línea JSON por tramo: "stderr" o la ruta de un archivo
+    target = os.environ["UYWA_PERF_LOG"]
+    handler = logging.StreamHandler() if target == "stderr" else logging.FileHandler(target)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_spans = deque(maxlen=MAX_SPANS)
+_counters = Counter()
+_lock = threading.Lock()
+_local = threading.local()
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def _rss_mb():
+    # Memoria residente actual (Linux); None si no se puede leer
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * _PAGE_SIZE / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _peak_rss_mb():
+    # Pico de memoria residente del proceso (ru_maxrss está en KB en Linux)
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+@contextmanager
+def span(name, **fields):
+    """
+    Mide un tramo: duración, variación de la memoria residente y cuánto subió
+    el pico del proceso. Los tramos anidados guardan su profundidad.
+    Uso: with span("beta.braycurtis", muestras=n): ...
+    """
+    if not ENABLED:
+        yield
+        return
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    rss0, peak0 = _rss_mb(), _peak_rss_mb()
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        _local.depth = depth
+        rss1, peak1 = _rss_mb(), _peak_rss_mb()
+        record = {
+            "span": name,
+            "seconds": round(seconds, 6),
+            "rss_delta_mb": round(rss1 - rss0, 2) if rss0 is not None and rss1 is not None else None,
+            "peak_growth_mb": round(peak1 - peak0, 2) if peak0 is not None else None,
+            "depth": depth,
+            "thread": threading.current_thread().name,
+            "time": time.time(),
+        }
+        if error:
+            record["error"] = error
+        record.update(fields)
+        with _lock:
+            _spans.append(record)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(record, default=str))
+
+def count(name, n=1):
+    """
+    Suma n a un contador con nombre (p. ej. "cache.beta.disco").
+    """
+    if ENABLED:
+        with _lock:
+            _counters[name] += n
+
+def recent_spans(limit=None):
+    with _lock:
+        spans = list(_spans)
+    return spans[-limit:] if limit else spans
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+def span_summary():
+    """
+    Resumen por tramo: llamadas, tiempo total/medio/máximo y mayor subida del pico de memoria.
+    """
+    spans = recent_spans()
+    if not spans:
+        return pd.DataFrame(columns=["span", "llamadas", "total_s", "medio_s", "max_s", "pico_mb"])
+    df = pd.DataFrame(spans)
+    out = df.groupby("span").agg(
+        llamadas=("seconds", "size"), total_s=("seconds", "sum"), medio_s=("seconds", "mean"),
+        max_s=("seconds", "max"), pico_mb=("peak_growth_mb", "max"),
+    )
+    return out.sort_values("total_s", ascending=False).reset_index()
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
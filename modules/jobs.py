@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from modules.cache import hash_key
+from modules.instrumentation import count, span
+
+# Cola de trabajos en segundo plano para los análisis largos (NMDS, PERMANOVA,
+# rarefacción, abundancia diferencial). Los trabajos corren en hilos del
+# servidor, fuera del hilo del script de Streamlit: un rerun o un segundo clic
+# no los reinicia. Los núcleos pesados ya reparten su trabajo en procesos
+# (n_jobs), así que basta con pocos hilos (UYWA_JOB_WORKERS).
+MAX_WORKERS = int(os.environ.get("UYWA_JOB_WORKERS", "2"))
+# Trabajos terminados que se conservan (con su resultado) para los reruns
+MAX_FINISHED = 50
+# Segundos que la interfaz espera a un trabajo antes de mostrar el progreso
+QUICK_WAIT = 0.3
+
+PENDING, RUNNING, DONE, FAILED, CANCELLED = "pendiente", "en curso", "terminado", "error", "cancelado"
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """
+    Un trabajo de la cola. La función recibe el propio trabajo y puede llamar
+    a job.report(fracción, mensaje) para informar del avance; cada llamada es
+    además el punto en que se atiende una cancelación (lanza JobCancelled).
+    """
+
+    def __init__(self, key, label):
+        self.key = key
+        self.label = label
+        self.status = PENDING
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+
+    def report(self, fraction, message=None):
+        if self._cancel.is_set():
+            raise JobCancelled(self.label)
+        self.progress = min(max(float(fraction), 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def _run(self, fn):
+        if self._cancel.is_set():
+            self._finish(CANCELLED)
+            return
+        self.status = RUNNING
+        self.started = time.time()
+        try:
+            with span(f"trabajo.{self.label}"):
+                self.result = fn(self)
+            self.progress = 1.0
+            self._finish(DONE)
+        except JobCancelled:
+            self._finish(CANCELLED)
+        except Exception as e:
+            self.error = e
+            self._finish(FAILED)
+
+    def _finish(self, status):
+        self.status = status
+        self.finished = time.time()
+        self._done.set()
+
+class JobQueue:
+    """
+    Pool de hilos con trabajos identificados por clave: enviar una clave que
+    ya está pendiente, en curso o terminada devuelve el trabajo existente
+    (deduplicación entre reruns y entre sesiones). Los trabajos fallidos se
+    vuelven a lanzar al reenviarlos; los cancelados, tras forget(clave).
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_finished=MAX_FINISHED):
+        self.max_finished = max_finished
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="uywa-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, label="trabajo"):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.status != FAILED:
+                self._jobs.move_to_end(key)
+                count("trabajos.deduplicados")
+                return job
+            job = Job(key, label)
+            self._jobs[key] = job
+            self._trim()
+        count("trabajos.enviados")
+        self._pool.submit(job._run, fn)
+        return job
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def cancel(self, key):
+        job = self.get(key)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def forget(self, key):
+        with self._lock:
+            self._jobs.pop(key, None)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _trim(self):
+        # Descarta los terminados más antiguos; los activos nunca se descartan
+        finished = [k for k, j in self._jobs.items() if j.done]
+        for key in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[key]
+
+JOBS = JobQueue()
+
+@st.fragment(run_every=1.0)
+def _job_status(key):
+    # Se refresca cada segundo; al terminar el trabajo relanza la app para pintar el resultado
+    job = JOBS.get(key)
+    if job is None or job.done:
+        st.rerun()
+    text = f"{job.label}: {job.status}"
+    if job.message:
+        text += f" · {job.message}"
+    if job.started:
+        text += f" · {job.elapsed:.0f} s"
+    st.progress(job.progress, text=text)
+    if job.cancel_requested:
+        st.caption("Cancelando...")
+    elif st.button("Cancelar", key=f"cancel_job_{hash_key(*key)}"):
+        job.cancel()
+
+def background_result(key, label, compute):
+    """
+    Ejecuta compute(job) en la cola de trabajos y devuelve su resultado si ya
+    terminó (o termina en QUICK_WAIT segundos, p. ej. por estar en caché).
+    Si sigue en curso muestra el progreso con un botón de cancelar y devuelve
+    None; la interfaz se actualiza sola al terminar. Los errores del cálculo
+    se relanzan aquí, en el hilo del script.
+    """
+    job = JOBS.submit(key, compute, label)
+    if not job.wait(QUICK_WAIT):
+        _job_status(key)
+        return None
+    if job.status == FAILED:
+        JOBS.forget(key)
+        raise job.error
+    if job.status == CANCELLED:
+        st.info(f"{label}: cancelado.")
+        if st.button("Volver a calcular", key=f"retry_job_{hash_key(*key)}"):
+            JOBS.forget(key)
+            st.rerun()
+        return None
+    return job.result
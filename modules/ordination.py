@@ -0,0 +1,174 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+from scipy.linalg import eigh
+from scipy.spatial.distance import pdist, squareform
+from scipy.sparse.linalg import eigsh
+from sklearn.manifold import smacof
+
+from modules.parallel import POLL_SECONDS, process_pool
+
+# Por debajo de este número de muestras no compensa abrir un pool de procesos
+PARALLEL_MIN_SAMPLES = 300
+
+def _square(dist):
+    # Acepta CondensedDistances, DistanceMatrix de scikit-bio o una matriz cuadrada
+    if hasattr(dist, "to_square"):
+        return dist.to_square()
+    return np.asarray(getattr(dist, "data", dist), dtype=np.float64)
+
+def _centered_gram(dist):
+    """
+    -0.5·D² doblemente centrada, en una sola matriz n x n: con
+    CondensedDistances se construye y centra en su sitio; una matriz
+    cuadrada de entrada no se modifica (se eleva al cuadrado en una copia).
+    """
+    if hasattr(dist, "to_square"):
+        B = dist.to_square()
+        B **= 2
+    else:
+        B = _square(dist) ** 2
+    B *= -0.5
+    means = B.mean(axis=1)
+    grand = means.mean()
+    # B es simétrica: medias por fila = medias por columna
+    B -= means[:, None]
+    B -= means[None, :]
+    B += grand
+    return B
+
+def pcoa(dist, n_components=2):
+    """
+    Análisis de coordenadas principales (MDS clásico).
+    Memoria: una matriz n x n float64 (8·n² bytes); NMDS necesita además la
+    de distancias (16·n²), por lo que ambos son para hasta ~20.000 muestras.
+    Devuelve (coordenadas n x n_components, proporción de varianza explicada por eje).
+    """
+    B = _centered_gram(dist)
+    n = B.shape[0]
+    if n > 500:
+        # Solo hacen falta los primeros autovectores: Lanczos evita la descomposición completa
+        vals, vecs = eigsh(B, k=n_components, which="LA")
+    else:
+        vals, vecs = eigh(B, subset_by_index=[n - n_components, n - 1])
+    order = np.argsort(vals)[::-1]
+    vals, vecs = vals[order], vecs[:, order]
+    coords = vecs * np.sqrt(np.clip(vals, 0, None))
+    total = np.trace(B)
+    explained = vals / total if total > 0 else np.full(n_components, np.nan)
+    return coords, explained
+
+def stress(dist, coords):
+    """
+    Stress-1 de Kruskal (métrico) de una configuración frente a las distancias originales.
+    """
+    if hasattr(dist, "condensed"):
+        d = np.asarray(dist.condensed, dtype=np.float64)
+    else:
+        d = squareform(_square(dist), checks=False)
+    d_conf = pdist(coords)
+    return float(np.sqrt(((d - d_conf) ** 2).sum() / (d ** 2).sum()))
+
+_WORKER_D = None
+
+def _init_worker(D):
+    # La matriz se envía una vez por proceso, no una vez por inicio
+    global _WORKER_D
+    _WORKER_D = D
+
+def _smacof_start(init, seed, n_components, max_iter, eps, D=None):
+    D = _WORKER_D if D is None else D
+    coords, st, n_iter = smacof(
+        D, metric=False, n_components=n_components, init=init, n_init=1,
+        max_iter=max_iter, eps=eps, random_state=seed,
+        return_n_iter=True, normalized_stress=True,
+    )
+    return coords, float(st), int(n_iter)
+
+def nmds(dist, n_components=2, n_init=4, max_iter=300, eps=1e-4, random_state=42,
+         n_jobs=None, stop_stress=0.05, progress=None, init=None):
+    """
+    NMDS (SMACOF no métrico) con inicio PCoA y varios arranques en paralelo.
+    - El primer arranque parte de la solución PCoA; el resto son aleatorios.
+    - Cada arranque se detiene al converger (mejora relativa de stress < eps).
+    - Si un arranque alcanza stress <= stop_stress no se lanzan más; en
+      paralelo hay como mucho n_jobs (y n_init - 1) arranques en curso, y
+      los que siguen en curso al parar se descartan sin esperarlos.
+    - n_jobs: procesos a usar (None = todos los núcleos, 1 = en serie).
+    - progress(fracción) informa del avance tras cada arranque (y, en
+      paralelo, cada POLL_SECONDS mientras espera, para atender cancelaciones).
+    - init: configuración inicial (n x n_components); si se da, un único
+      arranque desde ella (p. ej. la ordenación anterior de una tabla ampliada).
+    Devuelve un dict con coords, stress (el mejor), stresses (todos los
+    arranques completados), n_iter y method.
+    """
+    D = _square(dist)
+    rng = np.random.default_rng(random_state)
+    seeds = rng.integers(0, 2 ** 31 - 1, size=n_init)
+    if init is not None:
+        n_init = 1
+        starts = [(np.asarray(init, dtype=np.float64), int(seeds[0]), n_components, max_iter, eps)]
+    else:
+        init_pcoa, _ = pcoa(D, n_components)
+        starts = [(init_pcoa if i == 0 else None, int(seeds[i]), n_components, max_iter, eps) for i in range(n_init)]
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, n_init)
+
+    results = []
+    if n_jobs <= 1 or D.shape[0] < PARALLEL_MIN_SAMPLES:
+        for args in starts:
+            results.append(_smacof_start(*args, D=D))
+            if progress:
+                progress(len(results) / n_init)
+            if stop_stress is not None and results[-1][1] <= stop_stress:
+                break
+    else:
+        # Se retiene al menos un arranque: solo se lanza tras comprobar el stress de los anteriores
+        window = max(1, min(n_jobs, n_init - 1))
+        queue = list(starts)
+        pool = process_pool(window, _init_worker, (D,))
+        try:
+            pending = {pool.submit(_smacof_start, *queue.pop(0)) for _ in range(window)}
+            while pending:
+                done, pending = wait(pending, timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+                results.extend(f.result() for f in done)
+                if progress:
+                    progress(len(results) / n_init)
+                if not done:
+                    continue
+                if stop_stress is not None and min(r[1] for r in results) <= stop_stress:
+                    break
+                while queue and len(pending) < window:
+                    pending.add(pool.submit(_smacof_start, *queue.pop(0)))
+        finally:
+            # Al parar antes de tiempo no se espera a los arranques en curso (se descartan)
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    best = min(results, key=lambda r: r[1])
+    return {
+        "coords": best[0],
+        "stress": best[1],
+        "stresses": [r[1] for r in results],
+        "n_iter": best[2],
+        "method": "NMDS",
+    }
+
+def ordinate(dist, method="nmds", n_components=2, **kwargs):
+    """
+    Punto de entrada único: method="nmds" (SMACOF con inicio PCoA) o
+    method="pcoa" (modo rápido, segundos incluso con miles de muestras).
+    """
+    if method == "pcoa":
+        coords, explained = pcoa(dist, n_components)
+        return {
+            "coords": coords,
+            "stress": stress(dist, coords),
+            "stresses": [],
+            "explained": explained,
+            "method": "PCoA",
+        }
+    if method == "nmds":
+        return nmds(dist, n_components=n_components, **kwargs)
+    raise ValueError(f"Método de ordenación no soportado: {method}")
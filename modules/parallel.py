@@ -0,0 +1,67 @@
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# Los pools de procesos se abren desde hilos del servidor de Streamlit (la cola
+# de trabajos). Con "fork" el hijo hereda los cerrojos que tuvieran tomados
+# otros hilos y puede bloquearse: los procesos se crean con "forkserver" (o
+# "spawn" donde no existe). Los argumentos del inicializador se serializan
+# una vez por proceso.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+# Módulos que el servidor de forkserver importa una sola vez: cada proceso
+# nuevo nace con ellos cargados en lugar de importarlos al arrancar
+PRELOAD = ["__main__", "numpy", "pandas", "scipy.sparse", "modules.distances", "modules.differential",
+           "modules.ordination", "modules.permanova", "modules.pipeline"]
+# Segundos entre comprobaciones de cancelación mientras se espera a un bloque
+POLL_SECONDS = 0.5
+
+def process_pool(max_workers, initializer=None, initargs=()):
+    """
+    ProcessPoolExecutor con el método de arranque seguro entre hilos (START_METHOD).
+    """
+    context = multiprocessing.get_context(START_METHOD)
+    if START_METHOD == "forkserver":
+        context.set_forkserver_preload(PRELOAD)
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=context,
+        initializer=initializer, initargs=initargs,
+    )
+
+def run_chunks(fn, chunks, max_workers, initializer=None, initargs=(), on_result=None, progress=None, sizes=None):
+    """
+    Ejecuta fn(*args) para cada args de chunks en un pool de procesos.
+
+    - on_result(posición, resultado) se llama en este hilo según terminan los
+      bloques (en cualquier orden); sin on_result se devuelve la lista de
+      resultados en el orden de chunks.
+    - progress(fracción) se llama tras cada bloque (ponderado por sizes si se
+      da) y cada POLL_SECONDS mientras se espera, para que una cancelación
+      (JobCancelled desde job.report) se atienda sin esperar al bloque en curso.
+    Si algo lanza, los bloques pendientes se cancelan y no se espera a los
+    que están en marcha.
+    """
+    sizes = sizes or [1] * len(chunks)
+    total, done = sum(sizes), 0
+    results = [None] * len(chunks)
+    pool = process_pool(max_workers, initializer, initargs)
+    try:
+        futures = {}
+        for i, args in enumerate(chunks):
+            futures[pool.submit(fn, *args)] = i
+            if progress and i < max_workers:
+                # Los primeros envíos arrancan los procesos (lento con la CPU ocupada)
+                progress(0.0)
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = futures[future]
+                if on_result:
+                    on_result(i, future.result())
+                else:
+                    results[i] = future.result()
+                done += sizes[i]
+            if progress:
+                progress(done / total)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    return None if on_result else results
@@ -0,0 +1,156 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from modules.parallel import run_chunks
+
+# Filas de la matriz de distancias procesadas a la vez y permutaciones por lote:
+# acotan la memoria temporal (bloque de filas x n y n x permutaciones x grupos).
+ROW_BLOCK = 512
+PERM_BATCH = 64
+# Por debajo de este trabajo (n² x permutaciones) no compensa abrir procesos
+PARALLEL_MIN_WORK = 5e9
+# Permutaciones por tarea: cada tarea lleva su semilla, así que el p-valor no
+# depende de n_jobs, y una cancelación descarta las tareas aún en cola
+PERM_CHUNK = 2048
+
+def _n_from_condensed(m):
+    n = int(round((1 + np.sqrt(1 + 8 * m)) / 2))
+    if n * (n - 1) // 2 != m:
+        raise ValueError("El vector condensado no corresponde a una matriz de distancias.")
+    return n
+
+def _as_distances(dist):
+    # CondensedDistances -> su vector condensado; DistanceMatrix -> su matriz cuadrada (SIN copiar)
+    if hasattr(dist, "condensed"):
+        return np.asarray(dist.condensed)
+    data = getattr(dist, "data", dist)
+    return np.asarray(data)
+
+def _n_samples(d):
+    return d.shape[0] if d.ndim == 2 else _n_from_condensed(d.shape[0])
+
+def _row_block(d, n, start, stop):
+    """
+    Filas [start, stop) de la matriz cuadrada de distancias al cuadrado.
+    Con una matriz cuadrada es una vista; con un vector condensado se
+    reconstruye solo el bloque pedido, sin expandir nunca la matriz completa.
+    """
+    if d.ndim == 2:
+        block = d[start:stop]
+    else:
+        rows = np.arange(start, stop)[:, None]
+        cols = np.arange(n)[None, :]
+        i = np.minimum(rows, cols)
+        j = np.maximum(rows, cols)
+        idx = n * i - i * (i + 1) // 2 + (j - i - 1)
+        block = np.where(rows == cols, 0.0, d[np.clip(idx, 0, d.shape[0] - 1)])
+    return np.square(block, dtype=np.float64)
+
+def _ss_within(d, n, codes, sizes, perms):
+    """
+    Suma de cuadrados intra-grupo para un lote de permutaciones a la vez:
+    SS_W = sum_g 1/(2 n_g) * g' D² g, con g la columna indicadora del grupo.
+    - perms: matriz (P x n) de permutaciones de las etiquetas
+    """
+    k = len(sizes)
+    P = perms.shape[0]
+    # Indicadoras apiladas: columna p*k + g marca las muestras del grupo g en la permutación p
+    G = np.zeros((n, P * k))
+    permuted = codes[perms]
+    G[np.arange(n)[None, :], np.arange(P)[:, None] * k + permuted] = 1.0
+    quad = np.zeros(P * k)
+    for start in range(0, n, ROW_BLOCK):
+        stop = min(start + ROW_BLOCK, n)
+        block = _row_block(d, n, start, stop)
+        quad += np.einsum("ij,ij->j", G[start:stop], block @ G)
+    return (quad.reshape(P, k) / (2.0 * sizes[None, :])).sum(axis=1)
+
+def _pseudo_f(ss_w, ss_t, n, k):
+    return ((ss_t - ss_w) / (k - 1)) / (ss_w / (n - k))
+
+_WORKER_D = None
+
+def _init_worker(d):
+    # La matriz se envía una vez por proceso
+    global _WORKER_D
+    _WORKER_D = d
+
+def _count_extreme(seed, n_perm, codes, sizes, ss_t, f_obs, d=None, progress=None):
+    d = _WORKER_D if d is None else d
+    n = len(codes)
+    k = len(sizes)
+    rng = np.random.default_rng(seed)
+    extreme = 0
+    for start in range(0, n_perm, PERM_BATCH):
+        P = min(PERM_BATCH, n_perm - start)
+        perms = rng.permuted(np.tile(np.arange(n), (P, 1)), axis=1)
+        f_perm = _pseudo_f(_ss_within(d, n, codes, sizes, perms), ss_t, n, k)
+        extreme += int((f_perm >= f_obs).sum())
+        if progress:
+            progress(start + P)
+    return extreme
+
+def permanova(dist, grouping, permutations=999, seed=42, n_jobs=None, progress=None):
+    """
+    PERMANOVA (Anderson 2001) vectorizado.
+    - dist: CondensedDistances, DistanceMatrix de scikit-bio, matriz cuadrada o vector condensado;
+      se usa tal cual, sin copias
+    - grouping: etiqueta de grupo por muestra, en el mismo orden que dist
+    - permutations: número de permutaciones (9.999+ es viable)
+    - n_jobs: procesos para repartir las permutaciones (None = todos los núcleos)
+    - progress(fracción) informa del avance por lotes de permutaciones
+    El pseudo-F de cada lote de permutaciones se obtiene con productos de
+    matrices sobre bloques de filas. Devuelve una Serie con el mismo formato
+    que skbio.stats.distance.permanova, más el R².
+    """
+    d = _as_distances(dist)
+    n = _n_samples(d)
+    codes, groups = pd.factorize(pd.Series(np.asarray(grouping)).astype(str))
+    if len(codes) != n:
+        raise ValueError("La agrupación no tiene el mismo número de muestras que la matriz de distancias.")
+    k = len(groups)
+    if k < 2 or k >= n:
+        raise ValueError("PERMANOVA requiere entre 2 y n-1 grupos.")
+    sizes = np.bincount(codes, minlength=k).astype(np.float64)
+
+    ss_t = 0.0
+    for start in range(0, n, ROW_BLOCK):
+        ss_t += _row_block(d, n, start, min(start + ROW_BLOCK, n)).sum()
+    ss_t /= 2.0 * n
+    ss_w = _ss_within(d, n, codes, sizes, np.arange(n)[None, :])[0]
+    f_obs = _pseudo_f(ss_w, ss_t, n, k)
+
+    p_value = np.nan
+    if permutations > 0:
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
+        chunks = [min(PERM_CHUNK, permutations - s) for s in range(0, permutations, PERM_CHUNK)]
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        args = [(s, c, codes, sizes, ss_t, f_obs) for s, c in zip(seeds, chunks)]
+        if n_jobs <= 1 or len(chunks) == 1 or n * n * permutations < PARALLEL_MIN_WORK:
+            extreme, done = 0, 0
+            for a in args:
+                step = (lambda m: progress((done + m) / permutations)) if progress else None
+                extreme += _count_extreme(*a, d=d, progress=step)
+                done += a[1]
+        else:
+            extreme = sum(run_chunks(
+                _count_extreme, args, min(n_jobs, len(chunks)), _init_worker, (d,), progress=progress, sizes=chunks
+            ))
+        p_value = (extreme + 1) / (permutations + 1)
+
+    return pd.Series(
+        {
+            "method name": "PERMANOVA",
+            "test statistic name": "pseudo-F",
+            "sample size": n,
+            "number of groups": k,
+            "test statistic": f_obs,
+            "p-value": p_value,
+            "number of permutations": permutations,
+            "R2": (ss_t - ss_w) / ss_t,
+        },
+        name="PERMANOVA results",
+    )
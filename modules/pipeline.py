@@ -0,0 +1,342 @@
+import json
+import os
+import time
+
+import pandas as pd
+
+from modules.alignment import categorical_vars, load_dataset
+from modules.alpha import ALPHA_METRICS, alpha_diversity_table
+from modules.alpha_stats import alpha_group_tests
+from modules.cache import CACHE_VERSION, DISK_CACHE_DIR, hash_key, lookup, memoize
+from modules.distances import BETA_METRICS, TREE_METRICS, extend_distances, load_tree, pairwise_distances
+from modules.incremental import find_base, register_distances, sample_fingerprints, warm_start_coords
+from modules.ordination import ordinate
+from modules.parallel import process_pool
+from modules.permanova import permanova
+from modules.rarefaction import rarefaction_curves
+from modules.rollup import TaxonomyIndex
+from modules.sparse import SparseCounts
+from modules.utils import file_bytes, file_hash
+
+# Cálculos de las pestañas sin Streamlit. Las claves de memoize son las mismas
+# que usa la app: lo que se precalcula aquí (p. ej. con cli.py y el mismo
+# UYWA_CACHE_DIR) la app lo lee de la caché de disco sin recalcular.
+
+ORDINATION_METHODS = ("nmds", "pcoa")
+# Desde este número de muestras las distancias se escriben en un .npy con
+# memory-map (junto a la caché de disco) en lugar de quedarse en memoria
+MEMMAP_MIN_SAMPLES = int(os.environ.get("UYWA_MEMMAP_SAMPLES", "10000"))
+
+def phase_progress(progress, start, end, label):
+    # Tramo [start, end] de una barra compartida por varias fases, con su nombre:
+    # progress(fracción, mensaje), como Job.report
+    if progress is None:
+        return None
+    return lambda fraction: progress(start + (end - start) * fraction, label)
+
+def subset_key(ds):
+    # Huella del subconjunto de muestras analizado (las que tienen metadata)
+    return hash_key(*ds.common_samples) if ds.metadata is not None else hash_key(*ds.alignment.samples)
+
+def compute_alpha(otus, metrics=None):
+    """
+    Índices de diversidad alfa (columnas = etiquetas de ALPHA_METRICS) de una
+    tabla de conteos (DataFrame OTU x muestras o SparseCounts), sin caché.
+    """
+    return alpha_diversity_table(otus, metrics)
+
+def compute_distances(otus, metric="braycurtis", tree=None, n_jobs=1, out=None, progress=None):
+    """
+    Distancias beta entre muestras (CondensedDistances, float32), sin caché.
+    """
+    return pairwise_distances(otus, metric, tree=tree, n_jobs=n_jobs, out=out, progress=progress)
+
+def compute_braycurtis(otus):
+    return compute_distances(otus, "braycurtis")
+
+def alpha_table(ds, metrics=None):
+    """
+    Índices de diversidad alfa por muestra común (memorizados). Con la
+    tabla rarefactada son la media de los de cada submuestreo.
+    """
+    metrics = tuple(ALPHA_METRICS) if metrics is None else tuple(metrics)
+    if ds.rarefaction is not None:
+        # Tabla rarefactada: índices ya calculados en cada submuestreo y promediados
+        alpha = ds.rarefaction["alpha"][[ALPHA_METRICS[m] for m in metrics]]
+        return alpha[alpha.index.isin(ds.common_samples)] if ds.metadata is not None else alpha
+    return memoize("alpha", (ds.counts_key, subset_key(ds), metrics), lambda: compute_alpha(ds.common_counts(), metrics))
+
+def alpha_tests(ds, variables=None):
+    """
+    Pruebas de grupo de todas las métricas alfa x variables de agrupación
+    (por defecto categorical_vars): (resumen, post-hoc) de alpha_group_tests,
+    memorizados por datos y por los valores de cada variable.
+    """
+    variables = tuple(categorical_vars(ds.metadata) if variables is None else variables)
+    groupings = tuple(hash_key(*ds.metadata[var].astype(str)) for var in variables)
+    return memoize(
+        "alphatests", (ds.counts_key, subset_key(ds), variables, groupings),
+        lambda: alpha_group_tests(alpha_table(ds), ds.metadata, variables)
+    )
+
+def phylo_tree(tree_file):
+    """
+    Árbol Newick subido (o ruta) como TreeNode, una vez por contenido.
+    """
+    return memoize("tree", (file_hash(tree_file),), lambda: load_tree(file_bytes(tree_file)), persist=False)
+
+def metric_key(metric, tree_file=None):
+    # Las UniFrac dependen además del árbol
+    if metric not in BETA_METRICS:
+        raise ValueError(f"Métrica beta no soportada: {metric}")
+    if metric in TREE_METRICS:
+        if tree_file is None:
+            raise ValueError("Las métricas UniFrac necesitan un árbol filogenético (Newick).")
+        return (metric, file_hash(tree_file))
+    return metric
+
+def _compute_beta(ds, metric, tree_file, key, out, n_jobs, progress):
+    # Si la tabla amplía otra ya analizada (mismas muestras y conteos, más
+    # muestras), se parte de sus distancias y solo se calculan las filas nuevas
+    counts = ds.common_counts()
+    tree = phylo_tree(tree_file) if metric in TREE_METRICS else None
+    samples = counts.samples if isinstance(counts, SparseCounts) else counts.columns
+    fingerprints = sample_fingerprints(counts)
+    base = find_base(key[1], samples, fingerprints, exclude=(key[0], key[2]))
+    previous = lookup("distances", (base["counts_key"], key[1], base["subset"])) if base else None
+    if previous is not None:
+        dist = extend_distances(previous, counts, metric, tree, out=out, progress=progress)
+        dist.attrs["incremental"].update(counts_key=base["counts_key"], subset=base["subset"], base_ids=previous.ids)
+    else:
+        dist = compute_distances(counts, metric, tree, n_jobs=n_jobs, out=out, progress=progress)
+    register_distances(key[1], key[0], key[2], samples, fingerprints)
+    return dist
+
+def beta_distances(ds, metric="braycurtis", tree_file=None, n_jobs=None, progress=None):
+    """
+    Distancias beta de las muestras comunes (memorizadas). Con muchas muestras
+    (MEMMAP_MIN_SAMPLES) el vector condensado se escribe en disco y se abre
+    con memory-map. Una tabla que solo añade muestras a otra ya analizada
+    reutiliza sus distancias (modules.incremental).
+    """
+    key = (ds.counts_key, metric_key(metric, tree_file), subset_key(ds))
+    n = len(ds.common_samples) if ds.metadata is not None else len(ds.alignment.samples)
+    out = os.path.join(DISK_CACHE_DIR, f"{hash_key('distances', CACHE_VERSION, *key)}.npy") if n >= MEMMAP_MIN_SAMPLES else None
+    return memoize("distances", key, lambda: _compute_beta(ds, metric, tree_file, key, out, n_jobs, progress))
+
+def ordination_params(method):
+    params = dict(method=method, n_components=2)
+    if method == "nmds":
+        params.update(n_init=4, max_iter=300, eps=1e-4, random_state=42)
+    return params
+
+def _compute_ordination(ds, method, params, extra, metric, tree_file):
+    progress = extra.pop("progress", None)
+    split = 0.5 if method == "nmds" else 0.9
+    dist = beta_distances(ds, metric, tree_file, n_jobs=extra.get("n_jobs"),
+                          progress=phase_progress(progress, 0.0, split, "Distancias"))
+    if method == "nmds":
+        extra["progress"] = phase_progress(progress, split, 1.0, "NMDS")
+    base = dist.attrs.get("incremental")
+    if method == "nmds" and base and "counts_key" in base:
+        # Tabla ampliada: el NMDS arranca de la ordenación anterior (si sigue en caché)
+        previous = lookup(
+            "ordination",
+            (base["counts_key"], metric_key(metric, tree_file), tuple(sorted(params.items())), base["subset"]),
+        )
+        if previous is not None:
+            init = warm_start_coords(dist, base["base_ids"], previous["coords"])
+            result = ordinate(dist, **params, **extra, init=init)
+            result["warm_start"] = {"base_samples": base["base_samples"], "new_samples": base["new_samples"]}
+            return result
+    return ordinate(dist, **params, **extra)
+
+def ordination_result(ds, method="nmds", n_jobs=None, progress=None, metric="braycurtis", tree_file=None):
+    """
+    Ordenación (NMDS o PCoA) sobre las distancias de metric; dict de ordinate().
+    n_jobs y progress no forman parte de la clave: no cambian el resultado.
+    progress(fracción, mensaje) recibe distancias y ordenación como tramos
+    consecutivos de una misma barra.
+    Si la tabla amplía otra ya ordenada, el NMDS arranca de aquella
+    configuración (un solo arranque; el resultado lleva "warm_start").
+    """
+    params = ordination_params(method)
+    extra = {"n_jobs": n_jobs, "progress": progress} if method == "nmds" else {"progress": progress}
+    return memoize(
+        "ordination", (ds.counts_key, metric_key(metric, tree_file), tuple(sorted(params.items())), subset_key(ds)),
+        lambda: _compute_ordination(ds, method, params, extra, metric, tree_file)
+    )
+
+def ordination_coords(ds, ordination, metric="braycurtis", tree_file=None):
+    prefix = ordination["method"]
+    return pd.DataFrame(
+        ordination["coords"], index=list(beta_distances(ds, metric, tree_file).ids),
+        columns=[f"{prefix}1", f"{prefix}2"]
+    )
+
+def permanova_result(ds, variable, permutations=999, seed=42, n_jobs=None, progress=None,
+                     metric="braycurtis", tree_file=None):
+    """
+    PERMANOVA de las distancias de metric para una variable de metadata (Serie de resultados).
+    progress(fracción, mensaje) recibe distancias y permutaciones como tramos de una misma barra.
+    """
+    dist = beta_distances(ds, metric, tree_file, n_jobs=n_jobs, progress=phase_progress(progress, 0.0, 0.3, "Distancias"))
+    grouping = ds.metadata.loc[list(dist.ids), variable].astype(str)
+    if grouping.nunique() < 2:
+        raise ValueError("PERMANOVA requiere al menos dos grupos diferentes en la variable de agrupación.")
+    return memoize(
+        "permanova",
+        ((ds.counts_key, metric_key(metric, tree_file), subset_key(ds)), variable, hash_key(*grouping), permutations, seed),
+        lambda: permanova(
+            dist, grouping=grouping.to_numpy(), permutations=permutations, seed=seed, n_jobs=n_jobs,
+            progress=phase_progress(progress, 0.3, 1.0, "Permutaciones"),
+        ),
+    )
+
+def taxonomy_table(ds):
+    """
+    Taxonomía con columnas capitalizadas y niveles con más de un taxón.
+    """
+    taxonomy = ds.taxonomy.rename(columns=lambda c: str(c).strip().capitalize())
+    levels = [col for col in taxonomy.columns if taxonomy[col].nunique(dropna=True) > 1]
+    return taxonomy, levels
+
+def taxonomy_key(ds):
+    return (ds.counts_key, ds.key[1])
+
+def taxonomy_index(ds):
+    """
+    TaxonomyIndex de todos los niveles útiles, una vez por (tabla OTU, taxonomía).
+    """
+    taxonomy, levels = taxonomy_table(ds)
+    return memoize(
+        "taxindex", taxonomy_key(ds) + tuple(levels),
+        lambda: TaxonomyIndex(ds.features, taxonomy, levels), persist=False
+    )
+
+def taxonomy_rollup(ds, level):
+    """
+    Abundancias taxones x muestras de un nivel (todas las muestras de la tabla OTU).
+    """
+    return memoize("rollup", taxonomy_key(ds) + (level,), lambda: taxonomy_index(ds).rollup_frame(ds.otus, level))
+
+def rarefaction_table(ds, steps=10, iterations=10, seed=42, progress=None):
+    """
+    Curvas de rarefacción (formato largo) de las muestras comunes.
+    """
+    return memoize(
+        "rarefaction", (ds.counts_key, subset_key(ds), steps, iterations, seed),
+        lambda: rarefaction_curves(ds.common_counts(), steps=steps, iterations=iterations, seed=seed, progress=progress)
+    )
+
+def _study_dataset(study, sparse, prefilter=None, rarefy=None):
+    return load_dataset(
+        study["otus"], study.get("taxonomy"), study.get("metadata"), sparse=sparse, prefilter=prefilter, rarefy=rarefy
+    )
+
+def _write_frame(df, out_dir, name):
+    path = os.path.join(out_dir, name)
+    df.to_csv(path)
+    return path
+
+def run_study(study, out_dir, method="nmds", permutations=999, variables=None, sparse=False, n_jobs=1,
+              metric="braycurtis", prefilter=None, rarefy=None):
+    """
+    Análisis completo de un estudio ({"name", "otus", "taxonomy", "metadata"}
+    y opcionalmente "tree" para UniFrac: rutas a los archivos). Escribe los
+    resultados en out_dir/<name>/ y devuelve un resumen con las rutas
+    generadas y los tiempos de cada etapa. prefilter (modules.prefilter) y
+    rarefy (rarefy_table) normalizan la tabla para todas las etapas.
+    """
+    tree_file = study.get("tree")
+    start = time.perf_counter()
+    timings = {}
+
+    def stage(name, fn):
+        t0 = time.perf_counter()
+        value = fn()
+        timings[name] = round(time.perf_counter() - t0, 4)
+        return value
+
+    folder = os.path.join(out_dir, study["name"])
+    os.makedirs(folder, exist_ok=True)
+    ds = stage("alineamiento", lambda: _study_dataset(study, sparse, prefilter, rarefy))
+    summary = {
+        "name": study["name"],
+        "samples": len(ds.alignment.samples),
+        "features": len(ds.features),
+        "files": {},
+        "timings": timings,
+    }
+    if ds.prefilter is not None:
+        summary["prefilter"] = ds.prefilter
+    if ds.rarefaction is not None:
+        summary["rarefaction"] = {k: v for k, v in ds.rarefaction.items() if k != "alpha"}
+    if ds.taxonomy is not None:
+        summary["features_with_taxonomy"] = ds.alignment.n_tax_matched
+        for level in taxonomy_table(ds)[1]:
+            rolled = stage(f"taxonomia_{level}", lambda: taxonomy_rollup(ds, level))
+            summary["files"][f"taxonomy_{level}"] = _write_frame(rolled, folder, f"taxonomy_{level}.csv")
+
+    if ds.metadata is not None:
+        summary["samples_with_metadata"] = len(ds.common_samples)
+        if variables is None:
+            variables = categorical_vars(ds.metadata)
+        alpha = stage("alfa", lambda: alpha_table(ds))
+        summary["files"]["alpha"] = _write_frame(alpha.join(ds.metadata), folder, "alpha.csv")
+        tests, posthoc = stage("alfa_pruebas", lambda: alpha_tests(ds, variables))
+        summary["files"]["alpha_tests"] = _write_frame(tests, folder, "alpha_tests.csv")
+        summary["files"]["alpha_posthoc"] = _write_frame(posthoc, folder, "alpha_posthoc.csv")
+        ordination = stage(
+            "ordenacion", lambda: ordination_result(ds, method, n_jobs=n_jobs, metric=metric, tree_file=tree_file)
+        )
+        coords = ordination_coords(ds, ordination, metric, tree_file).join(ds.metadata, how="left")
+        summary["metric"] = metric
+        summary["files"]["ordination"] = _write_frame(coords, folder, f"ordination_{method}.csv")
+        summary["stress"] = float(ordination["stress"])
+        rows = {}
+        for var in variables:
+            try:
+                rows[var] = stage(
+                    f"permanova_{var}",
+                    lambda: permanova_result(ds, var, permutations, n_jobs=n_jobs, metric=metric, tree_file=tree_file)
+                )
+            except ValueError as e:
+                summary.setdefault("errors", {})[f"permanova_{var}"] = str(e)
+        if rows:
+            summary["files"]["permanova"] = _write_frame(pd.DataFrame(rows).T, folder, "permanova.csv")
+    rare = stage("rarefaccion", lambda: rarefaction_table(ds))
+    rare.to_csv(os.path.join(folder, "rarefaction.csv"), index=False)
+    summary["files"]["rarefaction"] = os.path.join(folder, "rarefaction.csv")
+
+    summary["total_seconds"] = round(time.perf_counter() - start, 4)
+    with open(os.path.join(folder, "summary.json"), "w") as fh:
+        json.dump(summary, fh, indent=2, default=str)
+    return summary
+
+def _run_study_safe(study, out_dir, kwargs):
+    try:
+        return run_study(study, out_dir, **kwargs)
+    except Exception as e:
+        return {"name": study["name"], "error": f"{type(e).__name__}: {e}"}
+
+def run_batch(studies, out_dir, n_jobs=None, **kwargs):
+    """
+    Procesa varios estudios en paralelo, uno por proceso. Dentro de cada
+    proceso los cálculos van en serie (n_jobs=1) para no anidar pools.
+    Un estudio que falla no detiene al resto: su resumen lleva "error".
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(studies)))
+    if n_jobs == 1:
+        # Un solo proceso: cada estudio puede usar todos los núcleos en NMDS/PERMANOVA
+        results = [_run_study_safe(s, out_dir, dict(kwargs, n_jobs=None)) for s in studies]
+    else:
+        with process_pool(n_jobs) as pool:
+            results = list(pool.map(_run_study_safe, studies, [out_dir] * len(studies),
+                                    [dict(kwargs, n_jobs=1)] * len(studies)))
+    with open(os.path.join(out_dir, "batch_summary.json"), "w") as fh:
+        json.dump(results, fh, indent=2, default=str)
+    return results
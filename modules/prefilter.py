@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from modules.sparse import SparseCounts, as_sample_matrix
+
+# Prefiltrado de OTUs/ASVs común a todas las pestañas. Los pasos se aplican en
+# este orden y el informe dice cuántos OTUs y lecturas quita cada uno.
+PREFILTER_STEPS = {
+    "exclude": "Exclusión taxonómica",
+    "min_count": "Conteo total mínimo",
+    "min_prevalence": "Prevalencia mínima",
+    "top_n": "Top N",
+}
+TOP_BY = {"abundance": "abundancia total", "variance": "varianza de la abundancia relativa"}
+DEFAULT_PREFILTER = {"min_count": 0, "min_prevalence": 0.0, "top_n": 0, "top_by": "abundance", "exclude": ()}
+
+def normalize_prefilter(params):
+    """
+    Parámetros completos y ordenados (tupla de pares, apta como clave de caché),
+    o None si no filtran nada. exclude: pares (nivel, texto).
+    """
+    if not params:
+        return None
+    full = {**DEFAULT_PREFILTER, **dict(params)}
+    if full["top_by"] not in TOP_BY:
+        raise ValueError(f"Criterio de top N no soportado: {full['top_by']}")
+    full["exclude"] = tuple(sorted((str(level), str(text).strip()) for level, text in full["exclude"] if str(text).strip()))
+    full["min_count"] = float(full["min_count"])
+    full["min_prevalence"] = float(full["min_prevalence"])
+    full["top_n"] = int(full["top_n"] or 0)
+    if not (full["exclude"] or full["min_count"] > 0 or full["min_prevalence"] > 0 or full["top_n"] > 0):
+        return None
+    return tuple(sorted(full.items()))
+
+def _excluded(features, taxonomy, exclude):
+    # OTUs cuyo taxón en el nivel indicado contiene el texto (sin distinguir mayúsculas)
+    out = np.zeros(len(features), dtype=bool)
+    if taxonomy is None:
+        return out
+    columns = {str(c).strip().lower(): c for c in taxonomy.columns}
+    for level, text in exclude:
+        col = columns.get(level.strip().lower())
+        if col is None:
+            continue
+        hit = taxonomy[col].astype(str).str.contains(text, case=False, regex=False, na=False)
+        out |= pd.Index(features).isin(taxonomy.index[hit.to_numpy()])
+    return out
+
+def _feature_stats(matrix):
+    """
+    Por OTU, en una pasada sobre la matriz muestras x OTUs: lecturas totales,
+    muestras en que aparece y varianza entre muestras de la abundancia relativa.
+    """
+    n_samples = matrix.shape[0]
+    if sparse.issparse(matrix):
+        X = sparse.csr_matrix(matrix, dtype=np.float64)
+        depth = np.asarray(X.sum(axis=1)).ravel()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = np.where(depth > 0, 1 / depth, 0.0)
+        rel = sparse.diags(scale) @ X
+        totals = np.asarray(X.sum(axis=0)).ravel()
+        prevalence = np.bincount(X.indices[X.data > 0], minlength=X.shape[1])
+        mean = np.asarray(rel.sum(axis=0)).ravel() / n_samples
+        mean_sq = np.asarray(rel.multiply(rel).sum(axis=0)).ravel() / n_samples
+    else:
+        X = np.asarray(matrix, dtype=np.float64)
+        depth = X.sum(axis=1, keepdims=True)
+        rel = np.divide(X, depth, out=np.zeros_like(X), where=depth > 0)
+        totals = X.sum(axis=0)
+        prevalence = (X > 0).sum(axis=0)
+        mean = rel.mean(axis=0)
+        mean_sq = (rel * rel).mean(axis=0)
+    return totals, prevalence, np.clip(mean_sq - mean ** 2, 0, None)
+
+def prefilter_features(otus, taxonomy=None, params=None):
+    """
+    OTUs que pasan el prefiltrado y el informe de lo eliminado.
+    - otus: DataFrame OTU x muestras o SparseCounts
+    - taxonomy: taxonomía indexada por ID de OTU (para la exclusión)
+    - params: dict o salida de normalize_prefilter con min_count (lecturas
+      totales), min_prevalence (fracción de muestras, 0-1), top_n y top_by
+      ("abundance" o "variance") y exclude (pares nivel, texto)
+    Devuelve (índice de OTUs conservados en el orden de la tabla, informe).
+    """
+    params = {**DEFAULT_PREFILTER, **dict(normalize_prefilter(params) or ())}
+    matrix, samples, features = as_sample_matrix(otus)
+    totals, prevalence, variance = _feature_stats(matrix)
+    keep = np.ones(len(features), dtype=bool)
+    report = {
+        "features_before": len(features), "reads_before": float(totals.sum()), "steps": {},
+    }
+
+    def apply(step, mask):
+        removed = keep & ~mask
+        report["steps"][step] = {"features": int(removed.sum()), "reads": float(totals[removed].sum())}
+        keep[:] &= mask
+
+    if params["exclude"]:
+        apply("exclude", ~_excluded(features, taxonomy, params["exclude"]))
+    if params["min_count"] > 0:
+        apply("min_count", totals >= params["min_count"])
+    if params["min_prevalence"] > 0:
+        apply("min_prevalence", prevalence >= params["min_prevalence"] * len(samples))
+    if 0 < params["top_n"] < keep.sum():
+        score = totals if params["top_by"] == "abundance" else variance
+        candidates = np.flatnonzero(keep)
+        # Orden estable: a igualdad de puntuación gana el primer OTU de la tabla
+        top = candidates[np.argsort(-score[candidates], kind="stable")[:params["top_n"]]]
+        mask = np.zeros(len(features), dtype=bool)
+        mask[top] = True
+        apply("top_n", mask)
+
+    report["features_after"] = int(keep.sum())
+    report["reads_after"] = float(totals[keep].sum())
+    return features[keep], report
+
+def select_features(otus, features):
+    """
+    La tabla de conteos (densa o SparseCounts) restringida a features.
+    """
+    if isinstance(otus, SparseCounts):
+        return otus.select_features(features)
+    return otus.loc[otus.index.isin(features)]
+
+def prefilter_summary(report):
+    """
+    Resumen en una línea de un informe de prefilter_features.
+    """
+    kept = report["reads_after"] / report["reads_before"] if report["reads_before"] else 0.0
+    steps = ", ".join(
+        f"{PREFILTER_STEPS[step]}: -{removed['features']}" for step, removed in report["steps"].items()
+    )
+    return (
+        f"Prefiltrado: {report['features_after']} de {report['features_before']} OTUs/ASVs "
+        f"({kept:.1%} de las lecturas) · {steps}"
+    )
@@ -0,0 +1,200 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from modules.alpha import ALPHA_METRICS, alpha_diversity_table
+from modules.sparse import SparseCounts, as_sample_matrix, smallest_int_dtype
+
+# Fracción de las muestras no vacías que conserva la profundidad automática
+AUTO_DEPTH_KEEP = 0.9
+DEFAULT_RAREFY = {"depth": 0, "iterations": 1, "seed": 42}
+
+def rarefaction_depths(nseqs, steps=10, min_depth=10):
+    """
+    Profundidades a evaluar para cada muestra (nseqs: lecturas por muestra),
+    de min(min_depth, nseqs) a nseqs en steps puntos enteros (como
+    np.linspace por muestra). Devuelve (profundidades muestras x steps,
+    máscara de las válidas: primera aparición de cada valor, muestras no vacías).
+    """
+    nseqs = np.asarray(nseqs, dtype=np.int64)
+    start = np.minimum(min_depth, nseqs)
+    step = (nseqs - start) / max(steps - 1, 1)
+    depths = (start[:, None] + np.arange(steps)[None, :] * step[:, None]).astype(np.int64)
+    depths[:, -1] = nseqs
+    valid = np.ones(depths.shape, dtype=bool)
+    valid[:, 1:] = depths[:, 1:] != depths[:, :-1]
+    valid &= (nseqs > 0)[:, None]
+    return depths, valid
+
+def _count_matrix(otus):
+    # CSR muestras x OTUs de conteos enteros no negativos, con índices ordenados
+    matrix, samples, features = as_sample_matrix(otus)
+    matrix = sparse.csr_matrix(matrix)
+    matrix = sparse.csr_matrix((np.rint(np.clip(matrix.data, 0, None)).astype(np.int64), matrix.indices, matrix.indptr),
+                               shape=matrix.shape)
+    matrix.sort_indices()
+    return matrix, samples, features
+
+def rarefaction_curves(otus, steps=10, iterations=10, seed=42, min_depth=10, progress=None):
+    """
+    Curvas de rarefacción de TODAS las muestras en una sola llamada.
+    Cada réplica de cada punto de la curva es un único submuestreo de toda
+    la tabla con _subsample (una profundidad por muestra): steps x iterations
+    llamadas vectorizadas, sin bucle por muestra y sin expandir lecturas.
+    Dentro de una réplica las profundidades están anidadas (cada curva es
+    monótona); la media y la DE de cada punto no cambian.
+    - otus: tabla OTU x muestras (como la devuelve load_table) o SparseCounts
+    - steps: número de profundidades por muestra (de min_depth hasta su total de lecturas)
+    - iterations: réplicas por profundidad, promediadas
+    - seed: semilla para resultados reproducibles
+    - progress(fracción) informa del avance por réplicas
+    Devuelve un DataFrame ordenado (tidy) con columnas
+    Muestra, Profundidad, OTUs Observados y DE (desviación estándar entre réplicas).
+    """
+    rng = np.random.default_rng(seed)
+    matrix, samples, _ = _count_matrix(otus)
+    sizes = np.asarray(matrix.sum(axis=1)).ravel()
+    depths, valid = rarefaction_depths(sizes, steps, min_depth)
+    entry_rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    observed = np.zeros(depths.shape)
+    observed_sq = np.zeros(depths.shape)
+    for it in range(iterations):
+        # De la mayor profundidad a la menor, cada una submuestreada de la
+        # anterior: sigue siendo un submuestreo uniforme de la muestra original
+        # y los OTUs ya agotados no necesitan sorteo
+        current = matrix.data
+        for s in range(steps - 1, -1, -1):
+            rows = np.flatnonzero(valid[:, s])
+            drawn = _subsample(current, matrix.indptr, rows, depths[rows, s], rng)
+            current = np.where(valid[entry_rows, s], drawn, current)
+            n_obs = np.bincount(entry_rows, weights=current > 0, minlength=matrix.shape[0])[rows]
+            observed[rows, s] += n_obs
+            observed_sq[rows, s] += n_obs ** 2
+        if progress:
+            progress((it + 1) / iterations)
+    mean = observed / iterations
+    sd = np.sqrt(np.clip(observed_sq / iterations - mean ** 2, 0, None))
+    r, c = np.nonzero(valid)
+    return pd.DataFrame({
+        "Muestra": samples[r], "Profundidad": depths[r, c], "OTUs Observados": mean[r, c], "DE": sd[r, c],
+    })
+
+def normalize_rarefy(params):
+    """
+    Parámetros completos de rarefy_table como tupla ordenada (clave de caché),
+    o None si no se rarefacta. depth 0 = profundidad automática.
+    """
+    if not params:
+        return None
+    full = {**DEFAULT_RAREFY, **dict(params)}
+    full = {"depth": int(full["depth"] or 0), "iterations": max(1, int(full["iterations"])), "seed": int(full["seed"])}
+    return tuple(sorted(full.items()))
+
+def auto_depth(library_sizes, keep=AUTO_DEPTH_KEEP):
+    """
+    Profundidad automática: la mayor que alcanzan al menos keep de las
+    muestras no vacías (cuantil inferior de los tamaños de biblioteca).
+    """
+    sizes = np.asarray(library_sizes)
+    sizes = np.sort(sizes[sizes > 0])
+    if not len(sizes):
+        return 0
+    # Muestras que deben alcanzarla; redondeado antes del techo porque
+    # (1 - 0.9) * 10 no da exactamente 1 en coma flotante
+    reach = max(1, int(np.ceil(round(keep * len(sizes), 9))))
+    return int(sizes[len(sizes) - reach])
+
+def _subsample(data, indptr, rows, depth, rng):
+    """
+    depth lecturas (un valor o uno por fila) sin reemplazo de cada fila de
+    rows de una CSR (data enteros), todas las filas a la vez. Cada tramo de OTUs se parte en dos
+    mitades y sus lecturas se reparten con una hipergeométrica; en
+    log2(OTUs por fila) rondas vectorizadas se llega a OTUs sueltos.
+    Es un muestreo exacto que nunca expande las lecturas individuales.
+    """
+    cumulative = np.concatenate([[0], np.cumsum(data, dtype=np.int64)])
+    out = np.zeros(len(data), dtype=np.int64)
+    lo, hi = indptr[rows].astype(np.int64), indptr[rows + 1].astype(np.int64)
+    k = np.broadcast_to(np.asarray(depth, dtype=np.int64), rows.shape).copy()
+    while len(lo):
+        single = hi - lo == 1
+        out[lo[single]] = k[single]
+        split = ~single & (k > 0)
+        lo, hi, k = lo[split], hi[split], k[split]
+        mid = (lo + hi) // 2
+        good, bad = cumulative[mid] - cumulative[lo], cumulative[hi] - cumulative[mid]
+        # Sin sorteo si se toman todas las lecturas del tramo o una mitad está vacía
+        left = np.where(bad == 0, k, np.minimum(good, k))
+        draw = (k < good + bad) & (good > 0) & (bad > 0)
+        left[draw] = rng.hypergeometric(good[draw], bad[draw], k[draw])
+        lo, hi, k = np.concatenate([lo, mid]), np.concatenate([mid, hi]), np.concatenate([left, k - left])
+    return out
+
+def rarefy_table(otus, depth=0, iterations=1, seed=42, alpha_metrics=None, progress=None):
+    """
+    Rarefacción de toda la tabla a una profundidad uniforme (normalización
+    para alfa, Bray-Curtis y agregados taxonómicos).
+    - otus: tabla OTU x muestras o SparseCounts
+    - depth: lecturas por muestra (0 = auto_depth); las muestras con menos se descartan
+    - iterations: submuestreos promediados; con más de uno la tabla tiene la
+      media de los conteos y los índices alfa son la media de los de cada
+      submuestreo (no los de la tabla media, que deja de tener singletons)
+    - seed: semilla; el resultado es reproducible
+    Devuelve un dict con counts (mismo tipo que otus), alpha (índices de
+    alpha_metrics, por defecto todos), depth, iterations, seed y dropped
+    (muestras descartadas).
+    """
+    matrix, samples, features = _count_matrix(otus)
+    sizes = np.asarray(matrix.sum(axis=1)).ravel()
+    depth = int(depth) if depth else auto_depth(sizes)
+    if depth <= 0:
+        raise ValueError("Todas las muestras están vacías; no se puede rarefactar.")
+    rows = np.flatnonzero(sizes >= depth)
+    if not len(rows):
+        raise ValueError(f"Ninguna muestra alcanza la profundidad de rarefacción ({depth} lecturas).")
+    kept = matrix[rows]
+    alpha_metrics = list(ALPHA_METRICS) if alpha_metrics is None else list(alpha_metrics)
+
+    rng = np.random.default_rng(seed)
+    total, alpha = None, []
+    for it in range(iterations):
+        drawn = sparse.csr_matrix(
+            (_subsample(kept.data, kept.indptr, np.arange(len(rows)), depth, rng), kept.indices, kept.indptr),
+            shape=kept.shape,
+        )
+        alpha.append(alpha_diversity_table(drawn, alpha_metrics).to_numpy())
+        total = drawn if total is None else total + drawn
+        if progress:
+            progress((it + 1) / iterations)
+
+    if iterations == 1:
+        counts = total.astype(smallest_int_dtype(depth))
+    else:
+        counts = (total / iterations).astype(np.float32).tocsr()
+    kept_samples = samples[rows]
+    counts = SparseCounts(counts, kept_samples, features)
+    if isinstance(otus, pd.DataFrame):
+        counts = counts.to_frame()
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        # Muestras con una métrica indefinida en todas las iteraciones (p. ej. ACE)
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean_alpha = np.nanmean(np.stack(alpha), axis=0)
+    return {
+        "counts": counts,
+        "alpha": pd.DataFrame(mean_alpha, index=kept_samples, columns=[ALPHA_METRICS[m] for m in alpha_metrics]),
+        "depth": depth, "iterations": iterations, "seed": seed,
+        "dropped": list(samples[np.setdiff1d(np.arange(len(samples)), rows)]),
+    }
+
+def rarefy_summary(report):
+    """
+    Resumen en una línea de un resultado de rarefy_table.
+    """
+    text = f"Rarefacción a {report['depth']} lecturas por muestra"
+    if report["iterations"] > 1:
+        text += f" (media de {report['iterations']} submuestreos)"
+    if report["dropped"]:
+        text += f" · {len(report['dropped'])} muestras descartadas por no alcanzar la profundidad"
+    return text
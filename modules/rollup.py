@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from modules.sparse import as_sample_matrix
+
+class TaxonomyIndex:
+    """
+    Mapeo OTU -> taxón precalculado una sola vez, para todos los niveles.
+    Cada nivel se guarda como una matriz indicadora dispersa OTUs x taxones
+    construida sobre códigos categóricos, de modo que la abundancia por
+    nivel es un único producto matricial (sin join ni groupby por cadenas).
+    - features: IDs de OTU en el orden de las columnas de la matriz de conteos
+    - taxonomy: tabla de taxonomía indexada por ID de OTU
+    - levels: niveles a indexar (por defecto todas las columnas)
+    Los OTUs sin taxonomía o con el nivel vacío no cuentan para ese nivel.
+    """
+
+    def __init__(self, features, taxonomy, levels=None):
+        taxonomy = taxonomy[~taxonomy.index.duplicated(keep="first")]
+        self.features = pd.Index(features)
+        self.levels = list(levels) if levels is not None else list(taxonomy.columns)
+        pos = taxonomy.index.get_indexer(self.features)
+        self.matched = int((pos >= 0).sum())
+        rows = np.flatnonzero(pos >= 0)
+        self.indicators = {}
+        self.taxa = {}
+        for level in self.levels:
+            # Solo los taxones con algún OTU presente en la tabla de conteos
+            cat = pd.Categorical(taxonomy[level].to_numpy()[pos[rows]])
+            codes = cat.codes
+            keep = codes >= 0
+            self.indicators[level] = sparse.csr_matrix(
+                (np.ones(keep.sum(), dtype=np.float64), (rows[keep], codes[keep])),
+                shape=(len(self.features), len(cat.categories)),
+            )
+            self.taxa[level] = pd.Index(cat.categories, name=level)
+
+    def rollup(self, matrix, level):
+        """
+        Abundancias muestras x taxones de un nivel a partir de una matriz
+        muestras x OTUs (densa o dispersa) con las columnas en el orden de features.
+        """
+        summed = matrix @ self.indicators[level]
+        if sparse.issparse(summed):
+            summed = summed.toarray()
+        return np.asarray(summed)
+
+    def rollup_frame(self, otus, level):
+        """
+        Como rollup(), pero a partir de la tabla (densa OTU x muestras o
+        SparseCounts) y devolviendo un DataFrame taxones x muestras.
+        """
+        matrix, samples, features = as_sample_matrix(otus)
+        if not features.equals(self.features):
+            raise ValueError("La tabla de conteos no coincide con los OTUs del índice taxonómico.")
+        return pd.DataFrame(self.rollup(matrix, level).T, index=self.taxa[level], columns=samples)
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+def smallest_int_dtype(max_value):
+    """
+    Tipo entero sin signo más pequeño capaz de representar max_value.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+class SparseCounts:
+    """
+    Tabla de conteos dispersa (opcional) para tablas OTU/ASV grandes.
+    - matrix: scipy.sparse CSR de enteros, muestras x OTUs (orientación de análisis)
+    - samples: índice de muestras (filas de matrix)
+    - features: índice de OTUs/ASVs (columnas de matrix)
+    Las tablas reales tienen >95% de ceros: 10k x 50k caben en unos cientos de MB.
+    """
+
+    def __init__(self, matrix, samples, features):
+        matrix = sparse.csr_matrix(matrix)
+        # Las matrices en caché son de solo lectura: se copia solo si hay que normalizar
+        if not matrix.has_canonical_format or (matrix.data == 0).any():
+            matrix = matrix.copy()
+            matrix.sum_duplicates()
+            matrix.eliminate_zeros()
+        self.matrix = matrix
+        self.samples = pd.Index(samples)
+        self.features = pd.Index(features)
+        self.attrs = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Convierte una tabla densa OTU x muestras (la orientación de load_table).
+        Los valores no numéricos o negativos se tratan como 0.
+        """
+        values = df.apply(pd.to_numeric, errors="coerce").fillna(0).to_numpy()
+        values = np.rint(np.clip(values, 0, None))
+        dtype = smallest_int_dtype(values.max() if values.size else 0)
+        matrix = sparse.csr_matrix(values.T.astype(dtype))
+        return cls(matrix, df.columns, df.index)
+
+    def to_frame(self):
+        """
+        Tabla densa OTU x muestras (solo para tablas pequeñas o subconjuntos).
+        """
+        return pd.DataFrame(self.matrix.T.toarray(), index=self.features, columns=self.samples)
+
+    def select_samples(self, samples):
+        pos = self.samples.get_indexer(samples)
+        if (pos < 0).any():
+            raise KeyError("Muestras no presentes en la tabla de conteos.")
+        return SparseCounts(self.matrix[pos], self.samples[pos], self.features)
+
+    def select_features(self, features):
+        pos = self.features.get_indexer(features)
+        if (pos < 0).any():
+            raise KeyError("OTUs no presentes en la tabla de conteos.")
+        return SparseCounts(self.matrix[:, pos], self.samples, self.features[pos])
+
+    @property
+    def shape(self):
+        # Misma orientación que la tabla densa: OTUs x muestras
+        return (len(self.features), len(self.samples))
+
+    @property
+    def nbytes(self):
+        m = self.matrix
+        return int(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes)
+
+def row_slice(matrix, start, stop):
+    """
+    Filas [start, stop) de una CSR como vistas de sus arrays (sin copiar los
+    datos; con una tabla del almacén siguen en el memory-map). Solo indptr,
+    de stop - start + 1 valores, es nuevo. scipy copia de todos modos los
+    tramos con menos de la mitad de los valores (libera el resto del array).
+    """
+    if start == 0 and stop == matrix.shape[0]:
+        return matrix
+    lo, hi = matrix.indptr[start], matrix.indptr[stop]
+    return sparse.csr_matrix(
+        (matrix.data[lo:hi], matrix.indices[lo:hi], matrix.indptr[start:stop + 1] - lo),
+        shape=(stop - start, matrix.shape[1]), copy=False,
+    )
+
+def as_sample_matrix(otus):
+    """
+    Devuelve (matriz muestras x OTUs, índice de muestras, índice de OTUs) tanto
+    para una tabla densa OTU x muestras como para SparseCounts, sin transponer
+    copias innecesarias en el caso disperso.
+    """
+    if isinstance(otus, SparseCounts):
+        return otus.matrix, otus.samples, otus.features
+    values = otus.apply(pd.to_numeric, errors="coerce").fillna(0).to_numpy().T
+    return values, otus.columns, otus.index
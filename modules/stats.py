@@ -1,25 +1,84 @@
 import streamlit as st
-import pandas as pd
+import numpy as np
 import plotly.express as px
-from modules.utils import load_table
+from modules.alignment import categorical_vars, load_dataset
+from modules.utils import session_load_options
+from modules.prefilter import prefilter_summary
+from modules.rarefaction import rarefy_summary
+from modules.instrumentation import span
+from modules.cache import hash_key, memoize
+from modules.differential import TESTS, differential_abundance
+from modules.jobs import background_result
 
+@st.fragment
 def stats_tab(otus_file, taxonomy_file, metadata_file):
     st.header("Modelos Estadísticos y Comparación de Tratamientos")
     st.info("Próximamente: integración completa con DESeq2 y modelos cero-inflados.")
-    otus = load_table(otus_file)
-    metadata = load_table(metadata_file)
-    if otus is None or metadata is None:
+    try:
+        ds = load_dataset(otus_file, taxonomy_file, metadata_file, **session_load_options())
+    except ValueError as e:
+        st.error(str(e))
+        return
+    if ds is None or ds.metadata is None:
         st.warning("Carga archivos para análisis.")
         return
+    otus = ds.common_counts()
+    metadata = ds.metadata
+    if ds.prefilter is not None:
+        st.caption(prefilter_summary(ds.prefilter))
+    if ds.rarefaction is not None:
+        st.caption(rarefy_summary(ds.rarefaction))
+
+    st.subheader("Abundancia diferencial (CLR)")
+    cat_vars = categorical_vars(metadata)
+    if not cat_vars:
+        st.warning("La metadata no tiene variables categóricas con al menos dos grupos.")
+        return
+    var = st.selectbox("Variable de agrupación", cat_vars, index=0, key="da_var")
+    groups = metadata[var].dropna().astype(str)
+    levels = sorted(groups.unique())
+    col_a, col_b, col_t = st.columns(3)
+    group_a = col_a.selectbox("Grupo A", levels, index=0, key="da_group_a")
+    group_b = col_b.selectbox("Grupo B (referencia)", levels, index=1 if len(levels) > 1 else 0, key="da_group_b")
+    test = col_t.selectbox("Prueba", list(TESTS), format_func=TESTS.get, index=0, key="da_test")
+    if group_a == group_b:
+        st.info("Selecciona dos grupos diferentes para el contraste.")
+        return
+
+    try:
+        # Resultado memorizado por (conjunto de datos, variable, contraste, prueba),
+        # calculado en la cola de trabajos en segundo plano
+        key = (ds.counts_key, hash_key(*metadata.index), var, hash_key(*groups), group_a, group_b, test)
+        res_df = background_result(
+            ("differential",) + key, "Abundancia diferencial",
+            lambda job: memoize(
+                "differential", key,
+                lambda: differential_abundance(
+                    otus, groups, (group_a, group_b), test=test, n_jobs=None, progress=job.report
+                ),
+            ),
+        )
+    except Exception as e:
+        st.error(f"No se pudo calcular la abundancia diferencial: {e}")
+        return
+    if res_df is None:
+        return
 
-    st.subheader("Volcano plot (simulado)")
-    # Simula resultados para el ejemplo
-    import numpy as np
-    res_df = pd.DataFrame({
-        "log2FC": np.random.normal(0, 2, len(otus.columns)),
-        "pvalue": np.random.uniform(0, 1, len(otus.columns)),
-        "ASV": otus.columns
-    })
-    res_df["-log10p"] = -np.log10(res_df["pvalue"])
-    fig = px.scatter(res_df, x="log2FC", y="-log10p", text="ASV", title="Volcano plot (randomizado)")
-    st.plotly_chart(fig)
+    res_df = res_df.dropna(subset=["pvalue"]).reset_index()
+    res_df["-log10p"] = -np.log10(res_df["pvalue"].clip(lower=1e-300))
+    res_df["Significativo"] = np.where(res_df["padj"] < 0.05, "FDR < 0.05", "n.s.")
+    st.caption(
+        f"{TESTS[test]} sobre valores CLR · {len(res_df)} ASVs evaluados · "
+        f"{(res_df['padj'] < 0.05).sum()} con FDR (Benjamini-Hochberg) < 0.05"
+    )
+    with span("grafico.volcano", puntos=len(res_df)):
+        fig = px.scatter(
+            res_df, x="log2FC", y="-log10p", color="Significativo", hover_name="ASV",
+            hover_data={"padj": ":.3g", "prevalencia": ":.2f"},
+            title=f"Volcano plot: {group_a} vs {group_b} ({var})"
+        )
+        st.plotly_chart(fig)
+    st.dataframe(
+        res_df.sort_values("pvalue")[["ASV", "log2FC", "log2FC_rel", "estadistico", "pvalue", "padj", "prevalencia"]].head(200),
+        use_container_width=True
+    )
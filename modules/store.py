@@ -0,0 +1,385 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from modules.sparse import SparseCounts
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+# Almacén de conjuntos de datos convertidos a formato binario/columnar.
+# Se puede mover con la variable de entorno UYWA_STORE_DIR. Las tablas se
+# guardan por huella de contenido y se comparten entre usuarios; cada usuario
+# tiene además su espacio de trabajo (sus estudios guardados), con una cuota.
+STORE_DIR = os.environ.get(
+    "UYWA_STORE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "uywa-microbiota", "datasets")
+)
+# Tamaño máximo del almacén compartido (expulsión LRU) y cuota por espacio de trabajo
+STORE_MAX_BYTES = int(os.environ.get("UYWA_STORE_MB", "10240")) * 1024 ** 2
+WORKSPACE_QUOTA_BYTES = int(os.environ.get("UYWA_WORKSPACE_MB", "2048")) * 1024 ** 2
+# Archivos de un estudio guardado (el árbol Newick es opcional, para UniFrac)
+STUDY_ROLES = ("otus", "taxonomy", "metadata", "tree")
+
+# Tamaño estimado del almacén compartido por directorio: se mide recorriéndolo
+# una vez y después se suma lo que se escribe. Solo se vuelve a recorrer
+# (evict_store) cuando la estimación supera STORE_MAX_BYTES.
+_size_lock = threading.Lock()
+_store_bytes = {}
+
+def _table_dir(content_hash):
+    return os.path.join(STORE_DIR, "tables", content_hash)
+
+def _touch(content_hash):
+    # La fecha del directorio de la tabla marca su último uso (para la expulsión LRU)
+    try:
+        os.utime(_table_dir(content_hash))
+    except OSError:
+        pass
+
+def _variant_dir(content_hash, variant):
+    return os.path.join(_table_dir(content_hash), variant)
+
+class StoredTable:
+    """
+    Referencia a un archivo ya guardado en el almacén. Se comporta como un
+    archivo subido (name, getvalue) para que load_table y el resto de la app
+    lo usen sin cambios, pero su huella se conoce sin leer el contenido y sus
+    tablas se abren con memory-map.
+    """
+
+    def __init__(self, content_hash, name):
+        self.content_hash = content_hash
+        self.name = name
+
+    def getvalue(self):
+        with self.open() as fh:
+            return fh.read()
+
+    def open(self):
+        # Manejador binario del archivo original (para leerlo por bloques)
+        _touch(self.content_hash)
+        return open(os.path.join(_table_dir(self.content_hash), "source.bin"), "rb")
+
+    def __repr__(self):
+        return f"StoredTable({self.name!r}, {self.content_hash[:8]})"
+
+def _atomic_dir(final_dir, write):
+    # Escribe en un directorio temporal y lo renombra: nunca quedan variantes a medias
+    tmp = f"{final_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp)
+    try:
+        write(tmp)
+        os.replace(tmp, final_dir)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(final_dir):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+def _save_ids(path, ids):
+    np.save(path, np.asarray([str(x) for x in ids], dtype=str), allow_pickle=False)
+
+def _load_ids(path):
+    return pd.Index(np.load(path, allow_pickle=False).astype(object))
+
+def _write_variant(path, obj):
+    if isinstance(obj, SparseCounts):
+        np.save(os.path.join(path, "data.npy"), obj.matrix.data)
+        np.save(os.path.join(path, "indices.npy"), obj.matrix.indices)
+        np.save(os.path.join(path, "indptr.npy"), obj.matrix.indptr)
+        _save_ids(os.path.join(path, "samples.npy"), obj.samples)
+        _save_ids(os.path.join(path, "features.npy"), obj.features)
+        kind = "sparse"
+    elif len(set(obj.dtypes)) == 1 and pd.api.types.is_numeric_dtype(obj.dtypes.iloc[0]):
+        # Tabla de conteos densa: una única matriz .npy más los índices
+        np.save(os.path.join(path, "values.npy"), np.ascontiguousarray(obj.to_numpy()))
+        _save_ids(os.path.join(path, "index.npy"), obj.index)
+        _save_ids(os.path.join(path, "columns.npy"), obj.columns)
+        kind = "dense"
+    else:
+        kind = "pickle"
+        if HAS_PARQUET:
+            try:
+                obj.to_parquet(os.path.join(path, "table.parquet"))
+                kind = "parquet"
+            except Exception:
+                # Columnas que Arrow no sabe tipar (p. ej. números y texto mezclados)
+                if os.path.exists(os.path.join(path, "table.parquet")):
+                    os.remove(os.path.join(path, "table.parquet"))
+        if kind == "pickle":
+            obj.to_pickle(os.path.join(path, "table.pkl"))
+    manifest = {"kind": kind, "attrs": dict(obj.attrs), "index_name": getattr(obj, "index", pd.Index([])).name}
+    with open(os.path.join(path, "manifest.json"), "w") as fh:
+        json.dump(manifest, fh)
+
+def _read_variant(path):
+    with open(os.path.join(path, "manifest.json")) as fh:
+        manifest = json.load(fh)
+    kind = manifest["kind"]
+    if kind == "sparse":
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        samples = _load_ids(os.path.join(path, "samples.npy"))
+        features = _load_ids(os.path.join(path, "features.npy"))
+        matrix = sparse.csr_matrix(
+            (load("data.npy"), load("indices.npy"), load("indptr.npy")),
+            shape=(len(samples), len(features)), copy=False,
+        )
+        obj = SparseCounts(matrix, samples, features)
+    elif kind == "dense":
+        values = np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+        obj = pd.DataFrame(
+            values, index=_load_ids(os.path.join(path, "index.npy")),
+            columns=_load_ids(os.path.join(path, "columns.npy")), copy=False,
+        )
+        obj.index.name = manifest.get("index_name")
+    elif kind == "parquet":
+        obj = pd.read_parquet(os.path.join(path, "table.parquet"), memory_map=True)
+    else:
+        obj = pd.read_pickle(os.path.join(path, "table.pkl"))
+    obj.attrs.update(manifest.get("attrs", {}))
+    return obj
+
+def save_source(content_hash, name, data):
+    """
+    Guarda (una sola vez) los bytes originales de un archivo subido, para
+    poder derivar nuevas variantes sin volver a subirlo. data son los bytes
+    o un manejador binario, que se copia por bloques.
+    """
+    path = _table_dir(content_hash)
+    if os.path.exists(os.path.join(path, "source.bin")):
+        _touch(content_hash)
+        return
+    os.makedirs(path, exist_ok=True)
+    tmp = os.path.join(path, f"source.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "wb") as fh:
+        if isinstance(data, bytes):
+            fh.write(data)
+        else:
+            shutil.copyfileobj(data, fh, 8 * 1024 ** 2)
+    os.replace(tmp, os.path.join(path, "source.bin"))
+    with open(os.path.join(path, "name.txt"), "w") as fh:
+        fh.write(name)
+    _written(source_bytes(content_hash))
+
+def save_table(content_hash, variant, obj):
+    """
+    Convierte una tabla parseada (DataFrame o SparseCounts) al formato binario.
+    variant identifica las opciones de parseo (index_col, sep, disperso...).
+    """
+    final_dir = _variant_dir(content_hash, variant)
+    if os.path.isdir(final_dir):
+        _touch(content_hash)
+        return
+    os.makedirs(_table_dir(content_hash), exist_ok=True)
+    _atomic_dir(final_dir, lambda tmp: _write_variant(tmp, obj))
+    _written(_dir_bytes(final_dir))
+
+def load_stored_table(content_hash, variant):
+    """
+    Abre una variante guardada con memory-map (lectura sin copia), o None si no existe.
+    """
+    path = _variant_dir(content_hash, variant)
+    if not os.path.isfile(os.path.join(path, "manifest.json")):
+        return None
+    try:
+        obj = _read_variant(path)
+    except (OSError, ValueError, KeyError):
+        return None
+    _touch(content_hash)
+    return obj
+
+def _dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def source_bytes(content_hash):
+    try:
+        return os.path.getsize(os.path.join(_table_dir(content_hash), "source.bin"))
+    except OSError:
+        return 0
+
+def _written(nbytes):
+    # Suma lo escrito a la estimación y expulsa solo si el almacén pasa del límite
+    with _size_lock:
+        known = _store_bytes.get(STORE_DIR)
+        if known is not None:
+            known = _store_bytes[STORE_DIR] = known + nbytes
+    if known is None or known > STORE_MAX_BYTES:
+        evict_store()
+
+def evict_store(max_bytes=None):
+    """
+    Mantiene el almacén compartido por debajo de max_bytes (UYWA_STORE_MB)
+    eliminando primero las tablas usadas hace más tiempo. Los archivos
+    originales de los estudios guardados en algún espacio de trabajo no se
+    eliminan (solo sus variantes, que se regeneran al abrirlos).
+    Devuelve los bytes liberados.
+    """
+    max_bytes = STORE_MAX_BYTES if max_bytes is None else max_bytes
+    folder = os.path.join(STORE_DIR, "tables")
+    if not os.path.isdir(folder):
+        with _size_lock:
+            _store_bytes[STORE_DIR] = 0
+        return 0
+    entries = []
+    for content_hash in os.listdir(folder):
+        path = os.path.join(folder, content_hash)
+        try:
+            entries.append((os.stat(path).st_mtime, content_hash, _dir_bytes(path)))
+        except OSError:
+            continue
+    total = sum(e[2] for e in entries)
+    if total <= max_bytes:
+        with _size_lock:
+            _store_bytes[STORE_DIR] = total
+        return 0
+    pinned = _pinned_hashes()
+    freed = 0
+    for _, content_hash, size in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        path = os.path.join(folder, content_hash)
+        if content_hash in pinned:
+            for name in os.listdir(path):
+                if os.path.isdir(os.path.join(path, name)):
+                    shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+            freed += size - _dir_bytes(path)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+            freed += size
+    with _size_lock:
+        _store_bytes[STORE_DIR] = total - freed
+    return max(freed, 0)
+
+def _safe_name(name):
+    return "".join(c if c.isalnum() or c in "-_ " else "_" for c in name).strip()
+
+def _studies_dir(workspace=None):
+    # Sin espacio de trabajo: estudios compartidos (los que usa cli.py por defecto)
+    if workspace is None:
+        return os.path.join(STORE_DIR, "studies")
+    return os.path.join(STORE_DIR, "workspaces", _safe_name(workspace))
+
+def _study_path(name, workspace=None):
+    return os.path.join(_studies_dir(workspace), f"{_safe_name(name)}.json")
+
+def _read_studies(folder):
+    if not os.path.isdir(folder):
+        return []
+    studies = []
+    for fname in os.listdir(folder):
+        if fname.endswith(".json"):
+            try:
+                with open(os.path.join(folder, fname)) as fh:
+                    studies.append(json.load(fh))
+            except (OSError, ValueError):
+                continue
+    return studies
+
+def _pinned_hashes():
+    # Huellas de las tablas referenciadas por algún estudio guardado
+    folders = [_studies_dir()]
+    root = os.path.join(STORE_DIR, "workspaces")
+    if os.path.isdir(root):
+        folders += [os.path.join(root, name) for name in os.listdir(root)]
+    return {
+        entry[role]["hash"]
+        for folder in folders for entry in _read_studies(folder)
+        for role in STUDY_ROLES if role in entry
+    }
+
+def workspace_usage(workspace=None, studies=None):
+    """
+    Bytes de los archivos originales referenciados por los estudios de un
+    espacio de trabajo (cada archivo cuenta una vez aunque lo usen varios estudios).
+    """
+    studies = list_studies(workspace) if studies is None else studies
+    hashes = {entry[role]["hash"] for entry in studies for role in STUDY_ROLES if role in entry}
+    return sum(source_bytes(h) for h in hashes)
+
+def save_study(name, otus_file=None, taxonomy_file=None, metadata_file=None, workspace=None,
+               quota=WORKSPACE_QUOTA_BYTES, tree_file=None):
+    """
+    Registra un estudio (OTUs + taxonomía + metadata y, si lo hay, el árbol
+    Newick) por nombre en un espacio de trabajo. Los archivos pueden ser
+    subidos o StoredTable; sus bytes
+    originales se guardan una sola vez en el almacén compartido aunque varios
+    usuarios guarden el mismo archivo. Lanza ValueError si el estudio dejaría
+    el espacio de trabajo por encima de quota bytes.
+    """
+    from modules.utils import file_hash, file_name, file_size, open_binary
+    entry = {"name": name, "saved": time.time()}
+    files = {}
+    for role, file in zip(STUDY_ROLES, (otus_file, taxonomy_file, metadata_file, tree_file)):
+        if file is None:
+            continue
+        content_hash = file_hash(file)
+        files[content_hash] = file
+        entry[role] = {"hash": content_hash, "name": file_name(file)}
+
+    if quota is not None:
+        others = [s for s in list_studies(workspace) if _safe_name(s["name"]) != _safe_name(name)]
+        used = {e[role]["hash"] for e in others for role in STUDY_ROLES if role in e}
+        new = sum(
+            file_size(f) if not isinstance(f, StoredTable) else source_bytes(h)
+            for h, f in files.items() if h not in used
+        )
+        if workspace_usage(workspace, others) + new > quota:
+            raise ValueError(
+                f"El estudio supera la cuota del espacio de trabajo ({quota / 2 ** 20:.0f} MB). "
+                "Elimina algún estudio guardado."
+            )
+
+    for content_hash, file in files.items():
+        if not isinstance(file, StoredTable):
+            with open_binary(file) as fh:
+                save_source(content_hash, file_name(file), fh)
+    path = _study_path(name, workspace)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fh:
+        json.dump(entry, fh)
+    return entry
+
+def list_studies(workspace=None):
+    """
+    Estudios guardados de un espacio de trabajo, del más reciente al más antiguo.
+    """
+    return sorted(_read_studies(_studies_dir(workspace)), key=lambda s: s.get("saved", 0), reverse=True)
+
+def delete_study(name, workspace=None):
+    """
+    Quita un estudio del espacio de trabajo. Sus tablas quedan en el almacén
+    compartido (otros estudios pueden usarlas) hasta que las expulse el LRU.
+    """
+    try:
+        os.remove(_study_path(name, workspace))
+    except FileNotFoundError:
+        pass
+    evict_store()
+
+def open_study(entry):
+    """
+    Devuelve (otus, taxonomía, metadata, árbol) como StoredTable (o None) de un estudio guardado.
+    """
+    return tuple(
+        StoredTable(entry[role]["hash"], entry[role]["name"]) if role in entry else None
+        for role in STUDY_ROLES
+    )
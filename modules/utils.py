@@ -1,46 +1,321 @@
+import hashlib
+import io
+import logging
+import os
+from contextlib import contextmanager
+
+import numpy as np
 import pandas as pd
+import scipy.sparse as sps
+
+from modules.cache import LRUCache, hash_bytes, hash_key
+from modules.biom_hdf5 import biom_counts, biom_metadata, biom_taxonomy, is_biom
+from modules.sparse import SparseCounts, smallest_int_dtype
+from modules.store import load_stored_table, save_source, save_table
+from modules.instrumentation import count, span
+
+# Caché de tablas ya parseadas, compartida por todas las pestañas y sesiones.
+# El presupuesto se puede ajustar con la variable de entorno UYWA_PARSE_CACHE_MB.
+PARSE_CACHE = LRUCache(max_bytes=int(os.environ.get("UYWA_PARSE_CACHE_MB", "512")) * 1024 ** 2)
+# Tamaño aproximado de cada bloque en la lectura por bloques de tablas grandes
+STREAM_CHUNK_BYTES = 64 * 1024 ** 2
+# Bytes por lectura al calcular huellas y copiar archivos
+READ_CHUNK_BYTES = 8 * 1024 ** 2
+
+logger = logging.getLogger("uywa.store")
+
+def file_name(file):
+    """
+    Nombre (en minúsculas) de un archivo subido o de una ruta en disco.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        return os.fspath(file).lower()
+    return file.name.lower() if hasattr(file, "name") else ""
+
+def file_bytes(file):
+    """
+    Contenido completo de un archivo subido (st.file_uploader), de un objeto
+    tipo archivo o de una ruta en disco, sin alterar su posición de lectura.
+    """
+    if hasattr(file, "getvalue"):
+        return file.getvalue()
+    if hasattr(file, "read"):
+        pos = file.tell()
+        file.seek(0)
+        data = file.read()
+        file.seek(pos)
+        return data
+    with open(file, "rb") as fh:
+        return fh.read()
+
+@contextmanager
+def open_binary(file):
+    """
+    Manejador binario al principio de un archivo subido, objeto tipo archivo,
+    StoredTable o ruta en disco, para leerlo por bloques sin cargarlo entero.
+    Al salir se restaura la posición de lectura de los objetos tipo archivo.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as fh:
+            yield fh
+    elif hasattr(file, "read"):
+        pos = file.tell()
+        file.seek(0)
+        try:
+            yield file
+        finally:
+            file.seek(pos)
+    elif hasattr(file, "open"):
+        with file.open() as fh:
+            yield fh
+    else:
+        yield io.BytesIO(file_bytes(file))
 
-def load_table(file, index_col=None, sep=None):
+def file_size(file):
     """
-    Carga un archivo de tabla (.csv, .tsv, .xlsx) y configura el índice si se indica.
+    Tamaño en bytes de un archivo (sin leerlo).
+    """
+    with open_binary(file) as fh:
+        return fh.seek(0, os.SEEK_END)
+
+def file_hash(file):
+    """
+    Huella del contenido de un archivo; identifica el conjunto de datos en las cachés.
+    Se calcula por bloques (igual que hash_bytes sobre el contenido completo).
+    Las tablas del almacén (StoredTable) ya la conocen y no se leen.
+    """
+    known = getattr(file, "content_hash", None)
+    if known is not None:
+        return known
+    digest = hashlib.blake2b(digest_size=16)
+    with open_binary(file) as fh:
+        for block in iter(lambda: fh.read(READ_CHUNK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _freeze(df):
+    if isinstance(df, SparseCounts):
+        for arr in (df.matrix.data, df.matrix.indices, df.matrix.indptr):
+            arr.flags.writeable = False
+        return df
+    # Marca los bloques numpy como de solo lectura: una escritura accidental
+    # sobre la tabla en caché falla en lugar de contaminar otras pestañas.
+    for blk in getattr(df._mgr, "blocks", ()):
+        values = getattr(blk, "values", None)
+        if isinstance(values, np.ndarray):
+            values.flags.writeable = False
+    return df
+
+def load_table(file, index_col=None, sep=None, sparse=False, streaming=False, progress=None, section="counts"):
+    """
+    Carga un archivo de tabla (.csv, .tsv, .xlsx, .biom) y configura el índice si se indica.
     Soporta index_col como nombre de columna (str) o índice por posición (int).
     Es robusto a variantes comunes de nombres de columna y espacios.
-    - file: archivo cargado (st.file_uploader)
+    - file: archivo cargado (st.file_uploader) o ruta en disco
     - index_col: nombre de la columna a usar como índice (ej: "OTU", "SampleID") o posición (0, 1, ...)
     - sep: separador opcional (por defecto autodetecta por extensión)
+    - sparse: si es True, la tabla de conteos (OTU x muestras) se devuelve como
+      SparseCounts (CSR entera muestras x OTUs) en lugar de un DataFrame denso
+    - streaming: lee la tabla de conteos por bloques, con tipos enteros mínimos y
+      sin los OTUs con todo ceros (tablas muy grandes); progress(fracción) informa del avance
+    - section: solo para .biom (un archivo con las tres tablas): "counts",
+      "taxonomy" o "metadata"; se leen en disperso directamente del HDF5
+
+    El resultado se guarda en PARSE_CACHE con clave (hash del contenido, index_col, sep),
+    de modo que el mismo archivo no se vuelve a parsear en cada rerun ni en cada pestaña.
+    Además se convierte una sola vez al almacén binario (modules.store): tras
+    reiniciar el servidor o desde otra sesión se abre con memory-map sin parsear.
+    Se devuelve una copia superficial de solo lectura: puede reindexarse o
+    renombrarse libremente, pero no modificarse en el sitio.
     """
     if file is None:
         return None
-    filename = file.name.lower() if hasattr(file, "name") else ""
+    filename = file_name(file)
+    content_hash = file_hash(file)
+    key = (content_hash, os.path.splitext(filename)[1], index_col, sep, sparse, streaming, section)
+    df = PARSE_CACHE.get(key)
+    if df is not None:
+        count("cache.parseo.memoria")
+    else:
+        # Segundo nivel: la versión binaria del almacén, abierta con memory-map
+        variant = hash_key(*key[1:])
+        with span("almacen.lectura", archivo=filename):
+            df = load_stored_table(content_hash, variant)
+        if df is not None:
+            count("cache.parseo.almacen")
+        else:
+            count("cache.parseo.calculo")
+            # Las tablas de texto se leen del manejador: el contenido nunca se copia entero en memoria
+            with span("parseo", archivo=filename, bytes=file_size(file), disperso=sparse), open_binary(file) as fh:
+                if is_biom(filename):
+                    df = _parse_biom(fh.read(), section, sparse)
+                elif streaming:
+                    df = _stream_counts(fh, filename, index_col, sep, sparse, progress)
+                else:
+                    df = _parse_table(fh, filename, index_col, sep)
+                    if sparse:
+                        df = SparseCounts.from_frame(df)
+            try:
+                with span("almacen.escritura", archivo=filename), open_binary(file) as fh:
+                    save_source(content_hash, filename, fh)
+                    save_table(content_hash, variant, df)
+            except Exception as e:
+                # El almacén es solo una caché: si no se puede escribir, la tabla ya está parseada
+                count("almacen.errores")
+                logger.warning("No se pudo guardar %s en el almacén: %s", filename, e)
+        df = PARSE_CACHE.put(key, _freeze(df), nbytes=df.nbytes if sparse else None)
+    return df if sparse else df.copy(deep=False)
+
+def _parse_biom(data, section, sparse=False):
+    if section in ("taxonomy", "metadata"):
+        df = biom_taxonomy(data) if section == "taxonomy" else biom_metadata(data)
+        if df is None:
+            raise ValueError(f"El archivo BIOM no contiene {'taxonomía' if section == 'taxonomy' else 'metadata de muestras'}.")
+        return df
+    counts = biom_counts(data)
+    if sparse:
+        return counts
+    df = counts.to_frame()
+    df.index.name = "OTU"
+    return df
+
+def _separator(filename, sep=None):
+    if sep:
+        return sep
+    return "," if filename.endswith(".csv") else "\t"
+
+def _resolve_index_col(columns, index_col):
+    """
+    Etiqueta real de la columna índice (por nombre normalizado o por posición), o None.
+    """
+    if index_col is None:
+        return None
+    if isinstance(index_col, int):
+        return columns[index_col]
+    # Normaliza nombres de columnas (quita espacios y pone en minúsculas para la búsqueda)
+    colnames_raw = [str(c) for c in columns]
+    colnames_norm = [c.strip().replace(" ", "").lower() for c in colnames_raw]
+    idx_norm = index_col.strip().replace(" ", "").lower()
+    if idx_norm in colnames_norm:
+        return columns[colnames_norm.index(idx_norm)]
+    raise ValueError(
+        f"No se encontró la columna '{index_col}'. Columnas detectadas: {colnames_raw}"
+    )
+
+def _parse_table(data, filename, index_col=None, sep=None):
+    # data: bytes o un manejador binario abierto (open_binary)
+    buffer = io.BytesIO(data) if isinstance(data, bytes) else data
     # Carga el archivo según extensión, SIEMPRE SIN índice
-    if filename.endswith(".csv"):
-        df = pd.read_csv(file, sep=sep if sep else ",")
-    elif filename.endswith(".tsv") or filename.endswith(".txt"):
-        df = pd.read_csv(file, sep=sep if sep else "\t")
+    if filename.endswith(".csv") or filename.endswith(".tsv") or filename.endswith(".txt"):
+        df = pd.read_csv(buffer, sep=_separator(filename, sep))
     elif filename.endswith(".xlsx"):
-        df = pd.read_excel(file)
+        df = pd.read_excel(buffer)
     else:
         raise ValueError("Formato de archivo no soportado.")
-    # Normaliza nombres de columnas (quita espacios y pone en minúsculas para la búsqueda)
-    colnames_raw = [str(c) for c in df.columns]
-    colnames_norm = [c.strip().replace(" ", "").lower() for c in colnames_raw]
-    # Fuerza el uso del nombre de columna como índice si es string
-    if index_col is not None and not isinstance(index_col, int):
-        idx_norm = index_col.strip().replace(" ", "").lower()
-        if idx_norm in colnames_norm:
-            real_col = colnames_raw[colnames_norm.index(idx_norm)]
-            df.set_index(real_col, inplace=True)
-        else:
-            raise ValueError(
-                f"No se encontró la columna '{index_col}'. Columnas detectadas: {colnames_raw}"
-            )
-    elif index_col is not None and isinstance(index_col, int):
-        df.set_index(df.columns[index_col], inplace=True)
+    real_col = _resolve_index_col(list(df.columns), index_col)
+    if real_col is not None:
+        df.set_index(real_col, inplace=True)
     # Limpia nombres finales de columnas e índice
     df.columns = [str(col).strip() for col in df.columns]
     df.index = df.index.map(lambda x: str(x).strip())
     return df
 
+def _count_lines(fh):
+    # Líneas del archivo (cota superior de las filas), leyendo por bloques
+    lines, last = 0, b"\n"
+    for block in iter(lambda: fh.read(READ_CHUNK_BYTES), b""):
+        lines += block.count(b"\n")
+        last = block[-1:]
+    fh.seek(0)
+    return lines + (last != b"\n")
+
+def _stream_counts(fh, filename, index_col=0, sep=None, sparse=False, progress=None):
+    """
+    Lectura por bloques de una tabla de conteos OTU x muestras desde un
+    manejador binario (open_binary), sin copiar el archivo en memoria:
+    - cada bloque de filas se valida (enteros no negativos) y se reduce al
+      entero sin signo más pequeño que lo representa
+    - los OTUs con todo ceros se descartan sobre la marcha
+    - en denso, los bloques se escriben en una matriz reservada de antemano
+      (filas acotadas por el número de líneas); solo se copia entera si un
+      bloque necesita un entero mayor (como mucho tres veces)
+    - progress(fracción) informa del avance
+    La memoria pico queda cerca del tamaño de la matriz final más un bloque.
+    """
+    if filename.endswith(".xlsx"):
+        # openpyxl no permite leer por bloques: se parsea entero y luego se comprime
+        df = _parse_table(fh, filename, index_col, sep)
+        counts = SparseCounts.from_frame(df)
+        keep = np.asarray((counts.matrix != 0).sum(axis=0)).ravel() > 0
+        counts = SparseCounts(counts.matrix[:, keep], counts.samples, counts.features[keep])
+        counts.attrs["dropped_features"] = int((~keep).sum())
+        if progress:
+            progress(1.0)
+        return counts if sparse else _downcast_frame(counts)
+    if not (filename.endswith(".csv") or filename.endswith(".tsv") or filename.endswith(".txt")):
+        raise ValueError("Formato de archivo no soportado.")
+
+    sep = _separator(filename, sep)
+    size = fh.seek(0, os.SEEK_END)
+    fh.seek(0)
+    header = pd.read_csv(fh, sep=sep, nrows=0)
+    fh.seek(0)
+    index_label = _resolve_index_col(list(header.columns), 0 if index_col is None else index_col)
+    sample_cols = [c for c in header.columns if c != index_label]
+    # Bloques de ~STREAM_CHUNK_BYTES en float64
+    chunksize = max(1, STREAM_CHUNK_BYTES // (8 * max(1, len(sample_cols))))
+    dtypes = {c: np.float64 for c in sample_cols}
+    dtypes[index_label] = str
+
+    if sparse:
+        pieces = []
+    else:
+        values_out = np.zeros((max(_count_lines(fh) - 1, 0), len(sample_cols)), dtype=np.uint8)
+    ids, rows, dropped = [], 0, 0
+    try:
+        reader = pd.read_csv(fh, sep=sep, index_col=index_label, dtype=dtypes, chunksize=chunksize)
+        for chunk in reader:
+            values = chunk.to_numpy(dtype=np.float64, na_value=0.0)
+            if (values < 0).any() or (values != np.rint(values)).any():
+                bad = chunk.index[((values < 0) | (values != np.rint(values))).any(axis=1)][:5]
+                raise ValueError(f"La tabla OTU debe contener conteos enteros no negativos (filas: {list(bad)}).")
+            keep = values.any(axis=1)
+            dropped += int((~keep).sum())
+            values = values[keep]
+            dtype = smallest_int_dtype(values.max() if values.size else 0)
+            if sparse:
+                pieces.append(sps.csr_matrix(values.astype(dtype)))
+            else:
+                if np.promote_types(values_out.dtype, dtype) != values_out.dtype:
+                    values_out = values_out.astype(np.promote_types(values_out.dtype, dtype))
+                values_out[rows:rows + len(values)] = values
+            rows += len(values)
+            ids.append(chunk.index[keep])
+            if progress:
+                progress(min(fh.tell() / max(size, 1), 1.0))
+    except ValueError as e:
+        raise ValueError(f"No se pudo leer la tabla OTU por bloques: {e}") from e
+
+    features = pd.Index(np.concatenate(ids) if ids else [], dtype=object).astype(str).str.strip()
+    samples = pd.Index([str(c).strip() for c in sample_cols])
+    if sparse:
+        matrix = sps.vstack(pieces).T.tocsr() if pieces else sps.csr_matrix((len(samples), 0), dtype=np.uint8)
+        result = SparseCounts(matrix, samples, features)
+    else:
+        # Las líneas vacías o sin OTU no son filas: se recorta la reserva en el sitio
+        values_out.resize((rows, len(samples)), refcheck=False)
+        result = pd.DataFrame(values_out, index=features, columns=samples, copy=False)
+    result.attrs["dropped_features"] = dropped
+    if progress:
+        progress(1.0)
+    return result
+
+def _downcast_frame(counts):
+    df = counts.to_frame()
+    df = df.astype(smallest_int_dtype(df.to_numpy().max() if df.size else 0))
+    df.attrs.update(counts.attrs)
+    return df
+
 def safe_float(val, default=0.0):
     try:
         if isinstance(val, str):
@@ -61,3 +336,28 @@ def clean_state(keys_prefix, valid_names):
                         break
                 if not found:
                     del st.session_state[key]
+
+def session_load_options():
+    """
+    Opciones de carga elegidas en la pestaña de carga (matriz dispersa,
+    lectura por bloques, prefiltrado de OTUs y rarefacción de la tabla,
+    comunes a todas las pestañas).
+    """
+    import streamlit as st
+    exclude_level = st.session_state.get("pf_exclude_level")
+    exclude_text = st.session_state.get("pf_exclude", "")
+    return {
+        "sparse": st.session_state.get("use_sparse", False),
+        "streaming": st.session_state.get("use_streaming", False),
+        "prefilter": {
+            "min_count": st.session_state.get("pf_min_count", 0),
+            "min_prevalence": st.session_state.get("pf_min_prevalence", 0) / 100,
+            "top_n": st.session_state.get("pf_top_n", 0),
+            "top_by": st.session_state.get("pf_top_by", "abundance"),
+            "exclude": [(exclude_level, t) for t in exclude_text.split(",") if t.strip()] if exclude_level else [],
+        },
+        "rarefy": {
+            "depth": st.session_state.get("rf_depth", 0),
+            "iterations": st.session_state.get("rf_iterations", 1),
+        } if st.session_state.get("rf_enabled", False) else None,
+    }
@@ -1 +1,178 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
 
+# Por encima de estos puntos las ordenaciones se dibujan con WebGL (Scattergl)
+WEBGL_MIN_POINTS = 1000
+# Máximo de muestras en un barplot apilado antes de submuestrear
+MAX_BAR_SAMPLES = 400
+PALETTE = px.colors.qualitative.Dark24
+SYMBOLS = ["circle", "triangle-up", "square", "star", "diamond", "cross", "x", "triangle-down"]
+
+def get_ellipse(x, y, n_std=2.0, num_points=100):
+    if len(x) < 3:
+        return None, None
+    cov = np.cov(x, y)
+    vals, vecs = np.linalg.eigh(cov)
+    order = vals.argsort()[::-1]
+    vals = vals[order]
+    vecs = vecs[:, order]
+    theta = np.degrees(np.arctan2(*vecs[:,0][::-1]))
+    width, height = 2 * n_std * np.sqrt(vals)
+    t = np.linspace(0, 2 * np.pi, num_points)
+    ellipse = np.array([width/2 * np.cos(t), height/2 * np.sin(t)])
+    R = np.array([[np.cos(np.radians(theta)), -np.sin(np.radians(theta))],
+                  [np.sin(np.radians(theta)),  np.cos(np.radians(theta))]])
+    ellipse_rot = R @ ellipse
+    x0, y0 = np.mean(x), np.mean(y)
+    return ellipse_rot[0] + x0, ellipse_rot[1] + y0
+
+def downsample_index(labels, max_points, seed=42):
+    """
+    Posiciones de un submuestreo estratificado (proporcional por etiqueta,
+    al menos un punto por grupo) de como mucho max_points elementos, en el
+    orden original. Reproducible con la misma semilla.
+    """
+    labels = pd.Series(np.asarray(labels)).astype(str)
+    n = len(labels)
+    if max_points is None or n <= max_points:
+        return np.arange(n)
+    rng = np.random.default_rng(seed)
+    keep = []
+    for _, pos in labels.groupby(labels, sort=False).indices.items():
+        take = max(1, int(round(len(pos) * max_points / n)))
+        keep.append(rng.choice(pos, size=min(take, len(pos)), replace=False))
+    return np.sort(np.concatenate(keep))
+
+def color_map(values):
+    return {g: PALETTE[i % len(PALETTE)] for i, g in enumerate(pd.unique(values))}
+
+def ordination_figure(coords, color_var, symbol_var=None, title=None, webgl_threshold=WEBGL_MIN_POINTS,
+                      max_points=None, ellipses=True):
+    """
+    Gráfico de ordenación (primeras dos columnas de coords) coloreado por
+    color_var y, opcionalmente, con símbolo por symbol_var.
+    - una traza por combinación color/símbolo (sin listas de símbolos por punto)
+    - Scattergl (WebGL) a partir de webgl_threshold puntos
+    - max_points: submuestreo estratificado de los marcadores; las elipses
+      se calculan siempre con todas las muestras del grupo
+    Devuelve (figura, número de puntos dibujados).
+    """
+    ax1, ax2 = coords.columns[:2]
+    colors = color_map(coords[color_var])
+    if symbol_var == color_var:
+        symbol_var = None
+    symbols = {v: SYMBOLS[i % len(SYMBOLS)] for i, v in enumerate(pd.unique(coords[symbol_var]))} if symbol_var else {}
+    shown = coords.iloc[downsample_index(coords[color_var], max_points)]
+    scatter = go.Scattergl if len(shown) >= webgl_threshold else go.Scatter
+    marker_size = 14 if len(shown) < 200 else (9 if len(shown) < webgl_threshold else 6)
+    hover = "Sample: %{customdata}<br>" + ax1 + ": %{x:.2f}<br>" + ax2 + ": %{y:.2f}<br>" + color_var + ": %{meta}"
+
+    traces = []
+    keys = [color_var, symbol_var] if symbol_var else [color_var]
+    for key, group_df in shown.groupby(keys, sort=False):
+        group = key[0] if isinstance(key, tuple) else key
+        name = str(group) if not symbol_var else f"{group} · {key[1]}"
+        traces.append(scatter(
+            x=group_df[ax1].to_numpy(), y=group_df[ax2].to_numpy(),
+            mode="markers", name=name, legendgroup=str(group), meta=str(group),
+            marker=dict(
+                color=colors[group], size=marker_size,
+                symbol=symbols[key[1]] if symbol_var else "circle",
+                line=dict(width=1 if len(shown) < webgl_threshold else 0, color="black"),
+            ),
+            customdata=group_df.index.to_numpy(),
+            hovertemplate=hover + "<extra></extra>",
+        ))
+    if ellipses:
+        for group, group_df in coords.groupby(color_var, sort=False):
+            ex, ey = get_ellipse(group_df[ax1].values, group_df[ax2].values)
+            if ex is not None:
+                traces.append(go.Scatter(
+                    x=ex, y=ey, mode="lines", line=dict(color=colors[group], width=2),
+                    name=f"{group} ellipse", legendgroup=str(group), showlegend=False, hoverinfo="skip",
+                ))
+    fig = go.Figure(traces)
+    fig.update_layout(xaxis_title=ax1, yaxis_title=ax2, legend_title=color_var, title=title, width=800, height=600)
+    return fig, len(shown)
+
+def stacked_bar_figure(pct, groups=None, title=None, group_label=None, max_samples=MAX_BAR_SAMPLES, aggregate=False):
+    """
+    Barplot apilado de abundancias relativas en formato ancho: una traza
+    go.Bar por taxón con los valores de todas las muestras (sin melt).
+    - pct: DataFrame muestras x taxones (porcentajes)
+    - groups: Serie muestra -> grupo; ordena las muestras por grupo y añade
+      separadores y rótulos en una sola actualización del layout
+    - aggregate: una barra por grupo con la media de sus muestras
+    - max_samples: submuestreo estratificado por grupo si hay más muestras
+    Devuelve (figura, número de barras dibujadas).
+    """
+    if groups is not None:
+        groups = groups.reindex(pct.index).astype(str)
+        if aggregate:
+            pct = pct.groupby(groups).mean()
+            groups = None
+        else:
+            order = np.lexsort((pct.index.astype(str), groups.to_numpy()))
+            pct, groups = pct.iloc[order], groups.iloc[order]
+    if not aggregate and max_samples is not None and len(pct) > max_samples:
+        keep = downsample_index(groups if groups is not None else np.zeros(len(pct)), max_samples)
+        pct = pct.iloc[keep]
+        groups = groups.iloc[keep] if groups is not None else None
+
+    x = pct.index.astype(str).to_numpy()
+    colors = color_map(pct.columns)
+    fig = go.Figure([
+        go.Bar(x=x, y=pct[taxon].to_numpy(), name=str(taxon), marker_color=colors[taxon],
+               hovertemplate="%{x}<br>" + str(taxon) + ": %{y:.2f}%<extra></extra>")
+        for taxon in pct.columns
+    ])
+    layout = dict(barmode="stack", bargap=0.05 if len(x) > 100 else 0.2, title=title,
+                  xaxis=dict(type="category", title="Grupo" if aggregate else "Muestra",
+                             showticklabels=len(x) <= 150),
+                  yaxis_title="% abundancia relativa")
+    if groups is not None:
+        # Separadores y rótulos de grupo: posiciones de inicio de cada bloque
+        values = groups.to_numpy()
+        starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+        ends = np.r_[starts[1:], len(values)] - 1
+        layout["shapes"] = [
+            dict(type="line", xref="x", yref="paper", x0=s - 0.5, x1=s - 0.5, y0=0, y1=1,
+                 line=dict(width=1, dash="dot", color="grey"))
+            for s in starts[1:]
+        ]
+        label = f"{group_label}: " if group_label else ""
+        layout["annotations"] = [
+            dict(x=(s + e) / 2, y=1.02, xref="x", yref="paper", text=f"{label}{values[s]}",
+                 showarrow=False, font=dict(size=13, color="black"))
+            for s, e in zip(starts, ends)
+        ]
+    fig.update_layout(**layout)
+    return fig, len(x)
+
+def grouped_lines_figure(df, x, y, line_group, color=None, title=None, webgl_threshold=WEBGL_MIN_POINTS):
+    """
+    Muchas líneas (p. ej. una curva por muestra) en una traza por color: las
+    líneas se concatenan separadas por huecos (NaN) en lugar de crear una
+    traza por línea, así que la figura tiene pocas trazas aunque haya miles de muestras.
+    """
+    df = df.sort_values([line_group, x])
+    colors = color_map(df[color]) if color else {None: PALETTE[0]}
+    scatter = go.Scattergl if len(df) >= webgl_threshold else go.Scatter
+    traces = []
+    for group, group_df in (df.groupby(color, sort=False) if color else [(None, df)]):
+        # Un hueco tras cada línea: posición del último punto de cada una
+        breaks = np.flatnonzero(group_df[line_group].to_numpy()[1:] != group_df[line_group].to_numpy()[:-1]) + 1
+        xs = np.insert(group_df[x].to_numpy(dtype=np.float64), breaks, np.nan)
+        ys = np.insert(group_df[y].to_numpy(dtype=np.float64), breaks, np.nan)
+        names = np.insert(group_df[line_group].astype(str).to_numpy(), breaks, "")
+        traces.append(scatter(
+            x=xs, y=ys, mode="lines+markers" if len(df) < webgl_threshold else "lines",
+            name=str(group) if color else y, line=dict(color=colors[group], width=1.5),
+            marker=dict(size=5), customdata=names, connectgaps=False,
+            hovertemplate="%{customdata}<br>" + x + ": %{x}<br>" + y + ": %{y:.1f}<extra></extra>",
+        ))
+    fig = go.Figure(traces)
+    fig.update_layout(title=title, xaxis_title=x, yaxis_title=y, legend_title=color)
+    return fig
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Los módulos se importan como en app.py y cli.py: desde la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def counts():
+    """
+    Tabla OTU x muestras pequeña con muchos ceros, empates y singletons
+    (binomial negativa), como las que devuelve load_table.
+    """
+    rng = np.random.default_rng(7)
+    X = rng.negative_binomial(0.5, 0.05, size=(40, 24))
+    return pd.DataFrame(
+        X, index=[f"OTU{i}" for i in range(X.shape[0])], columns=[f"S{j}" for j in range(X.shape[1])]
+    )
+
+@pytest.fixture
+def groups(counts):
+    # Tres grupos de tamaños distintos, alineados con las columnas de counts
+    labels = np.array(["A"] * 7 + ["B"] * 9 + ["C"] * 8)
+    return pd.Series(labels, index=counts.columns)
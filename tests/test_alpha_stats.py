@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from modules.alpha import alpha_diversity_table
+from modules.alpha_stats import alpha_group_tests
+
+# Las sumas por grupo van en otro orden que en scipy: diferencias de ~1e-14 en valor absoluto
+RTOL = 1e-11
+
+def _tests(counts, groups):
+    alpha = alpha_diversity_table(counts)
+    # Un NaN en una métrica: esa muestra no cuenta para esa métrica
+    alpha.iloc[2, 0] = np.nan
+    metadata = pd.DataFrame({"grupo": groups, "mitad": np.where(np.arange(len(groups)) < 12, "x", "y")},
+                            index=groups.index)
+    summary, posthoc = alpha_group_tests(alpha, metadata, ["grupo", "mitad"])
+    return alpha, metadata, summary, posthoc
+
+def _samples(alpha, metadata, metric, var):
+    values = alpha[metric]
+    ok = values.notna()
+    return {g: values[ok & (metadata[var] == g)].to_numpy() for g in metadata[var].unique()}
+
+def test_anova_and_kruskal_match_scipy(counts, groups):
+    alpha, metadata, summary, _ = _tests(counts, groups)
+    assert len(summary) == alpha.shape[1] * 2
+    for row in summary.itertuples(index=False):
+        samples = list(_samples(alpha, metadata, row[0], row[1]).values())
+        f, p = stats.f_oneway(*samples)
+        h, kp = stats.kruskal(*samples)
+        np.testing.assert_allclose([row[4], row[5]], [f, p], rtol=RTOL)
+        np.testing.assert_allclose([row[7], row[8]], [h, kp], rtol=RTOL)
+
+def test_pairwise_welch_matches_scipy(counts, groups):
+    alpha, metadata, _, posthoc = _tests(counts, groups)
+    assert len(posthoc) == alpha.shape[1] * (3 + 1)
+    for _, row in posthoc.iterrows():
+        samples = _samples(alpha, metadata, row["Métrica"], row["Variable"])
+        t, p = stats.ttest_ind(samples[row["Grupo A"]], samples[row["Grupo B"]], equal_var=False)
+        np.testing.assert_allclose([row["Welch t"], row["Welch p"]], [t, p], rtol=RTOL)
@@ -0,0 +1,84 @@
+import io
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from modules.biom_hdf5 import biom_counts, biom_info, biom_metadata, biom_taxonomy
+
+h5py = pytest.importorskip("h5py")
+
+# Tabla OTU x muestras conocida: 4 OTUs, 3 muestras
+TABLE = np.array([
+    [5, 0, 1],
+    [0, 2, 0],
+    [3, 0, 0],
+    [0, 7, 9],
+])
+OTUS = ["OTU_a", "OTU_b", "OTU_c", "OTU_d"]
+SAMPLES = ["S1", "S2", "S3"]
+
+def _biom_bytes(taxonomy=True, metadata=True):
+    """
+    BIOM v2.1 (HDF5) mínimo: la matriz por observación en CSR y por muestra
+    en CSC (la traspuesta), ids como texto y metadata opcional.
+    """
+    buffer = io.BytesIO()
+    with h5py.File(buffer, "w") as f:
+        f.attrs["format-version"] = [2, 1]
+        f.attrs["shape"] = list(TABLE.shape)
+        f.attrs["nnz"] = int(np.count_nonzero(TABLE))
+        for axis, ids, matrix in (("observation", OTUS, sparse.csr_matrix(TABLE)),
+                                  ("sample", SAMPLES, sparse.csr_matrix(TABLE.T))):
+            group = f.create_group(axis)
+            group.create_dataset("ids", data=np.array(ids, dtype="S"))
+            group.create_dataset("matrix/data", data=matrix.data.astype(np.float64))
+            group.create_dataset("matrix/indices", data=matrix.indices)
+            group.create_dataset("matrix/indptr", data=matrix.indptr)
+            group.create_group("metadata")
+        if taxonomy:
+            lineages = [["k__Bacteria", "p__Firmicutes", "c__Bacilli"],
+                        ["k__Bacteria", "p__Bacteroidota", ""],
+                        ["k__Archaea", "p__Euryarchaeota", "c__Methanobacteria"],
+                        ["k__Bacteria", "p__Firmicutes", "c__Clostridia"]]
+            f.create_dataset("observation/metadata/taxonomy", data=np.array(lineages, dtype="S"))
+        if metadata:
+            f.create_dataset("sample/metadata/Treatment", data=np.array(["A", "B", "A"], dtype="S"))
+            f.create_dataset("sample/metadata/Weight", data=np.array(["10.5", "11", "9.25"], dtype="S"))
+    return buffer.getvalue()
+
+def test_counts_orientation_and_ids():
+    counts = biom_counts(_biom_bytes())
+    assert list(counts.samples) == SAMPLES
+    assert list(counts.features) == OTUS
+    # La CSC por muestra se lee como CSR muestras x OTUs
+    np.testing.assert_array_equal(counts.matrix.toarray(), TABLE.T)
+    np.testing.assert_array_equal(counts.to_frame().to_numpy(), TABLE)
+    assert counts.matrix.dtype == np.uint8
+
+def test_taxonomy_columns():
+    taxonomy = biom_taxonomy(_biom_bytes())
+    assert list(taxonomy.columns) == ["Kingdom", "Phylum", "Class"]
+    assert list(taxonomy.index) == OTUS
+    assert taxonomy.loc["OTU_c", "Phylum"] == "Euryarchaeota"
+    assert taxonomy.loc["OTU_a", "Class"] == "Bacilli"
+    assert np.isnan(taxonomy.loc["OTU_b", "Class"])
+
+def test_metadata_index_and_types():
+    metadata = biom_metadata(_biom_bytes())
+    assert metadata.index.name == "SampleID"
+    assert list(metadata.index) == SAMPLES
+    assert list(metadata["Treatment"]) == ["A", "B", "A"]
+    np.testing.assert_array_equal(metadata["Weight"].to_numpy(), [10.5, 11.0, 9.25])
+
+def test_missing_sections():
+    data = _biom_bytes(taxonomy=False, metadata=False)
+    assert biom_taxonomy(data) is None
+    assert biom_metadata(data) is None
+    info = biom_info(data)
+    assert (info["n_features"], info["n_samples"], info["nnz"]) == (4, 3, 6)
+    assert not info["taxonomy"]
+
+def test_not_hdf5():
+    with pytest.raises(ValueError):
+        biom_counts(b'{"format": "Biological Observation Matrix 1.0.0"}')
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+from modules import cache
+from modules.cache import DiskCache
+
+def test_roundtrip_and_version(tmp_path, monkeypatch):
+    disk = DiskCache(str(tmp_path), 1024 ** 2)
+    disk.put(("ns", 1), {"a": 1})
+    assert disk.get(("ns", 1)) == {"a": 1}
+    # Otra versión del formato no ve los resultados anteriores
+    monkeypatch.setattr(cache, "CACHE_VERSION", cache.CACHE_VERSION + 1)
+    assert disk.get(("ns", 1)) is None
+
+class _Gone:
+    pass
+
+@pytest.mark.parametrize("payload", [b"no es un pickle", b""])
+def test_unreadable_pickle_is_a_miss(tmp_path, payload):
+    disk = DiskCache(str(tmp_path), 1024 ** 2)
+    path = disk._path(("ns", 2))
+    with open(path, "wb") as fh:
+        fh.write(payload)
+    assert disk.get(("ns", 2), "fallo") == "fallo"
+    assert not os.path.exists(path)
+
+def test_pickle_of_removed_class_is_a_miss(tmp_path, monkeypatch):
+    disk = DiskCache(str(tmp_path), 1024 ** 2)
+    disk.put(("ns", 3), _Gone())
+    # La clase ya no existe en el código actual: AttributeError al cargar
+    monkeypatch.delattr(sys.modules[__name__], "_Gone")
+    assert disk.get(("ns", 3)) is None
+    assert not os.path.exists(disk._path(("ns", 3)))
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from scipy import sparse, stats
+
+from modules.differential import bh_adjust, differential_abundance
+from modules.sparse import SparseCounts
+
+RTOL = 1e-11
+
+def _clr(counts, pseudocount=0.5):
+    logs = np.log(counts.to_numpy(dtype=np.float64) + pseudocount)
+    return logs - logs.mean(axis=0)
+
+def test_welch_matches_scipy(counts, groups):
+    res = differential_abundance(counts, groups, ("A", "B"), test="welch", block_size=7)
+    clr = _clr(counts)
+    t, p = stats.ttest_ind(clr[:, groups == "A"], clr[:, groups == "B"], axis=1, equal_var=False)
+    np.testing.assert_allclose(res["estadistico"], t, rtol=RTOL)
+    np.testing.assert_allclose(res["pvalue"], p, rtol=RTOL)
+
+def test_mannwhitney_matches_scipy(counts, groups):
+    res = differential_abundance(counts, groups, ("A", "C"), test="wilcoxon", block_size=7)
+    clr = _clr(counts)
+    u, p = stats.mannwhitneyu(clr[:, groups == "A"], clr[:, groups == "C"], axis=1, method="asymptotic")
+    np.testing.assert_allclose(res["estadistico"], u, rtol=RTOL)
+    np.testing.assert_allclose(res["pvalue"], p, rtol=RTOL)
+
+def test_kruskal_matches_scipy(counts, groups):
+    res = differential_abundance(counts, groups, ("A", "B"), test="kruskal", block_size=7)
+    clr = _clr(counts)
+    h, p = stats.kruskal(*(clr[:, groups == g] for g in ("A", "B", "C")), axis=1)
+    np.testing.assert_allclose(res["estadistico"], h, rtol=RTOL)
+    np.testing.assert_allclose(res["pvalue"], p, rtol=RTOL)
+
+@pytest.mark.parametrize("test", ["welch", "wilcoxon", "kruskal"])
+def test_sparse_matches_dense(counts, groups, test):
+    dense = differential_abundance(counts, groups, ("A", "B"), test=test)
+    sparse_counts = SparseCounts(sparse.csr_matrix(counts.to_numpy().T), counts.columns, counts.index)
+    res = differential_abundance(sparse_counts, groups, ("A", "B"), test=test, block_size=7)
+    np.testing.assert_allclose(res.to_numpy(), dense.to_numpy(), rtol=RTOL)
+
+def test_bh_adjust_matches_scipy():
+    p = np.random.default_rng(3).uniform(size=50)
+    p[[4, 9]] = np.nan
+    adjusted = bh_adjust(p)
+    ok = ~np.isnan(p)
+    np.testing.assert_allclose(adjusted[ok], stats.false_discovery_control(p[ok]), rtol=1e-14)
+    assert np.isnan(adjusted[~ok]).all()
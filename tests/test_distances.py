@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from scipy.spatial.distance import pdist, squareform
+from skbio.stats.composition import rclr
+
+from modules.distances import CondensedDistances, pairwise_distances
+from modules.sparse import SparseCounts
+
+# Las distancias se guardan en float32
+RTOL = 1e-6
+
+def _reference(counts, metric):
+    X = counts.to_numpy(dtype=np.float64).T
+    if metric == "braycurtis":
+        return pdist(X, "braycurtis")
+    if metric == "jaccard":
+        return pdist(X > 0, "jaccard")
+    return pdist(np.nan_to_num(rclr(X)), "euclidean")
+
+@pytest.mark.parametrize("metric", ["braycurtis", "jaccard", "aitchison"])
+def test_distances_match_reference(counts, metric):
+    dist = pairwise_distances(counts, metric, block_size=5)
+    assert dist.ids == list(counts.columns)
+    np.testing.assert_allclose(dist.condensed, _reference(counts, metric), rtol=RTOL, atol=1e-6)
+
+@pytest.mark.parametrize("metric", ["braycurtis", "jaccard", "aitchison"])
+def test_sparse_matches_dense(counts, metric):
+    dense = pairwise_distances(counts, metric)
+    sparse_counts = SparseCounts(sparse.csr_matrix(counts.to_numpy().T), counts.columns, counts.index)
+    np.testing.assert_array_equal(pairwise_distances(sparse_counts, metric, block_size=3).condensed, dense.condensed)
+
+def test_to_square_matches_squareform():
+    condensed = np.random.default_rng(5).uniform(size=15).astype(np.float32)
+    square = CondensedDistances(condensed, list("abcdef"), "braycurtis").to_square()
+    np.testing.assert_array_equal(square, squareform(condensed.astype(np.float64)))
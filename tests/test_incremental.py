@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.distances import extend_distances, pairwise_distances
+from modules.incremental import sample_fingerprints
+
+def _appended(counts):
+    """
+    Tabla base (18 muestras) y tabla ampliada: 6 muestras nuevas, una de
+    ellas intercalada, y un OTU nuevo que solo aparece en las nuevas.
+    """
+    base = counts.iloc[:, :18]
+    extra = counts.iloc[:, 18:].copy()
+    extra.columns = [f"N{j}" for j in range(extra.shape[1])]
+    full = pd.concat([base.iloc[:, :9], extra.iloc[:, :1], base.iloc[:, 9:], extra.iloc[:, 1:]], axis=1)
+    full.loc["OTU_nuevo"] = 0
+    full.loc["OTU_nuevo", extra.columns] = 3
+    return base, full
+
+@pytest.mark.parametrize("metric", ["braycurtis", "jaccard", "aitchison"])
+def test_extend_matches_full_recompute(counts, metric):
+    base, full = _appended(counts)
+    extended = extend_distances(pairwise_distances(base, metric), full, metric, block_size=4)
+    recomputed = pairwise_distances(full, metric)
+    assert extended.ids == recomputed.ids
+    np.testing.assert_array_equal(extended.condensed, recomputed.condensed)
+    assert extended.attrs["incremental"] == {"base_samples": 18, "new_samples": 6}
+
+def test_extend_rejects_unknown_base_samples(counts):
+    base, full = _appended(counts)
+    with pytest.raises(ValueError):
+        extend_distances(pairwise_distances(base), full.drop(columns=base.columns[0]))
+
+def test_fingerprints_survive_new_features(counts):
+    base, full = _appended(counts)
+    before = pd.Series(sample_fingerprints(base), index=base.columns)
+    after = pd.Series(sample_fingerprints(full.iloc[::-1]), index=full.columns)
+    np.testing.assert_array_equal(after[base.columns].to_numpy(), before.to_numpy())
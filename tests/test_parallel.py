@@ -0,0 +1,62 @@
+import operator
+import threading
+
+import numpy as np
+import pytest
+
+import modules.distances as distances
+import modules.permanova as permanova_module
+from modules.distances import pairwise_distances
+from modules.parallel import run_chunks
+from modules.permanova import permanova
+from modules.pipeline import phase_progress
+
+class Cancelled(Exception):
+    pass
+
+def test_run_chunks_keeps_order_and_reports():
+    seen = []
+    results = run_chunks(operator.mul, [(i, 2) for i in range(6)], 2, progress=seen.append, sizes=[1, 1, 1, 1, 1, 5])
+    assert results == [0, 2, 4, 6, 8, 10]
+    assert seen[-1] == 1.0
+    assert seen == sorted(seen)
+
+def test_run_chunks_on_result_receives_positions():
+    got = {}
+    assert run_chunks(operator.add, [(i, 10) for i in range(4)], 2, on_result=got.__setitem__) is None
+    assert got == {0: 10, 1: 11, 2: 12, 3: 13}
+
+def test_run_chunks_stops_when_progress_raises():
+    def progress(fraction):
+        raise Cancelled()
+    with pytest.raises(Cancelled):
+        run_chunks(operator.mul, [(i, 2) for i in range(50)], 2, progress=progress)
+
+def test_parallel_distances_from_thread_match_serial(counts, monkeypatch):
+    # La cola de trabajos abre los pools desde hilos del servidor
+    monkeypatch.setattr(distances, "PARALLEL_MIN_SAMPLES", 0)
+    serial = pairwise_distances(counts, "braycurtis", block_size=5, n_jobs=1)
+    out = {}
+    thread = threading.Thread(
+        target=lambda: out.update(dist=pairwise_distances(counts, "braycurtis", block_size=5, n_jobs=2))
+    )
+    thread.start()
+    thread.join()
+    np.testing.assert_array_equal(out["dist"].condensed, serial.condensed)
+
+def test_permanova_p_value_independent_of_n_jobs(counts, groups, monkeypatch):
+    monkeypatch.setattr(permanova_module, "PARALLEL_MIN_WORK", 0)
+    monkeypatch.setattr(permanova_module, "PERM_CHUNK", 64)
+    dist = pairwise_distances(counts, "braycurtis")
+    serial = permanova(dist, groups.to_numpy(), permutations=299, seed=3, n_jobs=1)
+    parallel = permanova(dist, groups.to_numpy(), permutations=299, seed=3, n_jobs=2)
+    assert serial["p-value"] == parallel["p-value"]
+
+def test_phase_progress_maps_into_its_span():
+    calls = []
+    phase = phase_progress(lambda fraction, message: calls.append((fraction, message)), 0.5, 1.0, "NMDS")
+    phase(0.0)
+    phase(0.5)
+    phase(1.0)
+    assert calls == [(0.5, "NMDS"), (0.75, "NMDS"), (1.0, "NMDS")]
+    assert phase_progress(None, 0.0, 0.5, "Distancias") is None
@@ -0,0 +1,32 @@
+import numpy as np
+from scipy.spatial.distance import pdist, squareform
+from skbio import DistanceMatrix
+from skbio.stats.distance import permanova as skbio_permanova
+
+from modules.distances import pairwise_distances
+from modules.permanova import permanova
+
+def test_pseudo_f_matches_skbio(counts, groups):
+    condensed = pdist(counts.to_numpy(dtype=np.float64).T, "braycurtis")
+    expected = skbio_permanova(DistanceMatrix(squareform(condensed), counts.columns), groups.to_numpy(),
+                               permutations=0)
+    for dist in (condensed, squareform(condensed)):
+        res = permanova(dist, groups.to_numpy(), permutations=99, n_jobs=1)
+        np.testing.assert_allclose(res["test statistic"], expected["test statistic"], rtol=1e-13)
+        assert res["sample size"] == expected["sample size"]
+        assert res["number of groups"] == expected["number of groups"]
+        assert 0 < res["p-value"] <= 1
+
+def test_condensed_distances_input(counts, groups):
+    # Distancias float32 del motor por bloques: mismo pseudo-F a precisión simple
+    dist = pairwise_distances(counts, "braycurtis", block_size=5)
+    expected = skbio_permanova(DistanceMatrix(dist.to_square(), dist.ids), groups.to_numpy(), permutations=0)
+    res = permanova(dist, groups.to_numpy(), permutations=0)
+    np.testing.assert_allclose(res["test statistic"], expected["test statistic"], rtol=1e-6)
+    assert np.isnan(res["p-value"])
+
+def test_permutations_reproducible_with_seed(counts, groups):
+    dist = pdist(counts.to_numpy(dtype=np.float64).T, "braycurtis")
+    serial = permanova(dist, groups.to_numpy(), permutations=199, seed=1, n_jobs=1)
+    again = permanova(dist, groups.to_numpy(), permutations=199, seed=1, n_jobs=1)
+    assert serial["p-value"] == again["p-value"]
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from modules.prefilter import normalize_prefilter, prefilter_features, prefilter_summary
+from modules.sparse import SparseCounts
+
+# Cada OTU cae en un paso concreto:
+# OTU1 mitocondria, OTU2 pocas lecturas, OTU3 poco prevalente,
+# OTU7 el más abundante y OTU5 el de mayor varianza relativa
+COUNTS = pd.DataFrame(
+    [[50, 50, 50, 50], [1, 0, 0, 0], [3, 3, 0, 0], [10, 10, 10, 10], [20, 1, 20, 1], [5, 5, 5, 5], [100, 100, 100, 100]],
+    index=[f"OTU{i}" for i in range(1, 8)], columns=["S1", "S2", "S3", "S4"],
+)
+TAXONOMY = pd.DataFrame(
+    {"Family": ["Mitochondria", "Lachnospiraceae", "Ruminococcaceae", "Prevotellaceae",
+                "Bacteroidaceae", "Lachnospiraceae", "Ruminococcaceae"]},
+    index=COUNTS.index,
+)
+ALL_STEPS = {"exclude": [("family", "mitochondria")], "min_count": 5, "min_prevalence": 0.75, "top_n": 1}
+
+def _kept(params, otus=COUNTS):
+    features, report = prefilter_features(otus, TAXONOMY, params)
+    return list(features), report
+
+def test_exclude_by_taxon_text():
+    kept, report = _kept({"exclude": [("Family", "MITOCHONDRIA")]})
+    assert kept == ["OTU2", "OTU3", "OTU4", "OTU5", "OTU6", "OTU7"]
+    assert report["steps"] == {"exclude": {"features": 1, "reads": 200.0}}
+
+def test_min_count():
+    kept, report = _kept({"min_count": 5})
+    assert "OTU2" not in kept and len(kept) == 6
+    assert report["steps"]["min_count"] == {"features": 1, "reads": 1.0}
+
+def test_min_prevalence():
+    kept, report = _kept({"min_prevalence": 0.75})
+    assert kept == ["OTU1", "OTU4", "OTU5", "OTU6", "OTU7"]
+    assert report["steps"]["min_prevalence"] == {"features": 2, "reads": 7.0}
+
+def test_steps_apply_in_order_and_report_what_each_removed():
+    kept, report = _kept(ALL_STEPS)
+    assert kept == ["OTU7"]
+    assert list(report["steps"]) == ["exclude", "min_count", "min_prevalence", "top_n"]
+    # Cada paso cuenta solo lo que quedaba tras los anteriores
+    assert report["steps"]["min_prevalence"] == {"features": 1, "reads": 6.0}
+    assert report["steps"]["top_n"] == {"features": 3, "reads": 102.0}
+    assert report["features_before"] == 7 and report["features_after"] == 1
+    assert report["reads_before"] == COUNTS.to_numpy().sum()
+    assert report["reads_after"] == 400.0
+    assert prefilter_summary(report).startswith("Prefiltrado: 1 de 7 OTUs/ASVs")
+
+def test_top_n_by_variance():
+    kept, _ = _kept(dict(ALL_STEPS, top_by="variance"))
+    assert kept == ["OTU5"]
+    # Referencia: varianza poblacional de la abundancia relativa por muestra
+    rel = COUNTS / COUNTS.sum(axis=0)
+    survivors = ["OTU4", "OTU5", "OTU6", "OTU7"]
+    assert rel.loc[survivors].var(axis=1, ddof=0).idxmax() == "OTU5"
+
+def test_sparse_matches_dense():
+    stored = SparseCounts(sparse.csr_matrix(COUNTS.to_numpy().T), COUNTS.columns, COUNTS.index)
+    for top_by in ("abundance", "variance"):
+        params = dict(ALL_STEPS, top_n=2, top_by=top_by)
+        assert _kept(params, stored) == _kept(params)
+
+def test_normalize_prefilter():
+    assert normalize_prefilter({"min_count": 0, "exclude": [("Family", "  ")]}) is None
+    assert normalize_prefilter({"top_n": 10}) == normalize_prefilter({"top_n": "10", "top_by": "abundance"})
+    with pytest.raises(ValueError):
+        normalize_prefilter({"top_n": 10, "top_by": "mediana"})
+    np.testing.assert_array_equal(_kept(None)[0], COUNTS.index)
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from modules.rarefaction import _subsample, auto_depth, rarefaction_curves, rarefy_table
+from modules.sparse import SparseCounts
+
+def _replicated(row, replicates):
+    # CSR con la misma fila repetida: cada réplica es un submuestreo independiente
+    return sparse.csr_matrix(np.tile(row, (replicates, 1)))
+
+def test_subsample_hits_depth_without_exceeding_counts(counts):
+    matrix = sparse.csr_matrix(counts.to_numpy().T)
+    sizes = np.asarray(matrix.sum(axis=1)).ravel()
+    rng = np.random.default_rng(0)
+    for depth in (sizes // 3, np.full(len(sizes), 1), sizes):
+        drawn = sparse.csr_matrix(
+            (_subsample(matrix.data, matrix.indptr, np.arange(len(sizes)), depth, rng), matrix.indices, matrix.indptr),
+            shape=matrix.shape,
+        )
+        np.testing.assert_array_equal(np.asarray(drawn.sum(axis=1)).ravel(), depth)
+        assert (drawn.data >= 0).all() and (drawn.data <= matrix.data).all()
+    # Solo las filas indicadas; el resto queda a cero
+    out = _subsample(matrix.data, matrix.indptr, np.array([3]), 10, rng)
+    assert out.sum() == 10 and out[matrix.indptr[3]:matrix.indptr[4]].sum() == 10
+
+def test_subsample_matches_multivariate_hypergeometric():
+    colors = np.array([40, 1, 7, 0, 120, 15, 3, 64, 2])
+    depth, replicates = 50, 20000
+    m = _replicated(colors, replicates)
+    rows = np.arange(replicates)
+    drawn = sparse.csr_matrix(
+        (_subsample(m.data, m.indptr, rows, depth, np.random.default_rng(1)), m.indices, m.indptr), shape=m.shape
+    ).toarray()
+    reference = np.random.default_rng(2).multivariate_hypergeometric(colors, depth, size=replicates)
+    # Momentos exactos de la hipergeométrica y los de la referencia de numpy
+    p = colors / colors.sum()
+    mean = depth * p
+    var = depth * p * (1 - p) * (colors.sum() - depth) / (colors.sum() - 1)
+    se_mean = np.sqrt(var / replicates)
+    assert (np.abs(drawn.mean(axis=0) - mean) <= 5 * se_mean + 1e-12).all()
+    assert (np.abs(drawn.mean(axis=0) - reference.mean(axis=0)) <= 7 * se_mean + 1e-12).all()
+    np.testing.assert_allclose(drawn.var(axis=0), var, rtol=0.05, atol=1e-3)
+    np.testing.assert_allclose(drawn.var(axis=0), reference.var(axis=0), rtol=0.07, atol=1e-3)
+
+def test_rarefaction_curves_are_monotone_and_end_at_richness(counts):
+    curves = rarefaction_curves(counts, steps=8, iterations=5, seed=3)
+    sizes, richness = counts.sum(axis=0), (counts > 0).sum(axis=0)
+    nonempty = sizes.index[sizes > 0]
+    assert set(curves["Muestra"]) == set(nonempty)
+    for sample, curve in curves.groupby("Muestra"):
+        assert curve["Profundidad"].is_monotonic_increasing
+        assert curve["OTUs Observados"].is_monotonic_increasing
+        last = curve.iloc[-1]
+        assert last["Profundidad"] == sizes[sample]
+        assert last["OTUs Observados"] == richness[sample] and last["DE"] == 0
+    # Dispersa y densa dan las mismas curvas
+    stored = SparseCounts(sparse.csr_matrix(counts.to_numpy().T), counts.columns, counts.index)
+    pd.testing.assert_frame_equal(rarefaction_curves(stored, steps=8, iterations=5, seed=3), curves)
+
+def test_samples_below_depth_are_dropped(counts):
+    sizes = counts.sum(axis=0)
+    depth = int(sizes.median())
+    res = rarefy_table(counts, depth=depth)
+    assert sorted(res["dropped"]) == sorted(sizes.index[sizes < depth])
+    assert list(res["counts"].columns) == list(sizes.index[sizes >= depth])
+    assert (res["counts"].sum(axis=0) == depth).all()
+    assert (res["counts"] <= counts[res["counts"].columns]).all().all()
+    assert list(res["alpha"].index) == list(res["counts"].columns)
+
+def test_no_sample_reaches_depth(counts):
+    with pytest.raises(ValueError, match="Ninguna muestra"):
+        rarefy_table(counts, depth=int(counts.sum(axis=0).max()) + 1)
+    with pytest.raises(ValueError, match="vacías"):
+        rarefy_table(counts * 0)
+
+def test_auto_depth_keeps_ninety_percent():
+    sizes = np.array([0, 0] + list(range(100, 1100, 100)))
+    # Diez muestras no vacías: la profundidad la alcanzan nueve de ellas
+    assert auto_depth(sizes) == 200
+    assert (sizes >= auto_depth(sizes)).sum() == 9
+    assert auto_depth(sizes, keep=1.0) == 100
+    assert auto_depth([0, 0]) == 0
+
+def test_auto_depth_is_used_by_default(counts):
+    res = rarefy_table(counts)
+    assert res["depth"] == auto_depth(counts.sum(axis=0))
+    assert len(res["dropped"]) <= round(0.1 * counts.shape[1])
+
+def test_averaged_counts_keep_the_depth(counts):
+    stored = SparseCounts(sparse.csr_matrix(counts.to_numpy().T), counts.columns, counts.index)
+    depth = auto_depth(counts.sum(axis=0))
+    res = rarefy_table(stored, depth=depth, iterations=7, seed=3)
+    assert res["counts"].matrix.dtype == np.float32
+    np.testing.assert_allclose(np.asarray(res["counts"].matrix.sum(axis=1, dtype=np.float64)).ravel(), depth, rtol=1e-6)
+    # Misma semilla, mismo resultado; y la tabla densa da lo mismo que la dispersa
+    dense = rarefy_table(counts, depth=depth, iterations=7, seed=3)
+    np.testing.assert_array_equal(dense["counts"].to_numpy(), res["counts"].to_frame().to_numpy())
+    pd.testing.assert_frame_equal(dense["alpha"], res["alpha"])
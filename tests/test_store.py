@@ -0,0 +1,152 @@
+import io
+import mmap
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from modules import store
+from modules.alignment import Alignment
+from modules.sparse import SparseCounts
+
+@pytest.fixture(autouse=True)
+def store_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, "STORE_DIR", str(tmp_path))
+    return tmp_path
+
+def _mapped(arr):
+    # El array (o alguno de sus bases) es un memory-map del archivo
+    while arr is not None:
+        if isinstance(arr, (np.memmap, mmap.mmap)):
+            return True
+        arr = getattr(arr, "base", None)
+    return False
+
+def _upload(name, data):
+    # Archivo subido como el de st.file_uploader (name + contenido)
+    file = io.BytesIO(data)
+    file.name = name
+    return file
+
+def _roundtrip(obj, variant="v"):
+    store.save_table("hash", variant, obj)
+    return store.load_stored_table("hash", variant)
+
+def test_dense_roundtrip(counts):
+    counts.index.name = "OTU"
+    counts.attrs["dropped_features"] = 2
+    loaded = _roundtrip(counts.astype(np.uint16))
+    pd.testing.assert_frame_equal(loaded, counts.astype(np.uint16))
+    assert loaded.index.name == "OTU"
+    assert loaded.attrs == {"dropped_features": 2}
+    assert _mapped(loaded.to_numpy())
+
+def test_sparse_roundtrip(counts):
+    original = SparseCounts(sparse.csr_matrix(counts.to_numpy().T.astype(np.uint8)), counts.columns, counts.index)
+    original.attrs["dropped_features"] = 1
+    loaded = _roundtrip(original)
+    assert (loaded.matrix != original.matrix).nnz == 0
+    assert loaded.matrix.dtype == np.uint8
+    assert list(loaded.samples) == list(original.samples)
+    assert list(loaded.features) == list(original.features)
+    assert loaded.attrs == {"dropped_features": 1}
+    assert all(_mapped(a) for a in (loaded.matrix.data, loaded.matrix.indices, loaded.matrix.indptr))
+
+@pytest.mark.parametrize("parquet", [True, False])
+def test_mixed_table_roundtrip(monkeypatch, parquet):
+    if parquet and not store.HAS_PARQUET:
+        pytest.skip("pyarrow no está instalado")
+    monkeypatch.setattr(store, "HAS_PARQUET", parquet)
+    taxonomy = pd.DataFrame({"Kingdom": ["Bacteria", "Archaea"], "Nivel": [1, 2]},
+                            index=pd.Index(["OTU1", "OTU2"], name="OTU"))
+    taxonomy.attrs["fuente"] = "prueba"
+    loaded = _roundtrip(taxonomy)
+    pd.testing.assert_frame_equal(loaded, taxonomy)
+    assert loaded.attrs == {"fuente": "prueba"}
+    files = os.listdir(store._variant_dir("hash", "v"))
+    assert ("table.parquet" in files) == parquet and ("table.pkl" in files) != parquet
+
+def test_mixed_types_fall_back_to_pickle():
+    # Números y texto en una columna: Arrow no la tipa y se guarda en pickle
+    mixed = pd.DataFrame({"Peso": [1, "dos", 3.5]}, index=["a", "b", "c"])
+    pd.testing.assert_frame_equal(_roundtrip(mixed), mixed)
+    assert "table.pkl" in os.listdir(store._variant_dir("hash", "v"))
+
+def test_corrupt_manifest_is_missing(counts):
+    store.save_table("hash", "v", counts)
+    with open(os.path.join(store._variant_dir("hash", "v"), "manifest.json"), "w") as fh:
+        fh.write("{roto")
+    assert store.load_stored_table("hash", "v") is None
+    assert store.load_stored_table("hash", "otra") is None
+
+def test_aligned_counts_stay_mapped(counts):
+    # Tomar todas las muestras (o un tramo contiguo) no copia la tabla del almacén
+    stored = _roundtrip(SparseCounts(sparse.csr_matrix(counts.to_numpy().T), counts.columns, counts.index))
+    alignment = Alignment(stored.features, stored.samples)
+    aligned = alignment.counts(stored)
+    assert np.shares_memory(aligned.matrix.data, stored.matrix.data)
+    alignment.sample_meta_pos[:] = -1
+    alignment.sample_meta_pos[2:22] = np.arange(20)
+    part = alignment.counts(stored, common_only=True)
+    assert np.shares_memory(part.matrix.data, stored.matrix.data)
+    assert (part.matrix != stored.matrix[2:22]).nnz == 0
+    assert list(part.samples) == list(stored.samples[2:22])
+    dense = _roundtrip(counts, "denso")
+    assert np.shares_memory(Alignment(dense.index, dense.columns).counts(dense).to_numpy(), dense.to_numpy())
+
+def test_study_over_quota_is_rejected():
+    store.save_study("pequeño", _upload("a.csv", b"x" * 100), workspace="ana", quota=150)
+    with pytest.raises(ValueError, match="cuota"):
+        store.save_study("grande", _upload("b.csv", b"y" * 100), workspace="ana", quota=150)
+    assert [s["name"] for s in store.list_studies("ana")] == ["pequeño"]
+    # Un archivo ya guardado en el espacio de trabajo no vuelve a contar
+    store.save_study("copia", _upload("a.csv", b"x" * 100), workspace="ana", quota=150)
+    assert store.workspace_usage("ana") == 100
+
+def test_eviction_keeps_sources_of_saved_studies(counts):
+    store.save_study("guardado", _upload("a.csv", b"a" * 1000), workspace="ana")
+    pinned = store.list_studies("ana")[0]["otus"]["hash"]
+    store.save_source("libre", "b.csv", b"b" * 1000)
+    for content_hash in (pinned, "libre"):
+        store.save_table(content_hash, "v", counts)
+        os.utime(store._table_dir(content_hash), (0, 0))
+    store.save_source("reciente", "c.csv", b"c" * 10)
+    assert store.evict_store(max_bytes=1500) > 0
+    assert not os.path.exists(store._table_dir("libre"))
+    assert store.source_bytes(pinned) == 1000
+    assert not os.path.exists(store._variant_dir(pinned, "v"))
+    assert store.source_bytes("reciente") == 10
+
+def test_study_and_workspace_names_stay_inside_store(store_dir):
+    store.save_study("../../fuera", _upload("a.csv", b"a"), workspace="../otro/ana")
+    written = [os.path.join(root, f) for root, _, files in os.walk(store_dir) for f in files if f.endswith(".json")]
+    assert len(written) == 1
+    assert os.path.realpath(written[0]).startswith(os.path.realpath(store_dir) + os.sep)
+    assert store.list_studies("../otro/ana")[0]["name"] == "../../fuera"
+    store.delete_study("../../fuera", workspace="../otro/ana")
+    assert store.list_studies("../otro/ana") == []
+
+def test_study_keeps_tree_file():
+    tree = b"((OTU1:0.1,OTU2:0.2):0.3,OTU3:0.4);"
+    entry = store.save_study("unifrac", _upload("otus.csv", b"otus"), workspace="ana", tree_file=_upload("arbol.nwk", tree))
+    otus, taxonomy, metadata, stored_tree = store.open_study(entry)
+    assert taxonomy is None and metadata is None
+    assert otus.getvalue() == b"otus"
+    assert stored_tree.name == "arbol.nwk"
+    assert stored_tree.getvalue() == tree
+    assert store.workspace_usage("ana") == len(b"otus") + len(tree)
+
+def test_saves_only_scan_store_when_over_budget(counts, monkeypatch):
+    scans = []
+    evict = store.evict_store
+    monkeypatch.setattr(store, "evict_store", lambda max_bytes=None: scans.append(1) or evict(max_bytes))
+    store.save_source("h1", "a.csv", b"a" * 100)
+    store.save_table("h1", "v", counts)
+    store.save_source("h2", "b.csv", b"b" * 100)
+    assert len(scans) == 1
+    monkeypatch.setattr(store, "STORE_MAX_BYTES", store._store_bytes[store.STORE_DIR] + 50)
+    store.save_source("h3", "c.csv", b"c" * 100)
+    assert len(scans) == 2
+    assert not os.path.exists(store._table_dir("h1"))
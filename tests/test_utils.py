@@ -0,0 +1,57 @@
+import io
+
+import numpy as np
+import pytest
+
+from modules import store, utils
+from modules.cache import hash_bytes
+
+class _Upload(io.BytesIO):
+    # Como un archivo de st.file_uploader: objeto tipo archivo con nombre
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+@pytest.fixture
+def table_bytes(counts):
+    counts = counts.copy()
+    counts.iloc[3] = 0
+    counts.iloc[30, 2] = 70000
+    counts.index.name = "OTU"
+    return counts, counts.to_csv().encode()
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, "STORE_DIR", str(tmp_path))
+    monkeypatch.setattr(utils, "PARSE_CACHE", utils.LRUCache(64 * 1024 ** 2))
+    # Bloques diminutos: varias lecturas y una promoción de tipo entero
+    monkeypatch.setattr(utils, "STREAM_CHUNK_BYTES", 24 * 8 * 7)
+
+def test_file_hash_streams_without_moving_position(table_bytes):
+    _, data = table_bytes
+    upload = _Upload(data, "otus.csv")
+    upload.seek(11)
+    assert utils.file_hash(upload) == hash_bytes(data)
+    assert upload.tell() == 11
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_streaming_matches_full_parse(table_bytes, sparse):
+    counts, data = table_bytes
+    result = utils.load_table(_Upload(data, "otus.csv"), index_col=0, streaming=True, sparse=sparse)
+    frame = result.to_frame() if sparse else result
+    assert result.attrs["dropped_features"] == 1
+    assert list(frame.index) == [i for i in counts.index if i != "OTU3"]
+    np.testing.assert_array_equal(frame.to_numpy(), counts.drop(index="OTU3").to_numpy())
+    if not sparse:
+        assert frame.dtypes.iloc[0] == np.uint32
+
+def test_streaming_rejects_non_integer_counts():
+    data = b"OTU,S1,S2\nA,1,2.5\n"
+    with pytest.raises(ValueError):
+        utils.load_table(_Upload(data, "otus.csv"), index_col=0, streaming=True)
+
+def test_source_copied_to_store(table_bytes, tmp_path):
+    _, data = table_bytes
+    utils.load_table(_Upload(data, "otus.csv"), index_col=0)
+    with open(tmp_path / "tables" / hash_bytes(data) / "source.bin", "rb") as fh:
+        assert fh.read() == data